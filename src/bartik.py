@@ -0,0 +1,152 @@
+"""
+This script build the shift share (Bartik) instrument of industry regulation
+"""
+
+import warnings
+
+import pandas as pd
+import numpy as np
+
+# regulation unit of each instrument variant
+BARTIK_UNIT = {1: "agency", 2: "document_reference"}
+
+
+class ShareMatrix:
+    """
+    ShareMatrix industry x unit initial shares
+        - sparse CSR matrix (only non-zero shares are stored)
+        - index maps from rows to industries and from columns to units
+    Args:
+        matrix [csr_matrix]: shares
+        industry [array]: industry of each row
+        unit [array]: unit (agency or document reference) of each column
+        unit_name [str]: name of the unit
+    """
+
+    def __init__(self, matrix, industry, unit, unit_name="agency"):
+        from scipy import sparse
+        self.matrix = sparse.csr_matrix(matrix)
+        self.industry = pd.Index(industry, name="industry")
+        self.unit = pd.Index(unit, name=unit_name)
+
+    @classmethod
+    def from_frame(cls, df_init, unit_name):
+        """
+        from_frame create the matrix from (industry, unit, share_init) rows
+        """
+        from scipy import sparse
+        industry_code, industry = pd.factorize(df_init["industry"], sort=True)
+        unit_code, unit = pd.factorize(df_init[unit_name], sort=True)
+        matrix = sparse.coo_matrix(
+            (df_init["share_init"].to_numpy(dtype=np.float64), (industry_code, unit_code)),
+            shape=(len(industry), len(unit)),
+            ).tocsr()
+        matrix.eliminate_zeros()
+        return cls(matrix, industry, unit, unit_name)
+
+    def to_frame(self):
+        """
+        to_frame dense industry x unit DataFrame (zero if no initial share)
+        """
+        return pd.DataFrame(self.matrix.toarray(), index=self.industry, columns=self.unit)
+
+    def save(self, path):
+        """
+        save store the matrix and index maps in one compressed .npz file
+        """
+        unit = self.unit.to_numpy()
+        if unit.dtype == object:
+            unit = unit.astype(str)
+        np.savez_compressed(
+            path,
+            data=self.matrix.data, indices=self.matrix.indices,
+            indptr=self.matrix.indptr, shape=self.matrix.shape,
+            industry=self.industry.to_numpy(), unit=unit,
+            unit_name=self.unit.name,
+            )
+
+    @classmethod
+    def load(cls, path):
+        """
+        load read a matrix stored by save
+        """
+        from scipy import sparse
+        with np.load(path) as f:
+            matrix = sparse.csr_matrix((f["data"], f["indices"], f["indptr"]), shape=tuple(f["shape"]))
+            return cls(matrix, f["industry"], f["unit"], str(f["unit_name"]))
+
+
+def bartik_instrument(df_merge, baseline_years=(1986,), mode=1):
+    """
+    bartik_instrument function that
+        - create initial industry shares of each regulation unit (agency or
+          document reference) pooled over the baseline years
+        - create the log restrictions of the unit
+            mode 1: leave the industry out, log(restrictions_2_0 - reg_s_d)
+            mode 2: log(restrictions_2_0)
+        - bartik_iv of each industry and year = sum over units of
+          initial share * log restrictions (sparse product by year)
+    Args:
+        df_merge [DataFrame]: sums by year, industry and unit (see data_regdata_sums)
+            with reg_s_d and restrictions_2_0
+        baseline_years [lst]: years of the initial shares
+        mode [int]: instrument variant (1 or 2)
+    Returns:
+        Data by year and industry with the instrument, initial shares (ShareMatrix)
+    """
+    from scipy import sparse
+
+    unit = BARTIK_UNIT[mode]
+
+    # initial shares (pooled over the baseline years)
+    df_init = df_merge.loc[df_merge.year.isin(baseline_years), ["industry", unit, "reg_s_d"]]
+    df_init = df_init.groupby(["industry", unit], sort=True, observed=True)["reg_s_d"].sum().reset_index()
+    reg_s_init = df_init.groupby("industry")["reg_s_d"].transform("sum")
+    with np.errstate(divide="ignore", invalid="ignore"):
+        df_init["share_init"] = np.where(df_init["reg_s_d"] > 0, df_init["reg_s_d"] / reg_s_init, 0)
+
+    share = ShareMatrix.from_frame(df_init, unit)
+
+    # log restrictions of the unit
+    restrictions = df_merge["restrictions_2_0"].to_numpy(dtype=np.float64)
+    with warnings.catch_warnings():  # suppress log zero warnings
+        warnings.simplefilter("ignore")
+        if mode == 1:
+            log_reg_d = np.log(restrictions - df_merge["reg_s_d"].to_numpy())
+        else:
+            log_reg_d = np.log(restrictions)
+    log_reg_d_one_out = np.where(restrictions > 0, log_reg_d, 0)
+    # missing values do not add to the sum, -inf (no restrictions left out)
+    # is kept as in the first version: the industry and year drop out of the IV sample
+    log_reg_d_one_out[np.isnan(log_reg_d_one_out)] = 0
+
+    # aggregate data by year and industry
+    df_iv = df_merge.groupby(["year", "industry"])["reg_s_d"].sum().reset_index()
+    df_iv = df_iv.rename(columns={"reg_s_d": "industry_restrictions_2_0"})
+
+    # shift share: sum over units of share * log restrictions, for each year
+    row = share.industry.get_indexer(df_merge["industry"])
+    col = share.unit.get_indexer(df_merge[unit])
+    # only the units with a stored share add to the sum (-inf * 0 would be nan)
+    n_units = share.matrix.shape[1]
+    stored = share.matrix.tocoo()
+    stored_key = np.sort(stored.row.astype(np.int64) * n_units + stored.col)
+    key = row.astype(np.int64) * n_units + col
+    pos = np.searchsorted(stored_key, key).clip(max=max(len(stored_key) - 1, 0))
+    in_share = (row >= 0) & (col >= 0) & (len(stored_key) > 0)
+    in_share[in_share] = stored_key[pos[in_share]] == key[in_share]
+    iv_row = share.industry.get_indexer(df_iv["industry"])
+    iv_index = df_iv.groupby("year").indices
+    bartik_iv = np.zeros(len(df_iv))
+    for year, index in df_merge.groupby("year").indices.items():
+        index = index[in_share[index]]
+        log_matrix = sparse.csr_matrix(
+            (log_reg_d_one_out[index], (row[index], col[index])), shape=share.matrix.shape
+            )
+        iv_year = np.asarray(share.matrix.multiply(log_matrix).sum(axis=1)).ravel()
+        index_iv = iv_index[year]
+        index_iv = index_iv[iv_row[index_iv] >= 0]
+        bartik_iv[index_iv] = iv_year[iv_row[index_iv]]
+    df_iv["bartik_iv"] = bartik_iv
+
+    return df_iv, share
@@ -0,0 +1,199 @@
+"""
+This script benchmark the make_data stages and the model estimators on
+synthetic data of several sizes and compare them with stored baselines
+"""
+
+import copy
+import json
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+import click
+import pandas as pd
+
+from Src.utility import parse_config
+from Src.synthetic import synthetic_data
+from Src.make_data import data_output
+from Src.model import model_output
+
+
+def benchmark_config(config, work_dir):
+    """
+    benchmark_config config of a benchmark run (every path in work_dir, no stage cache)
+    Args:
+        config [dict]: project config
+        work_dir [Path]: directory of the run
+    Return:
+        config
+    """
+    config = copy.deepcopy(config)
+    config_make = config["make_data"]
+    config_make["data_file_path"] = str(work_dir/"raw")
+    config_make["cleaned_data_path"] = str(work_dir/"cleaned")
+    config_make["cache_path"] = ""
+    config_make["report_path"] = str(work_dir/"reports")
+
+    config_model = config["model"]
+    suffix = "." + config_make["storage_format"]
+    for panel in ["sector_panel", "sector_age_panel", "sector_size_panel", "sector_age_size_panel"]:
+        config_model[panel] = str(work_dir/"cleaned"/f"{panel}{suffix}")
+    config_model["results_tables_path"] = str(work_dir/"results"/"tables")
+    config_model["results_figs_path"] = str(work_dir/"results"/"figs")
+    config_model["report_path"] = str(work_dir/"reports")
+    config_model["fit_store_path"] = str(work_dir/"results"/"fits.sqlite")
+
+    return config
+
+
+def stage_summary(report):
+    """
+    stage_summary totals of each stage of a run report (see profiling.RunReport)
+        - rows: input rows (output rows if the stage has no DataFrame input)
+        - rows_per_s: rows / seconds
+    Args:
+        report [dict]: content of stages.json
+    Return:
+        DataFrame by stage
+    """
+    df = pd.DataFrame(report["stages"], columns=["stage", "seconds", "peak_rss_mb", "rows_in", "rows"])
+    df["rows"] = df["rows_in"].fillna(df["rows"])
+    df_stage = df.groupby("stage", sort=False).agg(
+        calls=("seconds", "size"), seconds=("seconds", "sum"),
+        rows=("rows", lambda rows: rows.sum(min_count=1)), peak_rss_mb=("peak_rss_mb", "max"),
+        ).reset_index()
+
+    # whole run
+    df_run = pd.DataFrame({
+        "stage": [report["run"]], "calls": [1], "seconds": [report["seconds"]],
+        "rows": [df_stage["rows"].sum()],
+        "peak_rss_mb": [max(report["peak_rss_mb"], report["peak_rss_children_mb"])],
+        })
+    df_stage = pd.concat([df_run, df_stage], ignore_index=True)
+    df_stage["rows_per_s"] = df_stage["rows"] / df_stage["seconds"]
+
+    return df_stage
+
+
+def benchmark_scale(config_file, scale, work_path, jobs=1, seed=0):
+    """
+    benchmark_scale run make_data and model on synthetic data of one scale
+    Args:
+        config_file [str]: path to config file
+        scale [int]: size multiple of the synthetic data
+        work_path [Path]: directory of the benchmark runs
+        jobs [int]: number of worker processes of the stages
+        seed [int]: random seed of the synthetic data
+    Return:
+        DataFrame by stage (seconds, rows, rows/s and peak memory)
+    """
+    work_dir = Path.cwd()/work_path/f"scale_{scale}"
+    shutil.rmtree(work_dir, ignore_errors=True)
+    config = benchmark_config(parse_config(config_file), work_dir)
+
+    import yaml
+
+    # synthetic raw data and config of the run
+    raw_rows = synthetic_data(work_dir/"raw", config, scale, seed=seed)
+    for path in [config["make_data"]["cleaned_data_path"], config["model"]["results_figs_path"]]:
+        Path(path).mkdir(parents=True, exist_ok=True)
+    (Path(config["model"]["results_tables_path"])/"key_results").mkdir(parents=True, exist_ok=True)
+    with open(work_dir/"config.yaml", "w") as f:
+        yaml.safe_dump(config, f, sort_keys=False)
+
+    # runs (each writes a report of its stages)
+    data_output(str(work_dir/"config.yaml"), jobs, use_cache=False)
+    model_output.callback(str(work_dir/"config.yaml"), jobs, False, True)
+
+    df_lst = []
+    for path in sorted((work_dir/"reports").glob("*/stages.json")):
+        with open(path, "r") as f:
+            df_lst.append(stage_summary(json.load(f)))
+    df = pd.concat(df_lst, ignore_index=True)
+    df.insert(0, "scale", scale)
+    df.insert(1, "raw_rows", sum(raw_rows.values()))
+
+    return df
+
+
+def compare_baseline(df, baseline_path, tolerance=0.25):
+    """
+    compare_baseline compare the stage times with the stored baseline
+    Args:
+        df [DataFrame]: benchmark results (see benchmark_scale)
+        baseline_path [Path]: json file of the baseline {scale: {stage: seconds}}
+        tolerance [float]: relative slow down reported as a regression
+    Return:
+        results with baseline_seconds, ratio and regression columns
+    """
+    baseline = {}
+    if Path(baseline_path).exists():
+        with open(baseline_path, "r") as f:
+            baseline = json.load(f)
+
+    df["baseline_seconds"] = [
+        baseline.get(str(scale), {}).get(stage, float("nan"))
+        for scale, stage in zip(df["scale"], df["stage"])
+        ]
+    df["ratio"] = df["seconds"] / df["baseline_seconds"]
+    df["regression"] = df["ratio"] > 1 + tolerance
+
+    return df
+
+
+def write_baseline(df, baseline_path):
+    """
+    write_baseline store the stage times of the benchmark as the baseline
+    (scales not in the results keep their baseline)
+    """
+    baseline = {}
+    if Path(baseline_path).exists():
+        with open(baseline_path, "r") as f:
+            baseline = json.load(f)
+    for scale, df_scale in df.groupby("scale"):
+        baseline[str(scale)] = dict(zip(df_scale["stage"], df_scale["seconds"]))
+    Path(baseline_path).parent.mkdir(parents=True, exist_ok=True)
+    with open(baseline_path, "w") as f:
+        json.dump(baseline, f, indent=2)
+
+
+@click.command()
+@click.argument("config_file", type=str, default="src/config.yaml")
+@click.option("--scale", "scales", type=int, multiple=True, help="size multiples of the synthetic data (config if not set)")
+@click.option("--jobs", type=int, default=1, help="number of worker processes of the stages")
+@click.option("--save-baseline", is_flag=True, help="store the results as the new baseline")
+def benchmark_output(config_file, scales, jobs, save_baseline):
+    """
+    benchmark_output run the benchmarks of each scale (in a new process each,
+    so that the peak memory is the one of the scale) and report the results
+    Args:
+        config_file [str]: path to config file
+        scales [lst]: size multiples
+        jobs [int]: number of worker processes of the stages
+        save_baseline [bool]: store the results as the new baseline
+    """
+    config = parse_config(config_file)["benchmark"]
+    scales = list(scales) or config["scales"]
+    work_path = Path(config["work_path"])
+    baseline_path = Path.cwd()/config["baseline_path"]
+
+    df_lst = []
+    for scale in scales:
+        print(f"benchmark scale {scale}x")
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            df_lst.append(executor.submit(benchmark_scale, config_file, scale, work_path, jobs, config["seed"]).result())
+    df = compare_baseline(pd.concat(df_lst, ignore_index=True), baseline_path, config["tolerance"])
+
+    file_path = Path.cwd()/work_path/f"benchmark_{datetime.now():%Y%m%d_%H%M%S}.csv"
+    df.to_csv(file_path, index=False)
+    print(df[["scale", "stage", "calls", "seconds", "rows_per_s", "peak_rss_mb", "ratio", "regression"]].to_string(index=False))
+    print(f"results in {file_path}")
+    if df["regression"].any():
+        print(f"slower than the baseline: {', '.join(df.loc[df.regression, 'stage'].unique())}")
+
+    if save_baseline:
+        write_baseline(df, baseline_path)
+
+
+if __name__ == "__main__":
+    benchmark_output()
@@ -0,0 +1,202 @@
+"""
+This script compute wild cluster bootstrap inference of the (weighted) 2SLS models
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from Src.estimators import IVResults
+from Src.profiling import profiled
+
+
+def bootstrap_weights(rng, reps, n_clusters, weight_type="webb"):
+    """
+    bootstrap_weights draw the replicate weights of every cluster
+    Args:
+        rng [Generator]: random number generator
+        reps [int]: number of replicates
+        n_clusters [int]: number of clusters
+        weight_type [str]: "rademacher" (+1/-1) or "webb" (six point, better with few clusters)
+    Return:
+        reps by n_clusters matrix
+    """
+    if weight_type == "rademacher":
+        values = np.array([-1.0, 1.0])
+    elif weight_type == "webb":
+        values = np.sqrt(np.array([1.5, 1.0, 0.5]))
+        values = np.concatenate([-values, values])
+    else:
+        raise ValueError(f"bootstrap_weights: unknown weight type {weight_type}")
+
+    return values[rng.integers(0, len(values), size=(reps, n_clusters), dtype=np.int8)]
+
+
+class BootstrapResults(IVResults):
+    """
+    BootstrapResults estimates of one outcome with wild cluster bootstrap inference
+        - std_errors: cluster robust standard errors
+        - pvalues: restricted (null imposed) bootstrap-t p-values
+        - conf_int: unrestricted bootstrap-t (percentile-t) intervals
+    Args:
+        params [Series]: coefficients
+        std_errors [Series]: cluster robust standard errors
+        nobs [int]: number of observations
+        pvalues [Series]: bootstrap p-values
+        tstats_boot [DataFrame]: unrestricted bootstrap t-statistics (one column per coefficient)
+        reps [int]: number of replicates
+        params_boot [DataFrame]: unrestricted bootstrap coefficients (one column per coefficient)
+    """
+
+    def __init__(self, params, std_errors, nobs, pvalues, tstats_boot, reps, params_boot=None):
+        super().__init__(params, std_errors, nobs)
+        self.pvalues = pvalues
+        self.tstats_boot = tstats_boot
+        self.reps = reps
+        self.params_boot = params_boot
+
+    def conf_int(self, level=0.95):
+        """
+        conf_int bootstrap-t confidence interval
+        """
+        lower_q = self.tstats_boot.quantile((1 + level) / 2)
+        upper_q = self.tstats_boot.quantile((1 - level) / 2)
+        return pd.DataFrame(
+            {"lower": self.params - lower_q * self.std_errors, "upper": self.params - upper_q * self.std_errors}
+            )
+
+
+@profiled
+def wild_cluster_bootstrap(
+    design, y, clusters, report=None,
+    reps=999, weight_type="webb", seed=0, chunk_size=1000, jobs=1,
+    ):
+    """
+    wild_cluster_bootstrap wild restricted efficient (WRE) cluster bootstrap-t
+    of a (weighted) 2SLS model (Davidson and MacKinnon, 2010)
+        - both equations are resampled: the outcome and the endogenous
+          regressors of a replicate are fitted values plus the residuals of the
+          structural equation and of the first stage, multiplied by the same
+          weight of their cluster, and the first stage is estimated again
+        - the first stage residuals come from a regression of the endogenous
+          regressors on the instruments and the structural residuals
+          (efficient, keeps the correlation of the two equations)
+        - p-values impose the null (coefficient is zero) on the structural
+          equation, confidence intervals use the unrestricted residuals
+        - the instruments are the same in every replicate: the first and second
+          stage of a replicate only need the cluster sums of the data in the basis
+          of the instruments, so all replicates of a chunk are batched matrix products
+        - all weights are drawn at once and chunks of replicates can run on a
+          thread pool (the result does not depend on jobs or chunk_size for a given seed and reps)
+    Args:
+        design [IVDesign]: design of the model
+        y [DataFrame]: outcome (one column)
+        clusters [array]: cluster of each observation
+        report [lst]: coefficients to test (endogenous regressors if None)
+        reps [int]: number of replicates
+        weight_type [str]: replicate weights (see bootstrap_weights)
+        seed [int]: random seed
+        chunk_size [int]: replicates per chunk
+        jobs [int]: number of threads
+    Return:
+        BootstrapResults
+    """
+    from scipy import sparse
+
+    x = design.x
+    yy = design.transform(y)[:, 0]
+    names = design.names
+    report = design.endog if report is None else [var for var in report if var in names]
+    index = [names.index(var) for var in report]
+    n_obs, k = x.shape
+    k_exog = k - len(design.endog)
+
+    cluster_code, cluster_names = pd.factorize(np.asarray(clusters), sort=True)
+    n_clusters = len(cluster_names)
+    dummies = sparse.csr_matrix(
+        (np.ones(n_obs), (np.arange(n_obs), cluster_code)), shape=(n_obs, n_clusters),
+        )
+    scale = n_clusters / (n_clusters - 1)
+
+    # basis of the instruments (exogenous regressors included)
+    q, _ = np.linalg.qr(design.z)
+    n_basis = q.shape[1]
+    qx = q.T @ x
+    qy = q.T @ yy
+
+    def cluster_sums(w):
+        # cluster sums of q_i w_i': clusters by basis by columns of w
+        w = w.reshape(n_obs, -1)
+        prod = (q[:, :, None] * w[:, None, :]).reshape(n_obs, -1)
+        return np.asarray(dummies.T @ prod).reshape(n_clusters, n_basis, w.shape[1])
+
+    def bootstrap_dgp(params_dgp, u):
+        # first stage of the endogenous regressors on the instruments and the structural residuals
+        x_fit = x.copy()
+        if k_exog < k:
+            coef = np.linalg.lstsq(np.column_stack([q, u]), x[:, k_exog:], rcond=None)[0]
+            x_fit[:, k_exog:] = q @ coef[:n_basis]
+        # x* = x_fit + x_res v, y* = x* params_dgp + u v
+        x_res = x - x_fit
+        c_fit = cluster_sums(x_fit)
+        return params_dgp, c_fit.sum(axis=0), c_fit, cluster_sums(x_res), cluster_sums(u)[:, :, 0]
+
+    def replicates(v, dgp, cols):
+        # coefficients (minus those of the dgp) and t-statistics of the replicates of a chunk
+        params_dgp, m_fit, c_fit, c_res, c_u = dgp
+        m = m_fit + np.einsum("bg,glk->blk", v, c_res)              # q'x*
+        mt = m.transpose(0, 2, 1)
+        h = np.linalg.inv(mt @ m)
+        delta = (h @ (mt @ (v @ c_u)[:, :, None]))[:, :, 0]          # b* - b = (x*'Pz x*)^-1 x*'Pz u v
+        # cluster sums of q_i e*_i with e* = u v - x* (b* - b)
+        r = v[:, :, None] * (c_u[None] - np.einsum("glk,bk->bgl", c_res, delta))
+        r -= np.einsum("glk,bk->bgl", c_fit, delta)
+        scores = np.einsum("bgl,blk->bgk", r, (m @ h)[:, :, cols])
+        se_boot = np.sqrt(scale * (scores ** 2).sum(axis=1))
+        return delta[:, cols], delta[:, cols] / se_boot
+
+    # estimates and cluster robust standard errors
+    params = design.xa.T @ yy
+    u_unr = yy - x @ params
+    s_unr = dummies.T @ (design.xa[:, index] * u_unr[:, None])
+    se = np.sqrt(scale * (s_unr ** 2).sum(axis=0))
+    dgp_unr = bootstrap_dgp(params, u_unr)
+
+    # restricted 2SLS of each tested coefficient (coefficient is zero)
+    dgp_res = []
+    for j in index:
+        free = [i for i in range(k) if i != j]
+        params_r = np.zeros(k)
+        if free:
+            params_r[free] = np.linalg.lstsq(qx[:, free], qy, rcond=None)[0]
+        dgp_res.append(bootstrap_dgp(params_r, yy - x @ params_r))
+
+    def run_chunk(chunk):
+        v = weights[chunk]
+        tstats_res = np.column_stack([replicates(v, dgp, [j])[1][:, 0] for j, dgp in zip(index, dgp_res)])
+        delta, tstats_unr = replicates(v, dgp_unr, index)
+        return tstats_res, tstats_unr, params[index] + delta
+
+    weights = bootstrap_weights(np.random.default_rng(seed), reps, n_clusters, weight_type)
+    chunks = [slice(start, start + chunk_size) for start in range(0, reps, chunk_size)]
+    if jobs > 1:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            outputs = list(executor.map(run_chunk, chunks))
+    else:
+        outputs = [run_chunk(chunk) for chunk in chunks]
+    tstats_res, tstats_unr, params_boot = [np.concatenate(output) for output in zip(*outputs)]
+
+    # symmetric bootstrap p-values of the null
+    tstats = params[index] / se
+    pvalues = (np.abs(tstats_res) >= np.abs(tstats)).mean(axis=0)
+
+    return BootstrapResults(
+        pd.Series(params[index], index=report, name="parameter"),
+        pd.Series(se, index=report, name="std_error"),
+        len(yy),
+        pd.Series(pvalues, index=report, name="pvalue"),
+        pd.DataFrame(tstats_unr, columns=report),
+        reps,
+        pd.DataFrame(params_boot, columns=report),
+        )
@@ -0,0 +1,300 @@
+"""
+This script cache the results of the make_data stages and the model fits on disk
+"""
+
+import ast
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import sqlite3
+import time
+from contextlib import closing
+from pathlib import Path
+import pandas as pd
+
+from Src.utility import run_tasks
+
+
+def file_digest(path, chunk_size=2**24):
+    """
+    file_digest hash the content of a file
+    Args:
+        path [Path]: file path
+        chunk_size [int]: bytes read at a time
+    Return:
+        hex digest
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def module_files(path, package="Src"):
+    """
+    module_files function that
+        - find the modules of the package imported by a source file, and the
+          modules they import (nested imports included)
+        - a stage keyed on these files reruns when any helper it can reach changes
+    Args:
+        path [Path]: source file of the package
+        package [str]: name the package is imported as
+    Return:
+        sorted list of source files (path included)
+    """
+    package_dir = Path(path).resolve().parent
+    files = set()
+    todo = [Path(path).resolve()]
+    while todo:
+        file = todo.pop()
+        if file in files or not file.exists():
+            continue
+        files.add(file)
+        for node in ast.walk(ast.parse(file.read_text(), filename=str(file))):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+                # from Src import module or from Src.module import name
+                names = [f"{node.module}.{alias.name}" for alias in node.names] + [node.module]
+            else:
+                continue
+            for name in names:
+                parts = name.split(".")
+                if parts[0] == package and len(parts) > 1:
+                    todo.append(package_dir/f"{parts[1]}.py")
+    return sorted(files)
+
+
+class StageCache:
+    """
+    StageCache store stage results keyed on a hash of the stage inputs
+        - key parts: input file contents, the relevant config section,
+          upstream stage keys and the source code of the stage
+        - results are pickled in cache_dir and evicted least recently used
+          once the cache is larger than max_bytes
+    Args:
+        cache_dir [Path]: cache directory
+        max_bytes [int]: size limit of the stored results
+        code_files [lst]: source files whose changes invalidate every stage
+    """
+
+    def __init__(self, cache_dir, max_bytes=10 * 2**30, code_files=()):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.index_path = self.cache_dir/"index.json"
+        self.index = {"stages": {}, "files": {}}
+        if self.index_path.exists():
+            with open(self.index_path, "r") as f:
+                self.index = json.load(f)
+        self.code = [self.file_key(path) for path in code_files]
+        self.hits = 0
+        self.misses = 0
+
+    def file_key(self, path):
+        """
+        file_key content hash of an input file
+            (only recomputed when the size or modification time changes)
+        """
+        path = Path(path).resolve()
+        stat = path.stat()
+        memo = self.index["files"].get(str(path))
+        if memo is None or memo["size"] != stat.st_size or memo["mtime"] != stat.st_mtime_ns:
+            memo = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "digest": file_digest(path)}
+            self.index["files"][str(path)] = memo
+            self._save_index()
+        return memo["digest"]
+
+    def key(self, stage, *parts):
+        """
+        key hash of a stage name and its key parts (json serializable)
+        """
+        text = json.dumps([stage, self.code, parts], sort_keys=True, default=str)
+        return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+    def get(self, key):
+        """
+        get load a stored result
+        Return:
+            (True, result) if stored, (False, None) otherwise
+        """
+        entry = self.index["stages"].get(key)
+        path = self.cache_dir/f"{key}.pkl"
+        if entry is None or not path.exists():
+            self.misses += 1
+            return False, None
+
+        self.hits += 1
+        entry["last_used"] = time.time()
+        self._save_index()
+        return True, pd.read_pickle(path)
+
+    def put(self, key, stage, result):
+        """
+        put store a result and evict the least recently used ones
+        """
+        path = self.cache_dir/f"{key}.pkl"
+        pd.to_pickle(result, path)
+        self.index["stages"][key] = {
+            "stage": stage, "size": path.stat().st_size, "last_used": time.time()
+            }
+        self._evict()
+        self._save_index()
+        return result
+
+    def run(self, stage, parts, func, *args, **kwargs):
+        """
+        run return the stored result of func(*args, **kwargs) or run and store it
+            - the source code of func is part of the key
+        Args:
+            stage [str]: stage name
+            parts [lst]: key parts
+            func [function]: stage function
+        Return:
+            (key, result)
+        """
+        key = self.key(stage, inspect.getsource(func), parts)
+        found, result = self.get(key)
+        if not found:
+            result = self.put(key, stage, func(*args, **kwargs))
+        return key, result
+
+    def missing(self, keys):
+        """
+        missing keys without a stored result
+        """
+        return [
+            key for key in keys
+            if key not in self.index["stages"] or not (self.cache_dir/f"{key}.pkl").exists()
+            ]
+
+    def map(self, stage, keys, func, tasks, jobs=1):
+        """
+        map return the stored results of func(*task) and run the missing tasks
+        (in a process pool if jobs > 1, see run_tasks)
+        Args:
+            stage [str]: stage name
+            keys [lst]: key of each task
+            func [function]: module level stage function
+            tasks [lst]: list of argument tuples
+            jobs [int]: number of worker processes
+        Return:
+            list of results in the order of tasks
+        """
+        results = [self.get(key) for key in keys]
+        todo = [i for i, (found, _) in enumerate(results) if not found]
+        outputs = run_tasks(func, [tasks[i] for i in todo], jobs)
+        for i, output in zip(todo, outputs):
+            results[i] = (True, self.put(keys[i], stage, output))
+        return [result for _, result in results]
+
+    def _evict(self):
+        stages = self.index["stages"]
+        total = sum(entry["size"] for entry in stages.values())
+        for key in sorted(stages, key=lambda key: stages[key]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            total -= stages[key]["size"]
+            (self.cache_dir/f"{key}.pkl").unlink(missing_ok=True)
+            del stages[key]
+
+    def _save_index(self):
+        path_tmp = self.index_path.with_suffix(".tmp")
+        with open(path_tmp, "w") as f:
+            json.dump(self.index, f)
+        os.replace(path_tmp, self.index_path)
+
+
+class NoCache(StageCache):
+    """
+    NoCache run every stage (same interface as StageCache)
+    """
+
+    def __init__(self):
+        self.code = []
+        self.hits = 0
+        self.misses = 0
+
+    def file_key(self, path):
+        return str(path)
+
+    def get(self, key):
+        self.misses += 1
+        return False, None
+
+    def put(self, key, stage, result):
+        return result
+
+    def missing(self, keys):
+        return list(keys)
+
+
+class FitStore:
+    """
+    FitStore persistent store of fitted models (SQLite database)
+        - one row per fit: key (hash of the data snapshot and the
+          specification), stage, label and the pickled results
+        - fits are never evicted, a changed specification has a new key
+        - every call opens its own connection: worker processes store
+          their fits as soon as they finish, so they survive a failed run
+    Args:
+        path [Path]: database file
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(self._connect()) as con, con:
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS fits "
+                "(key TEXT PRIMARY KEY, stage TEXT, label TEXT, created REAL, result BLOB)"
+                )
+
+    @staticmethod
+    def key(stage, func, *parts):
+        """
+        key hash of a stage name, the source code of the fit function and
+        its key parts (json serializable)
+        """
+        text = json.dumps([stage, inspect.getsource(func), parts], sort_keys=True, default=str)
+        return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+    def stored(self, keys):
+        """
+        stored keys with a stored fit
+        """
+        with closing(self._connect()) as con:
+            found = {key for key, in con.execute("SELECT key FROM fits")}
+        return [key for key in keys if key in found]
+
+    def get(self, key):
+        """
+        get load a stored fit
+        Return:
+            (True, result) if stored, (False, None) otherwise
+        """
+        with closing(self._connect()) as con:
+            row = con.execute("SELECT result FROM fits WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return False, None
+        return True, pickle.loads(row[0])
+
+    def put(self, key, stage, label, result):
+        """
+        put store a fit (replace the fit of the same key)
+        """
+        blob = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+        with closing(self._connect()) as con, con:
+            con.execute(
+                "INSERT OR REPLACE INTO fits VALUES (?, ?, ?, ?, ?)",
+                (key, stage, label, time.time(), blob),
+                )
+        return result
+
+    def _connect(self):
+        # wait for the writes of other processes
+        return sqlite3.connect(self.path, timeout=60)
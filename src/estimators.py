@@ -0,0 +1,404 @@
+"""
+This script estimate the (weighted) 2SLS models of several outcomes at once
+"""
+
+import hashlib
+import warnings
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+
+class IVResults:
+    """
+    IVResults estimates of one outcome (same attributes as linearmodels results
+    used by CoefTable: params, std_errors, tstats, pvalues, nobs, conf_int)
+    Args:
+        params [Series]: coefficients
+        std_errors [Series]: heteroskedasticity or cluster robust standard errors
+        nobs [int]: number of observations
+    """
+
+    def __init__(self, params, std_errors, nobs):
+        self.params = params
+        self.std_errors = std_errors
+        self.tstats = params / std_errors
+        # normal distribution functions of scipy.special (scipy.stats is slow to import)
+        from scipy import special
+        self.pvalues = pd.Series(2 * special.ndtr(-np.abs(self.tstats)), index=params.index)
+        self.nobs = nobs
+
+    def conf_int(self, level=0.95):
+        """
+        conf_int confidence interval (normal distribution)
+        """
+        from scipy import special
+        q = special.ndtri((1 + level) / 2)
+        return pd.DataFrame(
+            {"lower": self.params - q * self.std_errors, "upper": self.params + q * self.std_errors}
+            )
+
+    def summary_frame(self):
+        """
+        summary_frame table of coefficients, standard errors, t-stats, p-values and C.I.
+        """
+        df = pd.DataFrame({
+            "Parameter": self.params, "Std. Err.": self.std_errors,
+            "T-stat": self.tstats, "P-value": self.pvalues,
+            })
+        ci = self.conf_int()
+        df["Lower CI"] = ci["lower"]
+        df["Upper CI"] = ci["upper"]
+        return df
+
+
+def fe_codes(df, fe_vars):
+    """
+    fe_codes integer group codes of the fixed effects
+    Args:
+        df [DataFrame]: data
+        fe_vars [lst]: fixed effect variables, a list of variables gives an
+            interacted fixed effect (eg: ["sector", ["sector_2", "year"]])
+    Return:
+        list of integer arrays
+    """
+    codes = []
+    for var in fe_vars:
+        var = [var] if isinstance(var, str) else list(var)
+        codes.append(df.groupby(var, sort=False, observed=True).ngroup().to_numpy())
+    return codes
+
+
+def absorb(v, codes, weights=None, tol=1e-12, max_iter=10_000):
+    """
+    absorb remove the fixed effects by (weighted) alternating projections
+        - subtract the group means of each fixed effect in turn until the
+          data no longer change (within transformation)
+    Args:
+        v [array]: data (nobs by k)
+        codes [lst]: integer group codes of each fixed effect (see fe_codes)
+        weights [array]: observation weights
+        tol [float]: convergence tolerance (relative to the scale of v)
+        max_iter [int]: maximum number of sweeps (warns if the data still change)
+    Return:
+        residualized data
+    """
+    from scipy import sparse
+
+    v = np.array(v, dtype=np.float64, ndmin=2).reshape(len(v), -1)
+    nobs = v.shape[0]
+    w = np.ones(nobs) if weights is None else np.asarray(weights, dtype=np.float64)
+    groups = []
+    for code in codes:
+        dummies = sparse.csr_matrix((w, (np.arange(nobs), code)))
+        groups.append((dummies, np.asarray(dummies.sum(axis=0)).ravel(), code))
+
+    scale = np.maximum(np.abs(v).max(axis=0), 1.0)
+    change = np.inf
+    for _ in range(max_iter):
+        change = 0.0
+        for dummies, total, code in groups:
+            means = (dummies.T @ v) / total[:, None]
+            v = v - means[code]
+            change = max(change, np.max(np.abs(means[code]) / scale))
+        if change < tol or len(groups) == 1:
+            break
+    else:
+        warnings.warn(
+            f"absorb: no convergence after {max_iter} sweeps (last change {change:.3g}, tolerance {tol:.3g})",
+            RuntimeWarning,
+            )
+
+    return v
+
+
+class IVDesign:
+    """
+    IVDesign transformed regressors and projections of a (weighted) 2SLS model
+        - fixed effects are absorbed (within transformation) instead of dummies
+        - exogenous regressors absorbed by the fixed effects are dropped
+        - data are multiplied by the square root of the weights (normalized to mean one)
+        - the first stage projection and the second stage matrix are computed
+          once, each outcome only adds its transformed y-vector
+        (without endogenous regressors and instruments the model is weighted OLS)
+    Args:
+        exog [DataFrame]: exogenous regressors (a constant is added without fixed effects)
+        endog [DataFrame]: endogenous regressors
+        instr [DataFrame]: excluded instruments
+        weights [Series]: observation weights
+        fe [lst]: integer group codes of the absorbed fixed effects (see fe_codes)
+    """
+
+    def __init__(self, exog, endog, instr, weights=None, fe=None):
+        # intercept of the models without fixed effects (absorbed by the fixed effects otherwise)
+        if not fe and "const" not in exog.columns:
+            exog = pd.concat([pd.Series(1.0, index=exog.index, name="const"), exog], axis=1)
+
+        x = np.column_stack([exog.to_numpy(np.float64), endog.to_numpy(np.float64)])
+        z_instr = instr.to_numpy(np.float64).reshape(len(exog), -1)
+        names = list(exog.columns) + list(endog.columns)
+        k_exog, k_x = exog.shape[1], x.shape[1]
+        self.fe = fe
+        self.weights = None if weights is None else np.asarray(weights, dtype=np.float64)
+
+        # within transformation (partial out the fixed effects)
+        if fe:
+            data = np.column_stack([x, z_instr])
+            data_fe = absorb(data, fe, self.weights)
+
+            # drop the exogenous regressors absorbed by the fixed effects
+            absorbed = np.linalg.norm(data_fe, axis=0) <= 1e-8 * np.maximum(np.linalg.norm(data, axis=0), 1.0)
+            if absorbed[k_exog:].any():
+                raise ValueError("IVDesign: endogenous regressors or instruments are absorbed by the fixed effects")
+            keep = np.flatnonzero(~absorbed[:k_exog])
+            names = [names[i] for i in keep] + list(endog.columns)
+
+            x = data_fe[:, list(keep) + list(range(k_exog, k_x))]
+            z_instr = data_fe[:, k_x:]
+            k_exog = len(keep)
+
+        # weighted data (weights normalized to mean one)
+        self.w_sqrt = None
+        if self.weights is not None:
+            self.w_sqrt = np.sqrt(self.weights / np.mean(self.weights))[:, None]
+            x, z_instr = x * self.w_sqrt, z_instr * self.w_sqrt
+
+        self.x = x
+        self.z = np.column_stack([x[:, :k_exog], z_instr])
+        self.names = names
+        self.endog = list(endog.columns)
+        self.nobs = x.shape[0]
+
+        # first stage (projection of x on z)
+        q, _ = np.linalg.qr(self.z)
+        self.xhat = q @ (q.T @ x)
+
+        # second stage matrix: params = xa' y
+        self.xpx_inv = np.linalg.inv(self.xhat.T @ self.xhat)
+        self.xa = self.xhat @ self.xpx_inv
+
+    @property
+    def nbytes(self):
+        """
+        nbytes memory used by the arrays of the design
+        """
+        arrays = [self.x, self.z, self.xhat, self.xa, self.weights, self.w_sqrt] + list(self.fe or [])
+        return sum(array.nbytes for array in arrays if array is not None)
+
+    def transform(self, y):
+        """
+        transform outcomes with the transformation of the design
+        """
+        yy = np.array(y, dtype=np.float64, ndmin=2).reshape(self.nobs, -1)
+        if self.fe:
+            yy = absorb(yy, self.fe, self.weights)
+        if self.w_sqrt is not None:
+            yy = yy * self.w_sqrt
+        return yy
+
+    def fit(self, y, report=None, clusters=None):
+        """
+        fit estimates of several outcomes with heteroskedasticity robust (HC0)
+        or cluster robust standard errors
+        Args:
+            y [DataFrame]: outcomes (one column each)
+            report [lst]: regressors to report (all if None)
+            clusters [array]: cluster of each observation (HC0 if None), the
+                variance is scaled by G / (G - 1) as in wild_cluster_bootstrap
+        Return:
+            dictionary of {outcome: IVResults}
+        """
+        yy = self.transform(y)
+
+        # second stage for all outcomes
+        params = self.xa.T @ yy
+        eps = yy - self.x @ params
+
+        report = self.names if report is None else [var for var in report if var in self.names]
+        index = [self.names.index(var) for var in report]
+
+        if clusters is None:
+            # robust variance of every coefficient and outcome: sum_i (xhat_i A)^2 e_i^2
+            variance = (self.xa ** 2).T @ (eps ** 2)
+        else:
+            # cluster robust variance: sum_g (sum_i in g xhat_i A e_i)^2
+            from scipy import sparse
+            cluster_code, cluster_names = pd.factorize(np.asarray(clusters), sort=True)
+            n_clusters = len(cluster_names)
+            dummies = sparse.csr_matrix(
+                (np.ones(len(cluster_code)), (np.arange(len(cluster_code)), cluster_code)),
+                shape=(len(cluster_code), n_clusters),
+                )
+            variance = np.zeros(params.shape)
+            for k in index:
+                scores = dummies.T @ (self.xa[:, [k]] * eps)
+                variance[k] = (scores ** 2).sum(axis=0) * n_clusters / (n_clusters - 1)
+
+        results = {}
+        for j, depend_var in enumerate(y.columns):
+            results[depend_var] = IVResults(
+                pd.Series(params[index, j], index=report, name="parameter"),
+                pd.Series(np.sqrt(variance[index, j]), index=report, name="std_error"),
+                self.nobs,
+                )
+
+        return results
+
+
+def iv_2sls(y, exog, endog, instr, weights=None, fe=None, report=None):
+    """
+    iv_2sls weighted 2SLS of several outcomes on the same regressors
+        - fixed effects are absorbed (within transformation) instead of dummies
+        - the first stage is solved once for all outcomes
+        - the second stage is one multi-column least squares problem
+        - heteroskedasticity robust (HC0) standard errors, as linearmodels
+          IV2SLS(...).fit(cov_type="heteroskedastic") with dummies
+    Args:
+        y [DataFrame]: outcomes (one column each)
+        exog [DataFrame]: exogenous regressors (a constant is added without fixed effects)
+        endog [DataFrame]: endogenous regressors
+        instr [DataFrame]: excluded instruments
+        weights [Series]: observation weights
+        fe [lst]: integer group codes of the absorbed fixed effects (see fe_codes)
+        report [lst]: regressors to report (all if None)
+    Return:
+        dictionary of {outcome: IVResults}
+    """
+    return IVDesign(exog, endog, instr, weights, fe).fit(y, report)
+
+
+class DesignCache:
+    """
+    DesignCache designs of the models shared by the fits of several outcomes
+        - keyed by (panel, sample restriction, regressor set, fixed effects)
+          and the estimation sample (rows without missing values)
+        - the sample of each outcome is computed once, outcomes with the same
+          sample share the filtered and transformed X and Z
+        - least recently used designs (with the samples of their outcomes)
+          and samples are evicted once the designs and samples use more
+          than max_bytes
+    Args:
+        max_bytes [int]: memory limit of the stored designs and samples
+    """
+
+    def __init__(self, max_bytes=2**30):
+        self.max_bytes = max_bytes
+        self.designs = OrderedDict()
+        self.masks = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def spec(panel, exog, endog=(), instr=(), weights=None, fe_vars=(), sample=None, sample_vars=()):
+        """
+        spec key of a model specification
+        Args:
+            panel [str]: name of the panel
+            exog [lst]: exogenous regressors
+            endog [lst]: endogenous regressors
+            instr [lst]: excluded instruments
+            weights [str]: weight variable
+            fe_vars [lst]: fixed effects (see fe_codes)
+            sample [str]: description of the sample restriction
+            sample_vars [lst]: other variables without missing values in the sample
+        Return:
+            tuple
+        """
+        fe_vars = tuple(fe_var if isinstance(fe_var, str) else tuple(fe_var) for fe_var in fe_vars)
+        return (
+            str(panel), str(sample), tuple(exog), tuple(endog), tuple(instr),
+            weights, fe_vars, tuple(sample_vars),
+            )
+
+    def mask(self, df, spec, depend_var):
+        """
+        mask estimation sample of an outcome (rows without missing values)
+        Args:
+            df [DataFrame]: panel after the sample restriction
+            spec [tuple]: specification (see spec)
+            depend_var [str]: outcome
+        Return:
+            boolean array
+        """
+        mask, _ = self._sample(df, spec, depend_var)
+        self._evict()
+        return mask
+
+    def _sample(self, df, spec, depend_var):
+        # stored mask of the estimation sample and its hash (key of the design)
+        key = (spec, depend_var)
+        if key in self.masks:
+            self.masks.move_to_end(key)
+            return self.masks[key]
+
+        _, _, exog, endog, instr, weights, fe_vars, sample_vars = spec
+        var_lst = list(exog) + list(endog) + list(instr) + [depend_var] + list(sample_vars)
+        var_lst += [weights] if weights else []
+        var_lst += [var for fe_var in fe_vars for var in ([fe_var] if isinstance(fe_var, str) else fe_var)]
+        mask = df[list(dict.fromkeys(var_lst))].notna().all(axis=1).to_numpy()
+        self.masks[key] = (mask, hashlib.blake2b(np.packbits(mask).tobytes(), digest_size=16).hexdigest())
+        return self.masks[key]
+
+    def design(self, df, spec, depend_var):
+        """
+        design stored design of an outcome, or build and store it
+        Args:
+            df [DataFrame]: panel after the sample restriction
+            spec [tuple]: specification (see spec)
+            depend_var [str]: outcome
+        Return:
+            IVDesign and the rows of the estimation sample
+        """
+        mask, digest = self._sample(df, spec, depend_var)
+        key = (spec, digest)
+
+        if key in self.designs:
+            self.hits += 1
+            self.designs.move_to_end(key)
+            design = self.designs[key]
+            self._evict()
+            return design, mask
+
+        self.misses += 1
+        _, _, exog, endog, instr, weights, fe_vars, _ = spec
+        data = df.loc[mask, :]
+        design = IVDesign(
+            data[list(exog)], data[list(endog)], data[list(instr)],
+            weights=None if weights is None else data[weights],
+            fe=fe_codes(data, fe_vars) if fe_vars else None,
+            )
+        self.designs[key] = design
+        self._evict()
+
+        return design, mask
+
+    @property
+    def nbytes(self):
+        """
+        nbytes memory used by the stored designs and samples
+        """
+        return (
+            sum(design.nbytes for design in self.designs.values())
+            + sum(mask.nbytes for mask, _ in self.masks.values())
+            )
+
+    def _evict(self):
+        # least recently used designs and the samples of their outcomes first,
+        # then the other samples (the newest design and sample are kept)
+        total = self.nbytes
+        while total > self.max_bytes and len(self.designs) > 1:
+            (spec, digest), evicted = self.designs.popitem(last=False)
+            total -= evicted.nbytes
+            for key in [key for key, (_, mask_digest) in self.masks.items() if key[0] == spec and mask_digest == digest]:
+                total -= self.masks.pop(key)[0].nbytes
+        while total > self.max_bytes and len(self.masks) > 1:
+            _, (mask, _) = self.masks.popitem(last=False)
+            total -= mask.nbytes
+
+    def clear(self):
+        """
+        clear remove the stored designs and samples
+        """
+        self.designs.clear()
+        self.masks.clear()
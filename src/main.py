@@ -0,0 +1,85 @@
+"""
+This script run the stages of the project in one process (make_data, model and sweep)
+"""
+
+import importlib
+import time
+
+import click
+
+# module of each stage (imported only when the stage runs)
+STAGES = {
+    "make_data": "Src.make_data",
+    "model": "Src.model",
+    "sweep": "Src.sweep",
+}
+
+
+def import_stage(stage):
+    """
+    import_stage import the module of a stage and time the import
+    Args:
+        stage [str]: stage name (see STAGES)
+    Returns:
+        module, seconds
+    """
+    start = time.perf_counter()
+    module = importlib.import_module(STAGES[stage])
+    return module, time.perf_counter() - start
+
+
+def run_stage(stage, module, config_file, jobs=1, profile=False):
+    """
+    run_stage run a stage in this process (instead of a new interpreter)
+    Args:
+        stage [str]: stage name (see STAGES)
+        module [module]: module of the stage
+        config_file [str]: path to config file
+        jobs [int]: number of worker processes
+        profile [bool]: add a cProfile dump to the run report
+    Returns:
+        None
+    """
+    if stage == "make_data":
+        module.data_output(config_file, jobs, True, profile)
+    elif stage == "model":
+        module.model_output.callback(config_file, jobs, profile, False)
+    else:
+        module.sweep_output.callback(config_file, jobs, False, profile)
+    return None
+
+
+@click.command()
+@click.argument("config_file", type=str, default="src/config.yaml")
+@click.option(
+    "--stage", "stages", type=click.Choice(list(STAGES)), multiple=True,
+    help="stage to run, can be repeated (default: make_data only)",
+    )
+@click.option("--jobs", type=int, default=1, help="number of worker processes of the stages")
+@click.option("--profile", is_flag=True, help="add a cProfile dump to the run reports")
+def main(config_file, stages, jobs, profile):
+    """
+    main function run the stages of the replication in this process
+        - only make_data runs unless stages are given (model and sweep with --stage)
+        - heavy dependencies (scipy, pyarrow, linearmodels, matplotlib, duckdb) are
+          imported by the functions that use them, the import time of each stage is reported
+    Args:
+        config_file [str]: path to config file
+        stages [tuple]: stages to run
+        jobs [int]: number of worker processes of the stages
+        profile [bool]: add a cProfile dump to the run reports
+    Returns:
+        None
+    """
+    stages = stages or ("make_data",)
+    for i, stage in enumerate(stages, start=1):
+        print(f"{i}. running {stage}")
+        module, seconds = import_stage(stage)
+        print(f"imported {STAGES[stage]} in {seconds:.2f}s")
+        start = time.perf_counter()
+        run_stage(stage, module, config_file, jobs, profile)
+        print(f"{stage} finished in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
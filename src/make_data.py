@@ -3,6 +3,8 @@ This script load and clean the raw data to prepare for regression that study
 the regulation at the time of entering on firm exit rates
 """
 
+import inspect
+import tempfile
 import warnings
 
 from pathlib import Path
@@ -11,12 +13,34 @@ import pandas as pd
 import numpy as np
 
 from Src.utility import parse_config
-from Src.utility import lag_variable
+from Src.utility import set_logger
+from Src.utility import lag_variables
+from Src.utility import lag_lookup
+from Src.utility import share_frames
+from Src.utility import load_shared
+from Src.storage import write_panel
+from Src.storage import read_raw
+from Src.storage import BDS_COUNTS
+from Src.cache import StageCache
+from Src.cache import NoCache
+from Src.cache import module_files
+from Src.profiling import profiled
+from Src.profiling import RunReport
+from Src.bartik import bartik_instrument
+from Src.bartik import BARTIK_UNIT
+from Src.mappings import age_buckets
+from Src.mappings import size_dummy
+from Src.mappings import naics_code
+from Src.mappings import naics_prefix
+from Src.mappings import naics_recode
+from Src.queries import panels_duckdb
+from Src.queries import regdata_duckdb
 
 # options of pandas
 pd.options.mode.use_inf_as_na = True
 
 
+@profiled
 def data_load(config):
     """
     data_load function that
@@ -39,7 +63,6 @@ def data_load(config):
     data_file_path = Path(config["make_data"]["data_file_path"])
     regdata_path = Path(config["make_data"]["regdata_origin_path"])
     bds_naics_4_path = Path(config["make_data"]["bds_naics_4_path"])
-    gdp_path = Path(config["make_data"]["gdp_path"])
     bds_sector_size_path = Path(config["make_data"]["bds_sector_size"])
 
     ####################
@@ -47,27 +70,46 @@ def data_load(config):
     ####################
     
     # reg data
-    regdata = pd.read_csv(data_file_path/regdata_path)
+    regdata = read_raw(data_file_path/regdata_path, "regdata_origin")
     regdata["sector_reg"] = regdata["NAICS"]
     regdata = regdata.loc[:, ["year", "sector_reg",
                               "industry_restrictions_1_0", "industry_restrictions_2_0"]]
 
     # sector gdp data
-    gdp = pd.read_csv(data_file_path/gdp_path)
-    gdp = pd.melt(gdp, id_vars="sector_2", var_name="year", value_name="gdp")
-    gdp["year"] = pd.to_numeric(gdp["year"]).astype(np.int64)
+    gdp = data_gdp(config)
 
     # load BDS dataset by age sector
-    df_sec_ag = pd.read_csv(data_file_path/bds_naics_4_path)
+    df_sec_ag = read_raw(data_file_path/bds_naics_4_path, "bds_naics_4")
     df_sec_ag = df_sec_ag.drop_duplicates(subset=['year', "sector", "fage"])
     
     # load BDS dataset by age sector size
-    df_sec_sz_ag = pd.read_csv(data_file_path/bds_sector_size_path)
+    df_sec_sz_ag = read_raw(data_file_path/bds_sector_size_path, "bds_sector_size")
     df_sec_sz_ag = df_sec_sz_ag.drop_duplicates(subset=['year', "sector", "fage", "fsize"])
     
     return df_sec_sz_ag, df_sec_ag, regdata, gdp
 
 
+def data_gdp(config):
+    """
+    data_gdp function that
+        - load BEA gdp by 2 digit sector (years in columns)
+        - reshape to sector and year rows
+    Args:
+        config [str]: config file
+    Returns:
+        GDP data
+    """
+    data_file_path = Path(config["make_data"]["data_file_path"])
+    gdp_path = Path(config["make_data"]["gdp_path"])
+    
+    gdp = read_raw(data_file_path/gdp_path, "gdp")
+    gdp = pd.melt(gdp, id_vars="sector_2", var_name="year", value_name="gdp")
+    gdp["year"] = pd.to_numeric(gdp["year"]).astype(np.int64)
+    
+    return gdp
+
+
+@profiled
 def data_regdata(config):
     """
     data_regdata function that
@@ -76,7 +118,7 @@ def data_regdata(config):
     Args:
         config [str]: config file
     Returns:
-        Reg data
+        Reg data, initial shares (ShareMatrix)
         
     """
     
@@ -90,223 +132,144 @@ def data_regdata(config):
     regdata_ind_path = Path(config["make_data"]["regdata_ind_path"])
     
     # doc words count
-    df_doc = pd.read_csv(data_file_path/regdata_doc_path)
-    # ind doc probability
-    df_ind = pd.read_csv(data_file_path/regdata_ind_path)
+    df_doc = read_raw(data_file_path/regdata_doc_path, "regdata_doc")
+    # ind doc probability (read in chunks if regdata_chunksize is set)
+    chunksize = config["make_data"]["regdata_chunksize"]
+    if chunksize:
+        df_ind = read_raw(data_file_path/regdata_ind_path, "regdata_ind", engine="c", chunksize=chunksize)
+    else:
+        df_ind = read_raw(data_file_path/regdata_ind_path, "regdata_ind")
     
     ####################
     # Create merged dataset
     ####################
-    mode = 1
-    if mode == 1:
-        # clean variables
-        df_doc = df_doc.drop_duplicates("document_id")
-        df_doc["year"] = pd.to_numeric(df_doc.date.str.slice(0,4))
-
-        # create current measure
-        doc_var = [
-            "year",
-            "document_id",
-            "agency",
-            "document_reference",
-            "restrictions_2_0",
-            ]
-
-        df_merge_part = df_ind.merge(
-            df_doc[doc_var], 
-            how='inner', 
-            on=["document_id"], 
-            validate="many_to_one",
-            )
-
-        df_merge_part["reg_s_d"] = df_merge_part["probability"] * df_merge_part["restrictions_2_0"]
-        df_merge = df_merge_part.groupby(["year", "industry", "agency"])[["reg_s_d", "restrictions_2_0"]].sum()
-        df_merge = df_merge.reset_index()
-
-
-        # initial shares
-        df_merge["reg_s"] = df_merge.groupby(["industry", "year"])["reg_s_d"].transform(lambda x: x.sum())
-        df_merge["reg_d"] = df_merge.groupby(["agency", "year"])["reg_s_d"].transform(lambda x: x.sum())
-        df_merge["share"] = np.where(df_merge["reg_s_d"]>0, df_merge["reg_s_d"] / df_merge["reg_s"], 0)
-
-        # replace non record with zero
-        for var in ["reg_s_d", "reg_s", "share"]:
-            df_merge[var] = np.where(df_merge[var].isna(), 0, df_merge[var])
-            
-        # create initial shares
-        baseline_year = 1986
-        df_init = df_merge.loc[
-            df_merge.year == baseline_year, 
-            ["industry", "agency", "share"]
-            ]
-        df_init = df_init.rename(columns = {"share": "share_init"})
-        
-        df_share = pd.pivot_table(df_init, values="share_init", index=["industry"], columns=["agency"])
-        
-        # merge with main dataset
-        init_var = ["industry", "agency", "share_init"]
-        df_merge = df_merge.merge(df_init[init_var], how='left', on=["industry", "agency"], validate="many_to_one")
-        
-                
-        # average initial log restriction (leave one out)
-        df_merge["log_reg_s_d"] = np.where(df_merge["reg_s_d"] > 0, np.log(df_merge["reg_s_d"]), 0)
-        df_merge["log_reg_d_one_out"] = np.where(
-            df_merge["restrictions_2_0"]  > 0,
-            np.log(df_merge["restrictions_2_0"] - df_merge["reg_s_d"]) ,
-            0
-            )
-
-        df_merge["bartik_iv"] = (df_merge["log_reg_d_one_out"]) * df_merge["share_init"]
-        df_merge["industry_restrictions_2_0"] = df_merge["reg_s_d"]
-                
-    else:
-        # clean variables
-        df_doc = df_doc.drop_duplicates("document_id")
-        df_doc["year"] = pd.to_numeric(df_doc.date.str.slice(0,4))
-
-        # create current measure
-        doc_var = [
-            "year",
-            "document_id",
-            "agency",
-            "document_reference",
-            "restrictions_2_0",
-            ]
-        
-        df_merge = df_ind.merge(
-            df_doc[doc_var], 
-            how='inner', 
-            on=["document_id"], 
-            validate="many_to_one",                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                
-            )
-        
-        
+    mode = config["make_data"]["bartik_mode"]
+    baseline_years = config["make_data"]["bartik_baseline_years"]
+    unit = BARTIK_UNIT[mode]
+    
+    # clean variables
+    df_doc = df_doc.drop_duplicates("document_id")
+    df_doc["year"] = pd.to_numeric(df_doc.date.str.slice(0,4))
+
+    # create current measure
+    doc_var = [
+        "year",
+        "document_id",
+        "agency",
+        "document_reference",
+        "restrictions_2_0",
+        ]
 
-        # create initial shares
-        baseline_year = 1986
-        df_init = df_merge.loc[
-            df_merge.year == baseline_year,
-            ["industry", "probability", "document_reference", "restrictions_2_0"]
-            ]
-        df_init = df_init.rename(columns = {"probability": "probability_init"})
-        
-        # initial shares
-        df_init["reg_s_part_init"] = df_init["probability_init"] * df_init["restrictions_2_0"]
-        
-        
-        df_init["reg_s_init"] = df_init.groupby(["industry"])["reg_s_d_init"].transform(lambda x: x.sum())
-        df_init["share_init"] = np.where(df_init["reg_s_d_init"]>0, df_init["reg_s_d_init"] / df_init["reg_s_init"], 0) 
-        
-        # merge with main dataset
-        init_var = ["industry", "document_reference", "reg_s_d_init", "reg_s_init", "share_init"]
-        df_merge = df_merge.merge(df_init[init_var], how='left', on=["industry", "document_reference"], validate="many_to_one")
-        
-        # replace non record with zero
-        for var in ["reg_s_d_init", "reg_s_init", "share_init"]:
-            df_merge[var] = np.where(df_merge[var].isna(), 0, df_merge[var])
-        
-        # create current share
-        df_merge["reg_s_d"] = df_merge["probability"] * df_merge["restrictions_2_0"]
-        df_merge["reg_s"] = df_merge.groupby(["industry", "year"])["reg_s_d"].transform(lambda x: x.sum())
-        df_merge["share"] = np.where(df_merge["reg_s_d"] > 0, df_merge["reg_s_d"] / df_merge["reg_s"], 0)
-        
-        # average initial log restriction (leave one out)
-        df_merge["log_reg_s_d"] = np.where(df_merge["reg_s_d"] > 0, np.log(df_merge["reg_s_d"]), 0)
-        df_merge["log_reg_d_one_out"] = np.where(
-            df_merge["restrictions_2_0"]  > 0,
-            np.log(df_merge["restrictions_2_0"]),
-            0
-            )
-        
-        #df_merge["sum_log_reg_s_d"] = df_merge.groupby(["document_reference", "year"])["log_reg_s_d"].transform(lambda x: x.sum())
-        #df_merge["n_doc"] = df_merge.groupby(["document_reference", "year"])["log_reg_s_d"].transform(lambda x: x.size)
-        #df_merge["sum_reg_s_d"] = df_merge.groupby(["document_reference", "year"])["reg_s_d"].transform(lambda x: x.sum())
-        #df_merge["log_reg_d_one_out"] = np.where(
-        #    df_merge["sum_reg_s_d"] - df_merge["reg_s_d"]> 0,
-        #    np.log(df_merge["sum_reg_s_d"] - df_merge["reg_s_d"]),
-        #    np.nan
-        #   )
-        
-        # prepare to aggregate (sum)
-        #df_merge["bartik_iv"] = df_merge["avg_log_reg_s_d"] * df_merge["share_init"]
-        df_merge["bartik_iv"] = (df_merge["log_reg_d_one_out"]) * df_merge["share_init"]
-        df_merge["industry_restrictions_2_0"] = df_merge["reg_s_d"]
+    df_merge = data_regdata_sums(df_doc[doc_var], df_ind, unit=unit)
+    
+    # create shift share instrument (aggregated by year and industry)
+    regdata, df_share = bartik_instrument(df_merge, baseline_years, mode)
         
-    # aggregate data and finalize
-    regdata = df_merge.groupby(by=["year", "industry"])[["industry_restrictions_2_0", "bartik_iv"]].sum()
-    regdata = regdata.reset_index()
+    # finalize
     regdata = regdata.rename(columns={"industry":"sector_reg"})
     
     return regdata, df_share
 
     
-def data_clean(df, id_var, sector_dig, config):
+@profiled
+def data_regdata_sums(df_doc, df_ind, unit="agency", max_rows=10_000_000):
     """
-    data_clean function that
+    data_regdata_sums function that
+        - join the industry probabilities with the documents (by document_id)
+        - sum reg_s_d (probability * restrictions_2_0) and restrictions_2_0
+          by year, industry and regulation unit
+        - with a chunk iterator, only the partial sums are kept in memory
+    Args:
+        df_doc [DataFrame]: documents (document_id, year, unit, restrictions_2_0)
+        df_ind [DataFrame or iterator]: industry probabilities (document_id, industry, probability)
+        unit [str]: regulation unit (agency or document_reference)
+        max_rows [int]: number of partial sum rows kept before they are combined
+    Returns:
+        Sums by year, industry and unit
+    """
+    if isinstance(df_ind, pd.DataFrame):
+        df_ind = [df_ind]
+    
+    # document lookup (units as sorted integer codes)
+    doc_index = pd.Index(df_doc["document_id"])
+    if not doc_index.is_unique:
+        raise pd.errors.MergeError("data_regdata_sums: document_id is not unique in df_doc")
+    unit_code, unit_value = pd.factorize(df_doc[unit], sort=True)
+    doc_year = df_doc["year"].to_numpy()
+    doc_restrictions = df_doc["restrictions_2_0"].to_numpy()
+    
+    key_var = ["year", "industry", unit]
+    sum_var = ["reg_s_d", "restrictions_2_0"]
+    
+    def combine(parts):
+        df_parts = pd.concat(parts, ignore_index=True)
+        return df_parts.groupby(key_var, sort=False)[sum_var].sum().reset_index()
+    
+    parts = []
+    n_rows = 0
+    for chunk in df_ind:
+        # inner join on document_id (documents without unit are dropped as by groupby)
+        pos = doc_index.get_indexer(chunk["document_id"])
+        found = (pos >= 0)
+        found[found] = unit_code[pos[found]] >= 0
+        pos = pos[found]
+        
+        restrictions = doc_restrictions[pos]
+        df_chunk = pd.DataFrame({
+            "year": doc_year[pos],
+            "industry": chunk["industry"].to_numpy()[found],
+            unit: unit_code[pos],
+            "reg_s_d": chunk["probability"].to_numpy()[found] * restrictions,
+            "restrictions_2_0": restrictions,
+            })
+        parts.append(df_chunk.groupby(key_var, sort=False)[sum_var].sum().reset_index())
+        
+        # keep memory bounded by the number of groups
+        n_rows += len(parts[-1])
+        if n_rows > max_rows:
+            parts = [combine(parts)]
+            n_rows = len(parts[0])
+    
+    df_merge = combine(parts)
+    df_merge = df_merge.sort_values(key_var).reset_index(drop=True)
+    df_merge[unit] = unit_value.take(df_merge[unit].to_numpy())
+    
+    return df_merge
+
+
+@profiled
+def data_cube(df, id_var, sector_dig, config):
+    """
+    data_cube function that
         - make preliminary data type changes and data clean for main data file
+        - sum the additive counts at the finest level (year and id variables),
+          coarser levels are summed from this cube (see data_clean)
 
     Args:
         df [DataFrame]: input main data
-        id_var [list]: list of strings contains id variables (sector, year, fage, and fsize)
+        id_var [list]: list of strings contains id variables (sector, fage, and fsize)
         sector_dig [int]: sector digits
+        config [dict]: config (age and size buckets)
     Returns:
-        Cleaned data
+        Counts by year, sector, age_coarse and large_firm (of the id variables)
 
     """
     ####################
     # clean data
     ####################
     # create sector variables
-    df["sector"] = df["sector"].astype(str).str.slice(0, sector_dig)
-    df["sector"] = pd.to_numeric(df["sector"], errors="coerce", downcast=None)
-    
+    df["sector"] = naics_code(df["sector"], sector_dig)
     
-    # change variable types
-    dep_var = config["make_data"]["dep_var"]
-    
-    var_lst = dep_var + [
-        "firmdeath_firms", "year", "firms", "emp",
-        "estabs", "estabs_entry", "estabs_exit",
-        "job_creation", "job_destruction",
-        "net_job_creation", "denom"
-        ]
-
-    for var in var_lst:
-        df[var] = pd.to_numeric(df[var], errors="coerce", downcast=None)
+    # variable types are set when loading (see read_raw)
+    id_var = list(id_var)
 
     # if age variable included
     if "fage" in id_var:
         # aggregate by age group
         # coarse age group
-        conditions = [
-            df["fage"] == 'b) 1',
-            df["fage"] == 'c) 2',
-            df["fage"] == 'd) 3',
-            df["fage"] == 'e) 4',
-            df["fage"] == 'f) 5',
-            df["fage"] == 'g) 6 to 10',
-            df["fage"] == 'h) 11 to 15',
-            df["fage"] == 'i) 16 to 20',
-            df["fage"] == 'j) 21 to 25',
-            df["fage"] == 'k) 26+',
-            df["fage"] == 'l) Left Censored'
-        ]
-        
-        choices = [
-            "01",
-            "02",
-            "03",
-            "04",
-            "05",
-            "06-10",
-            "11+",
-            "11+",
-            "11+",
-            "11+",
-            "11+",
-        ]    
-        
-        df.loc[:, "age_coarse"] = np.select(conditions, choices, default="00")
+        df.loc[:, "age_coarse"] = age_buckets(
+            df["fage"], config["make_data"]["age_buckets"], config["make_data"]["age_default"]
+            )
         
         # variable selection for new dataset
         id_var.remove("fage") 
@@ -315,32 +278,41 @@ def data_clean(df, id_var, sector_dig, config):
     # if size variable included
     # create size dummy
     if "fsize" in id_var:
-        df.loc[:, "large_firm"] = 0
-        index = (
-            (df["fsize"] == "f) 500 to 999")
-            | (df["fsize"] == "g) 1000 to 2499")
-            | (df["fsize"] == "h) 2500 to 4999")
-            | (df["fsize"] == "i) 5000 to 9999")
-            | (df["fsize"] == "j) 10000+")
-        )
-        df.loc[index, "large_firm"] = 1
+        df.loc[:, "large_firm"] = size_dummy(df["fsize"], config["make_data"]["large_firm_sizes"])
         
         id_var.remove("fsize")
         id_var.append("large_firm")
     
     df = df.dropna(subset=["firms", "emp"])
-        
-    column_var = [
-        'firms', 'estabs', 'emp', 'denom', 
-        'estabs_entry', 'estabs_exit', 'job_creation', 
-        'job_creation_births', 'job_creation_continuers', 
-        'job_destruction', 'job_destruction_deaths', 
-        'job_destruction_continuers', 'job_destruction_rate_deaths', 
-        'net_job_creation', 'firmdeath_firms', 'firmdeath_estabs', 
-        'firmdeath_emp'
-        ]
     
-    df = df.groupby(["year"] + id_var)[column_var].sum()
+    df = df.groupby(["year"] + id_var)[BDS_COUNTS].sum()
+    df = df.reset_index()
+
+    return df
+
+
+@profiled
+def data_clean(df, id_var, config):
+    """
+    data_clean function that
+        - sum the counts of a cube (see data_cube) at the level of id_var
+        - create rates, sector variables and lags at this level
+
+    Args:
+        df [DataFrame]: counts by year and (finer) id variables
+        id_var [list]: list of strings contains id variables (sector, age_coarse, and large_firm)
+        config [dict]: config
+    Returns:
+        Cleaned data
+
+    """
+    ####################
+    # aggregate data
+    ####################
+    dep_var = config["make_data"]["dep_var"]
+
+    # the counts are additive, a coarser level is the sum of the finer cells
+    df = df.groupby(["year"] + id_var)[BDS_COUNTS].sum()
     df = df[df.firms > 0]
     df = df[df.emp > 0]
     df = df.reset_index()
@@ -364,32 +336,21 @@ def data_clean(df, id_var, sector_dig, config):
 
     # create sector at different digit
     for naics in range(2, 5):
-        if naics > 2 and "fsize" in id_var:
-            break
-        # clean and create variables
-        sector_name = f"sector_{naics}"
-        df[sector_name] = df["sector"].astype(str).str.slice(0,naics)
-        df[sector_name] = pd.to_numeric(df[sector_name], errors="coerce", downcast=None)
-
-    # recoding sectors at 2 digit level
-    df.loc[df.sector_2 == 32, "sector_2"] = 31
-    df.loc[df.sector_2 == 33, "sector_2"] = 31
-    df.loc[df.sector_2 == 45, "sector_2"] = 44
-    df.loc[df.sector_2 == 49, "sector_2"] = 48 
+        df[f"sector_{naics}"] = naics_prefix(df["sector"].to_numpy(), naics)
+
+    # recoding sectors at 2 digit level (31-33, 44-45 and 48-49)
+    df["sector_2"] = naics_recode(df["sector_2"].to_numpy())
         
     # lag var change variables
     dep_var = dep_var + ["death_rate", "log_avg_emp", "log_emp", "emp", "firms"]
     
-    for var in dep_var:
-        for lags in range(0, 3):
-            df = lag_variable(df, ["year"], id_var, [var], lags)
-  
-    for var in dep_var:
-        df[f"{var}_chg"] = df[var] - df[f"L_1_{var}"]
+    n_lags = config["make_data"]["n_lags"]
+    df = lag_variables(df, ["year"], id_var, dep_var, range(0, n_lags), change=True)
 
     return df
     
 
+@profiled
 def data_sector_entry(df, id_var):
     """
     data_sector_entry function that
@@ -413,14 +374,16 @@ def data_sector_entry(df, id_var):
     return df_age
 
 
-def data_final(df_input, id_var):
+@profiled
+def data_final(df_input, id_var, n_lags=3):
     """
     data_final function 
         - merges regulation, gdp, entry based on sector, age, or even size
         
     Args:
         df_input [tuple or list]: A sequence of dataframe
-        config [str]: config file
+        id_var [list]: list of strings contains id variables
+        n_lags [int]: number of lag years to merge
     Returns:
         Merged cohort data
     """
@@ -436,82 +399,52 @@ def data_final(df_input, id_var):
     #id_var = ["year", "sector", "age_coarse"]
     # define age groups
     df = df.sort_values(by= ["year"] + id_var)
+    df = df.reset_index(drop=True)
     
     ####################
     # Merge variables
     ####################
     
-    # rename the variables to merge (prevent from conflicts and harmonize data types)
-    regdata = regdata.rename(columns={"year": "year_reg"})
-    gdp = gdp.rename(columns={"year": "year_gdp"})
-    gdp["year_gdp"] = pd.to_numeric(gdp["year_gdp"]).astype(np.int64)
-    df_age_new = df_age.rename(columns={"year": "year_entry"})
+    # harmonize data types
+    gdp = gdp.copy()
+    gdp["year"] = pd.to_numeric(gdp["year"]).astype(np.int64)
+    
+    # look up all lag years at once (keyed on year and sector or id variables)
+    lags_lst = range(0, n_lags)
+    merge_var = [var for var in id_var if var != "age_coarse"]
     
+    regdata_lag = lag_lookup(df, regdata, "year", ["sector_2"], ["sector_reg"], lags_lst)
+    gdp_lag = lag_lookup(df, gdp, "year", ["sector_2"], ["sector_2"], lags_lst)
+    entry_lag = lag_lookup(df, df_age, "year", merge_var, merge_var, lags_lst)
     
     # merge by ages
-    for lags in range(0, 3):
+    new_cols = {}
+    for lags in lags_lst:
         # create lag year data
-        df.loc[:, f"L_{lags}_year"] = df.loc[:, "year"] - lags
+        new_cols[f"L_{lags}_year"] = df["year"].to_numpy() - lags
 
         ####################
         # Merge with cohort year variables
         ####################
-        # regulation
-        df = df.merge(
-            regdata,
-            how="left",
-            left_on=[f"L_{lags}_year", "sector_2"], 
-            right_on=["year_reg", "sector_reg"],
-            validate="many_to_one"
-            )
-        df = df.rename(
-            columns={
-                "industry_restrictions_2_0": f"L_{lags}_industry_restrictions_2_0",
-                "bartik_iv": f"L_{lags}_bartik_iv",
-                },
-            errors="raise"
-            )                        
-        df = df.drop(columns = {"sector_reg", "year_reg"})
-
-        # gdp
-        df = df.merge(
-            gdp,
-            how="left",
-            left_on=[f"L_{lags}_year", "sector_2"],
-            right_on=["year_gdp", "sector_2"], 
-            validate="many_to_one"
-            )
-        df = df.rename(columns={"gdp": f"L_{lags}_gdp"}, errors="raise")
-        df = df.drop(columns = {"year_gdp"})
-        
-        # merge the entry rate
-        merge_var = id_var
-        if "age_coarse" in merge_var:
-            merge_var.remove("age_coarse")
-            
-        df = df.merge(
-            df_age_new,
-            how = "left",
-            left_on=[f"L_{lags}_year"] + merge_var,
-            right_on=["year_entry"] + merge_var,
-            validate = "many_to_one"
-            )
-        df = df.rename(
-            columns={
-                "entry": f"L_{lags}_entry",
-                "incumbents": f"L_{lags}_incumbents"
-                }
-            )
-        df = df.drop(columns = {"year_entry"})
+        # regulation, gdp and the entry rate
+        for lagged in [regdata_lag, gdp_lag, entry_lag]:
+            new_cols.update(
+                {var: value for var, value in lagged.items() if var.startswith(f"L_{lags}_")}
+                )
     
         # create log variables
         with warnings.catch_warnings(): # suppress log zero warnings
             warnings.simplefilter("ignore")
-            df[f"L_{lags}_log_restriction_2_0"] = np.log(df[f"L_{lags}_industry_restrictions_2_0"])
-            df[f"L_{lags}_log_gdp"] = np.log(df[f"L_{lags}_gdp"])
-            df[f"L_{lags}_log_emp"] = np.log(df[f"L_{lags}_emp"])
-            df[f"L_{lags}_entry_rate"] = df[f"L_{lags}_entry"]/df[f"L_{lags}_incumbents"]
+            new_cols[f"L_{lags}_log_restriction_2_0"] = np.log(new_cols[f"L_{lags}_industry_restrictions_2_0"])
+            new_cols[f"L_{lags}_log_gdp"] = np.log(new_cols[f"L_{lags}_gdp"])
+            new_cols[f"L_{lags}_log_emp"] = np.log(df[f"L_{lags}_emp"].to_numpy())
+            new_cols[f"L_{lags}_entry_rate"] = new_cols[f"L_{lags}_entry"]/new_cols[f"L_{lags}_incumbents"]
     
+    # replace existing columns in place and append the new ones
+    df_new = pd.DataFrame(new_cols, index=df.index)
+    update_var = [var for var in df_new.columns if var in df.columns]
+    df[update_var] = df_new[update_var]
+    df = pd.concat([df, df_new.drop(columns=update_var)], axis=1)
     
     # final restrictions
     df = df[df.L_0_incumbents > 30]
@@ -522,7 +455,7 @@ def data_final(df_input, id_var):
     # create change variables        
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
-        for lags in range(0, 2):
+        for lags in range(0, n_lags - 1):
             lags_pre = lags + 1 
             df[f"L_{lags}_chg_log_restriction_2_0"] = (
                 df[f"L_{lags}_log_restriction_2_0"] - df[f"L_{lags_pre}_log_restriction_2_0"]
@@ -547,6 +480,7 @@ def data_final(df_input, id_var):
     return df
 
 
+@profiled
 def data_patterns(df_input):
     """
     data_patterns function 
@@ -585,11 +519,70 @@ def data_patterns(df_input):
 
 
 
-def data_output(config_file):
+def data_cube_task(df, id_var, sector_dig, config):
+    """
+    data_cube_task run data_cube on a (possibly shared) raw dataframe
+    Args:
+        df [DataFrame or Path]: raw data or file shared by share_frames
+        id_var, sector_dig, config: see data_cube
+    Returns:
+        Counts cube
+    """
+    return data_cube(load_shared(df), id_var, sector_dig, config)
+
+
+def data_clean_task(df, id_var, config):
+    """
+    data_clean_task run data_clean on a (possibly shared) counts cube
+    Args:
+        df [DataFrame or Path]: counts cube or file shared by share_frames
+        id_var, config: see data_clean
+    Returns:
+        Cleaned data
+    """
+    return data_clean(load_shared(df), id_var, config)
+
+
+def data_final_task(df, regdata, gdp, df_age, id_var, n_lags):
+    """
+    data_final_task run data_final on (possibly shared) dataframes
+    Args:
+        df, regdata, gdp, df_age [DataFrame or Path]: data or files shared by share_frames
+        id_var, n_lags: see data_final
+    Returns:
+        Merged cohort data
+    """
+    data_input = [load_shared(data) for data in (df, regdata, gdp, df_age)]
+    return data_final(data_input, id_var, n_lags)
+
+
+def stage_cache(config, use_cache=True):
+    """
+    stage_cache create the cache of the make_data stages
+    Args:
+        config [str]: config file
+        use_cache [bool]: if False, every stage runs
+    Returns:
+        StageCache (or NoCache)
+    """
+    cache_path = config["make_data"]["cache_path"]
+    if not use_cache or not cache_path:
+        return NoCache()
+    
+    max_bytes = int(config["make_data"]["cache_max_gb"] * 2**30)
+    # every Src module the stages can reach
+    code_files = module_files(Path(__file__))
+    return StageCache(Path.cwd()/cache_path, max_bytes, code_files)
+
+
+def data_output(config_file, jobs=1, use_cache=True, profile=False):
     """
     data_clean function clean and create the final dataset
     Args:
         config_file [str]: path to config file
+        jobs [int]: number of worker processes for the panel builds
+        use_cache [bool]: skip the stages whose inputs did not change
+        profile [bool]: add a cProfile dump to the run report
     Returns:
         Final data
     """
@@ -599,61 +592,158 @@ def data_output(config_file):
     ####################
     print("loading config files")
     config = parse_config(config_file)
-    df_sec_sz_ag_raw, df_sec_ag_raw, regdata, gdp = data_load(config)
-    regdata_iv, df_share = data_regdata(config)
-    
-    print("cleaning the data")
-    # clean data
-    df_sec = data_clean(df_sec_ag_raw, ["sector"], 4, config)
-    df_sec_ag = data_clean(df_sec_ag_raw, ["sector", "fage"], 4, config)
-    df_sec_sz = data_clean(df_sec_sz_ag_raw, ["sector", "fsize"], 2, config)
-    df_sec_sz_ag = data_clean(df_sec_sz_ag_raw, ["sector", "fsize", "fage"], 2, config)
-    
-    # create entry measures
-    df_age_4 = data_sector_entry(df_sec_ag, ["sector"])
-    df_age_sz_2 = data_sector_entry(df_sec_sz_ag, ["sector", "large_firm"])
-    
-    print("creating sector-level data")
-    data_input_sec = (df_sec, regdata_iv, gdp, df_age_4)
-    data_final_sec = data_final(data_input_sec, ["sector"])
-    
-    print("creating sector-size-level data")
-    data_input_sec_sz = (df_sec_sz, regdata_iv, gdp, df_age_sz_2)
-    data_final_sec_sz = data_final(data_input_sec_sz, ["sector","large_firm"])
-    
-    print("creating sector-age-level data")
-    data_input_sec_ag = (df_sec_ag, regdata_iv, gdp, df_age_4)
-    data_final_sec_ag = data_final(data_input_sec_ag, ["sector","age_coarse"])
+    report_path = Path.cwd()/config["make_data"]["report_path"]
+    logger = set_logger(report_path/"make_data.log")
+    
+    # time, peak memory and size of every stage (see RunReport)
+    with RunReport("make_data", report_path, profile, logger):
+        cache = stage_cache(config, use_cache)
+        n_lags = config["make_data"]["n_lags"]
+        dep_var = config["make_data"]["dep_var"]
+        buckets = [config["make_data"][var] for var in ["age_buckets", "age_default", "large_firm_sizes"]]
+    
+        # stages are keyed on the content of their input files
+        data_file_path = Path(config["make_data"]["data_file_path"])
+        load_files = [
+            cache.file_key(data_file_path/config["make_data"][path])
+            for path in ["regdata_origin_path", "gdp_path", "bds_naics_4_path", "bds_sector_size"]
+            ]
+        regdata_files = [
+            cache.file_key(data_file_path/config["make_data"][path])
+            for path in ["regdata_doc_path", "regdata_ind_path"]
+            ]
     
-    print("creating sector-age-size-level data")
-    data_input_sec_sz_ag = (df_sec_sz_ag, regdata_iv, gdp, df_age_sz_2)
-    data_final_sec_sz_ag = data_final(data_input_sec_sz_ag, ["sector", "large_firm", "age_coarse"])   
+        cleaned_data_path = Path(config["make_data"]["cleaned_data_path"])
+        suffix = "." + config["make_data"]["storage_format"]
     
+        bartik_config = [config["make_data"][var] for var in ["bartik_mode", "bartik_baseline_years"]]
+        regdata_func = regdata_duckdb if config["make_data"]["regdata_backend"] == "duckdb" else data_regdata
+        regdata_key, (regdata_iv, df_share) = cache.run(
+            "data_regdata", [regdata_files, bartik_config], regdata_func, config
+            )
+        
+        # out-of-core backend: the BDS files are only read by the queries
+        if config["make_data"]["backend"] == "duckdb":
+            print("creating the panels with duckdb")
+            rows = panels_duckdb(config, regdata_iv, data_gdp(config), cleaned_data_path)
+            df_share.save(Path.cwd()/cleaned_data_path/"df_share.npz")
+            print(", ".join(f"{panel}: {n} rows" for panel, n in rows.items()))
+            return
+        
+        load_key, (df_sec_sz_ag_raw, df_sec_ag_raw, regdata, gdp) = cache.run(
+            "data_load", load_files, data_load, config
+            )
     
-    print("creating aggregate pattern data")
-    # aggregate data
-    data_input_agg = (df_sec_ag, regdata_iv, gdp)
-    df_agg = data_patterns(data_input_agg)
+        with tempfile.TemporaryDirectory() as shared_dir:
+            # with workers, share the inputs of the missing stages through memory-mapped files
+            def share(frames, keys):
+                if jobs <= 1 or not cache.missing(keys):
+                    return frames
+                return share_frames(frames, shared_dir)
+        
+            print("cleaning the data")
+            # clean data and sum the counts at the finest level of each raw table
+            cube_id = [
+                ("df_sec_ag_raw", ["sector", "fage"], 4),
+                ("df_sec_sz_ag_raw", ["sector", "fsize", "fage"], 2),
+                ]
+            cube_keys = [
+                cache.key("data_cube", inspect.getsource(data_cube), load_key, raw, id_var, sector_dig, buckets)
+                for raw, id_var, sector_dig in cube_id
+                ]
+            raw = share({"df_sec_ag_raw": df_sec_ag_raw, "df_sec_sz_ag_raw": df_sec_sz_ag_raw}, cube_keys)
+            cube_ag, cube_sz_ag = cache.map(
+                "data_cube",
+                cube_keys,
+                data_cube_task,
+                [(raw[name], id_var, sector_dig, config) for name, id_var, sector_dig in cube_id],
+                jobs,
+                )
+            key_cube_ag, key_cube_sz_ag = cube_keys
+
+            # roll up the cubes to each panel level
+            clean_id = [
+                ("cube_ag", key_cube_ag, ["sector"]),
+                ("cube_ag", key_cube_ag, ["sector", "age_coarse"]),
+                ("cube_sz_ag", key_cube_sz_ag, ["sector", "large_firm"]),
+                ("cube_sz_ag", key_cube_sz_ag, ["sector", "age_coarse", "large_firm"]),
+                ]
+            clean_keys = [
+                cache.key("data_clean", inspect.getsource(data_clean), key_cube, id_var, dep_var, n_lags)
+                for _, key_cube, id_var in clean_id
+                ]
+            cube = share({"cube_ag": cube_ag, "cube_sz_ag": cube_sz_ag}, clean_keys)
+            df_sec, df_sec_ag, df_sec_sz, df_sec_sz_ag = cache.map(
+                "data_clean",
+                clean_keys,
+                data_clean_task,
+                [(cube[name], id_var, config) for name, _, id_var in clean_id],
+                jobs,
+                )
+            key_sec, key_sec_ag, key_sec_sz, key_sec_sz_ag = clean_keys
+        
+            # create entry measures
+            df_age_4 = data_sector_entry(df_sec_ag, ["sector"])
+            df_age_sz_2 = data_sector_entry(df_sec_sz_ag, ["sector", "large_firm"])
+        
+            print("creating sector, sector-size, sector-age and sector-age-size-level data")
+            final_id = [
+                ("df_sec", "df_age_4", ["sector"], key_sec, key_sec_ag),
+                ("df_sec_sz", "df_age_sz_2", ["sector", "large_firm"], key_sec_sz, key_sec_sz_ag),
+                ("df_sec_ag", "df_age_4", ["sector", "age_coarse"], key_sec_ag, key_sec_ag),
+                ("df_sec_sz_ag", "df_age_sz_2", ["sector", "large_firm", "age_coarse"], key_sec_sz_ag, key_sec_sz_ag),
+                ]
+            final_keys = [
+                cache.key(
+                    "data_final", inspect.getsource(data_final), inspect.getsource(data_sector_entry),
+                    load_key, regdata_key, key_clean, key_entry, id_var, n_lags,
+                    )
+                for _, _, id_var, key_clean, key_entry in final_id
+                ]
+            data = share({
+                "df_sec": df_sec, "df_sec_sz": df_sec_sz,
+                "df_sec_ag": df_sec_ag, "df_sec_sz_ag": df_sec_sz_ag,
+                "regdata_iv": regdata_iv, "gdp": gdp,
+                "df_age_4": df_age_4, "df_age_sz_2": df_age_sz_2,
+                }, final_keys)
+            data_final_sec, data_final_sec_sz, data_final_sec_ag, data_final_sec_sz_ag = cache.map(
+                "data_final",
+                final_keys,
+                data_final_task,
+                [
+                    (data[name], data["regdata_iv"], data["gdp"], data[name_entry], list(id_var), n_lags)
+                    for name, name_entry, id_var, _, _ in final_id
+                ],
+                jobs,
+                )
     
-    print("saving data file")
-    # store cleaned dataset
-    cleaned_data_path = Path(config["make_data"]["cleaned_data_path"])
+        print(f"stage cache: {cache.hits} hits, {cache.misses} misses")
+        print("creating aggregate pattern data")
+        # aggregate data
+        data_input_agg = (df_sec_ag, regdata_iv, gdp)
+        df_agg = data_patterns(data_input_agg)
     
-    df_share.to_csv(Path.cwd()/cleaned_data_path/"df_share.csv")
-    data_final_sec.to_csv(Path.cwd()/cleaned_data_path/"sector_panel.csv")
-    data_final_sec_sz.to_csv(Path.cwd()/cleaned_data_path/"sector_size_panel.csv")
-    data_final_sec_ag.to_csv(Path.cwd()/cleaned_data_path/"sector_age_panel.csv")
-    data_final_sec_sz_ag.to_csv(Path.cwd()/cleaned_data_path/"sector_age_size_panel.csv")
-    df_agg.to_csv(Path.cwd()/cleaned_data_path/"agg_pattern.csv")
+        print("saving data file")
+        # store cleaned dataset
     
+        df_share.save(Path.cwd()/cleaned_data_path/"df_share.npz")
+        write_panel(data_final_sec, Path.cwd()/cleaned_data_path/f"sector_panel{suffix}")
+        write_panel(data_final_sec_sz, Path.cwd()/cleaned_data_path/f"sector_size_panel{suffix}")
+        write_panel(data_final_sec_ag, Path.cwd()/cleaned_data_path/f"sector_age_panel{suffix}")
+        write_panel(data_final_sec_sz_ag, Path.cwd()/cleaned_data_path/f"sector_age_size_panel{suffix}")
+        write_panel(df_agg, Path.cwd()/cleaned_data_path/f"agg_pattern{suffix}")
+
 
 @click.command()
 @click.argument("config_file", type=str, default="src/config.yaml") 
-def data_output_cmd(config_file):
+@click.option("--jobs", type=int, default=1, help="number of worker processes for the panel builds")
+@click.option("--no-cache", is_flag=True, help="rerun every stage instead of using the stage cache")
+@click.option("--profile", is_flag=True, help="add a cProfile dump to the run report")
+def data_output_cmd(config_file, jobs, no_cache, profile):
     """
     data_output_cmd use to generate cmd commend
     """
-    data_output(config_file)
+    data_output(config_file, jobs, not no_cache, profile)
 
 if __name__ == "__main__":
     data_output_cmd()
\ No newline at end of file
@@ -0,0 +1,113 @@
+"""
+This script map the BDS age and size groups and the NAICS codes
+    - age and size buckets are lookups on the category codes (one lookup per category)
+    - the NAICS hierarchy is integer arithmetic on the codes
+"""
+
+import numpy as np
+import pandas as pd
+
+# 2 digit NAICS codes of a sector with several codes (31-33, 44-45 and 48-49)
+NAICS_2_RECODE = {32: 31, 33: 31, 45: 44, 49: 48}
+
+
+def map_categories(series, mapping, default):
+    """
+    map_categories map the values of a categorical (or string) variable
+        - the mapping is applied to the categories and read by category code
+    Args:
+        series [Series]: variable (eg: fage)
+        mapping [dict]: {value: bucket}
+        default []: bucket of the other values (and missing values)
+    Return:
+        array of buckets
+    """
+    cat = series.astype("category").cat
+    lookup = np.array([mapping.get(value, default) for value in cat.categories] + [default], dtype=object)
+    # code -1 (missing) reads the default at the end of the lookup
+    return lookup[cat.codes.to_numpy()]
+
+
+def age_buckets(fage, buckets, default):
+    """
+    age_buckets coarse age groups of the BDS firm age (fage)
+    Args:
+        fage [Series]: firm age groups
+        buckets [dict]: {fage: coarse age group}
+        default [str]: age group of the other values (age 0)
+    Return:
+        array of coarse age groups
+    """
+    return map_categories(fage, buckets, default)
+
+
+def size_dummy(fsize, sizes):
+    """
+    size_dummy 1 for the BDS firm size groups in sizes, 0 otherwise
+    Args:
+        fsize [Series]: firm size groups
+        sizes [lst]: size groups of the dummy (eg: large firms)
+    Return:
+        integer array
+    """
+    return map_categories(fsize, {size: 1 for size in sizes}, 0).astype(np.int64)
+
+
+def naics_code(series, digits):
+    """
+    naics_code integer NAICS code of the first digits of a sector variable
+        - integer codes: integer arithmetic (see naics_prefix)
+        - labels (eg: "31-33"): parsed once per category
+    Args:
+        series [Series]: sector codes or labels
+        digits [int]: number of digits
+    Return:
+        array of codes (float if some labels are not codes)
+    """
+    if pd.api.types.is_integer_dtype(series):
+        return naics_prefix(series.to_numpy(np.int64), digits)
+    if pd.api.types.is_numeric_dtype(series):
+        return naics_prefix(series.to_numpy(), digits)
+
+    cat = series.astype("category").cat
+    lookup = pd.to_numeric(pd.Series(cat.categories.astype(str).str.slice(0, digits)), errors="coerce").to_numpy()
+    codes = cat.codes.to_numpy()
+    if (codes < 0).any():
+        lookup = np.append(lookup.astype(np.float64), np.nan)
+    return lookup[codes]
+
+
+def naics_prefix(codes, digits):
+    """
+    naics_prefix first digits of integer NAICS codes (codes with fewer digits are kept)
+        eg: 3361 -> 33 (2 digits), 336 (3 digits); 31 -> 31 (3 digits)
+    Args:
+        codes [array]: NAICS codes
+        digits [int]: number of digits
+    Return:
+        array of codes
+    """
+    codes = np.asarray(codes)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        n_digits = np.floor(np.log10(np.where(codes > 0, codes, 1))).astype(np.int64) + 1
+    scale = 10 ** np.maximum(n_digits - digits, 0)
+    return codes // scale
+
+
+def naics_recode(codes, recode=None):
+    """
+    naics_recode recode the 2 digit codes of sectors with several codes
+        (32 and 33 to 31, 45 to 44, 49 to 48)
+    Args:
+        codes [array]: 2 digit NAICS codes
+        recode [dict]: {code: new code} (NAICS_2_RECODE if None)
+    Return:
+        array of codes
+    """
+    recode = NAICS_2_RECODE if recode is None else recode
+    codes = np.asarray(codes)
+    lookup = np.arange(100, dtype=codes.dtype)
+    for code, new_code in recode.items():
+        lookup[code] = new_code
+    inside = (codes >= 0) & (codes < 100)
+    return np.where(inside, lookup[np.where(inside, codes, 0).astype(np.int64)], codes)
@@ -2,27 +2,189 @@
 This script build the regression models
 """
 
+import tempfile
+from types import SimpleNamespace
+
 import click
 import pandas as pd
 from pathlib import Path
-from linearmodels.panel import PanelOLS
-from linearmodels.iv import IV2SLS
 
 from Src.utility import parse_config
-from Src.utility import coef_dict
-from Src.utility import plot_lp
+from Src.utility import set_logger
+from Src.utility import CoefTable
+from Src.utility import run_tasks
+from Src.utility import share_frames
+from Src.utility import load_shared
+from Src.storage import read_panel
+from Src.estimators import DesignCache
+from Src.bootstrap import wild_cluster_bootstrap
+from Src.cache import FitStore
+from Src.cache import file_digest
+from Src.profiling import profiled
+from Src.profiling import stage
+from Src.profiling import RunReport
 
 # options of pandas
 pd.options.mode.use_inf_as_na = True
+
+# sample restriction (applied when loading the panels)
+SAMPLE_YEARS = [("year", ">", 1985), ("year", "<", 2020)]
+
+# settings of the model section and source files of the estimators in the fit keys (see fit_keys)
+FIT_SETTINGS = [
+    "iv_fixed_effects", "bootstrap_reps", "bootstrap_cluster",
+    "bootstrap_weights", "bootstrap_seed", "bootstrap_chunk_size",
+    ]
+FIT_CODE_FILES = ["estimators.py", "bootstrap.py"]
+
+# panels and designs of the fit functions (see load_panels)
+PANELS = {}
+DESIGNS = DesignCache()
             
             
-def model_sector(config, depend_vars):
+def load_panels(panels, design_cache_bytes=2**30):
+    """
+    load_panels make the panels available to the fit functions
+    (run once in each worker process of run_tasks)
+    Args:
+        panels [dict]: {name: DataFrame or file shared by share_frames}
+        design_cache_bytes [int]: memory limit of the design cache
+    Returns:
+        None
+    """
+    for name, df in panels.items():
+        PANELS[name] = load_shared(df)
+    DESIGNS.clear()
+    DESIGNS.max_bytes = design_cache_bytes
+
+
+def fit_keys(func, panel_path, labels, config_model):
+    """
+    fit_keys keys of the fits in the fit store
+        - data snapshot: content hash of the panel file
+        - specification: source code of the fit function (formula, weights
+          and covariance type), the settings of FIT_SETTINGS and the sample
+          restriction
+        - source code of the estimators
+    Args:
+        func [function]: fit function
+        panel_path [Path]: panel file
+        labels [lst]: label of each fit (eg: dependent variable)
+        config_model [dict]: model section of the config file
+    Returns:
+        list of keys
+    """
+    snapshot = file_digest(panel_path)
+    settings = {var: config_model[var] for var in FIT_SETTINGS}
+    code = [file_digest(Path(__file__).parent/file) for file in FIT_CODE_FILES]
+    return [
+        FitStore.key(func.__name__, func, snapshot, label, settings, SAMPLE_YEARS, code)
+        for label in labels
+        ]
+
+
+def fit_stored(func, keys, store_path, *args):
+    """
+    fit_stored run a fit function and store its results (in the worker process,
+    so finished fits are kept if another fit fails)
+    Args:
+        func [function]: fit function returning {label: results} and design cache stats
+        keys [dict]: {label: key} of the results to store
+        store_path [Path]: fit store (see FitStore)
+        args: arguments of func
+    Returns:
+        design cache hits and misses
+    """
+    results, cache_stats = func(*args)
+    store = FitStore(store_path)
+    for label, key in keys.items():
+        store.put(key, func.__name__, label, results[label])
+    return cache_stats
+
+
+@profiled
+def fit_sector(depend_var, config_model):
+    """
+    fit_sector run the regressions of one dependent variable of the sector panel
+        (OLS, IV and wild cluster bootstrap share the samples and the IV design)
+    Args:
+        depend_var [str]: dependent variable
+        config_model [dict]: model section of the config file
+    Returns:
+        dictionary of {depend_var: results ("ols", "iv" and "bootstrap")}, design cache hits and misses
+    """
+    # load data (sample restriction applied when loading)
+    data = PANELS["sector"]
+    hits, misses = DESIGNS.hits, DESIGNS.misses
+    results = {}
+    
+    ####################
+    # OLS
+    ####################
+    var_lst = ["L_0_log_gdp", "L_0_log_restriction_2_0"]
+    spec_ols = DESIGNS.spec(
+        "sector", var_lst, weights="firms", fe_vars=["sector", "year"],
+        sample=SAMPLE_YEARS, sample_vars=["L_1_log_gdp", "sector_2"],
+        )
+    
+    # y ~ L_0_log_gdp + L_0_log_restriction_2_0 + EntityEffects + TimeEffects
+    from linearmodels.panel import PanelOLS
+    with stage("PanelOLS", depend_var) as record:
+        data_ols = data.loc[DESIGNS.mask(data, spec_ols, depend_var), :].set_index(['sector', 'year'])
+        mod_ols = PanelOLS(
+            data_ols[depend_var], data_ols[var_lst], weights=data_ols['firms'],
+            entity_effects=True, time_effects=True, drop_absorbed=True,
+            )
+        res_ols = mod_ols.fit(cov_type='heteroskedastic')
+        record["rows"], record["cols"] = data_ols.shape[0], len(var_lst)
+    
+    results["ols"] = SimpleNamespace(
+        params=res_ols.params, std_errors=res_ols.std_errors,
+        pvalues=res_ols.pvalues, nobs=res_ols.nobs,
+        table=res_ols.summary.as_csv(),
+        )
+
+    ####################
+    # PANEL
+    ####################
+    # y ~ fixed effects (absorbed) + L_0_log_gdp + [L_0_log_restriction_2_0 ~ L_0_bartik_iv]
+    spec_iv = DESIGNS.spec(
+        "sector", ["L_0_log_gdp"], ["L_0_log_restriction_2_0"], ["L_0_bartik_iv"],
+        weights="firms", fe_vars=config_model["iv_fixed_effects"],
+        sample=SAMPLE_YEARS, sample_vars=["L_1_log_gdp", "sector_2"],
+        )
+    with stage("iv_2sls", depend_var) as record:
+        design, mask = DESIGNS.design(data, spec_iv, depend_var)
+        y = data.loc[mask, [depend_var]]
+        res_iv = design.fit(y)[depend_var]
+        record["rows"], record["cols"] = design.x.shape
+    # parameter block only (no linearmodels header and diagnostics, see README)
+    res_iv.table = res_iv.summary_frame().to_csv()
+    results["iv"] = res_iv
+    
+    # wild cluster bootstrap inference (both stages resampled, see wild_cluster_bootstrap)
+    if config_model["bootstrap_reps"] > 0:
+        results["bootstrap"] = wild_cluster_bootstrap(
+            design, y, data.loc[mask, config_model["bootstrap_cluster"]],
+            reps=config_model["bootstrap_reps"],
+            weight_type=config_model["bootstrap_weights"],
+            seed=config_model["bootstrap_seed"],
+            chunk_size=config_model["bootstrap_chunk_size"],
+            jobs=config_model["bootstrap_threads"],
+            )
+    
+    return {depend_var: results}, (DESIGNS.hits - hits, DESIGNS.misses - misses)
+
+
+def model_sector(config, depend_vars, jobs=1, refit=False):
     """
     model_sector function load the clean data and run the regression
     to study the effects of regulation on firm dynamism
     Args:
         config [str]: config file
         depend_vars [str]: dependent variables
+        jobs [int]: number of worker processes for the regressions
+        refit [bool]: fit every model again (ignore the fit store)
     Returns:
         Final data
     """
@@ -33,80 +195,66 @@ def model_sector(config, depend_vars):
     # load data paths
     cleaned_data_path = Path(config["model"]["sector_panel"])
     results_tables_path = Path(config["model"]["results_tables_path"])
+    bootstrap = config["model"]["bootstrap_reps"] > 0
     
-    df = pd.read_hdf(Path.cwd()/cleaned_data_path, key="data")
+    # fits of the store (only new or changed specifications are fitted)
+    store = FitStore(Path.cwd()/config["model"]["fit_store_path"])
+    keys = dict(zip(depend_vars, fit_keys(fit_sector, Path.cwd()/cleaned_data_path, depend_vars, config["model"])))
+    stored = set() if refit else set(store.stored(keys.values()))
+    todo = [depend_var for depend_var in depend_vars if keys[depend_var] not in stored]
+    print(f"fit store: {len(depend_vars) - len(todo)} stored fits, {len(todo)} to fit")
+    
+    if todo:
+        # load only the regression variables of the sample years
+        var_model = [
+            "L_0_log_restriction_2_0", "L_0_bartik_iv",
+            "L_0_log_gdp", "L_1_log_gdp",
+            "sector_2", "firms", "sector", "year",
+            config["model"]["bootstrap_cluster"],
+            ]
+        var_model = list(dict.fromkeys(var_model))
+        df = read_panel(
+            Path.cwd()/cleaned_data_path,
+            columns=var_model + [var for var in todo if var not in var_model],
+            filters=SAMPLE_YEARS,
+            )
+        
+        ####################
+        # Regressions (OLS and IV of every dependent variable)
+        ####################
+        with tempfile.TemporaryDirectory() as shared_dir:
+            panels = {"sector": df}
+            if jobs > 1:
+                panels = share_frames(panels, shared_dir)
+            cache_stats = run_tasks(
+                fit_stored,
+                [(fit_sector, {depend_var: keys[depend_var]}, store.path, depend_var, config["model"]) for depend_var in todo],
+                jobs,
+                initializer=load_panels,
+                initargs=(panels, config["model"]["design_cache_mb"] * 2**20),
+                )
+        print(f"design cache: {sum(stats[0] for stats in cache_stats)} hits, {sum(stats[1] for stats in cache_stats)} misses")
+    fits = {depend_var: store.get(keys[depend_var])[1] for depend_var in depend_vars}
     
-    ####################
-    # OLS
-    ####################
     dict1 = {}
     dict1["index"] = [
         "OLS Coef", "", "# obs", "",
         "OLS IV", "",  "# obs", ""
         ]
-    for depend_var in depend_vars:
-
-        # load data
-        data = df
-
-        # sample restriction
-        data = data[(data.year > 1985)&(data.year < 2020)]
-
-        # regression
-        data_ols = data.set_index(['sector', 'year'])
-        
-        var_lst = [
-        "L_0_log_restriction_2_0",
-        "L_0_log_gdp", "L_1_log_gdp",
-        depend_var, "sector_2", "firms"
-        ]
-        
-        formula_txt = f'{depend_var} ~ L_0_log_gdp + L_0_log_restriction_2_0 + EntityEffects + TimeEffects'
-        
-        # regression
-        data_ols = data_ols.loc[:, var_lst].dropna()
-        mod_ols = PanelOLS.from_formula(formula = formula_txt, weights=data_ols['firms'], data = data_ols, drop_absorbed=True)
-
-        res_ols = mod_ols.fit(cov_type='heteroskedastic')
-        results_ols = res_ols.summary
+    coef_table = CoefTable()
+    for depend_var, results in fits.items():
+        res_ols = results["ols"]
+        res_iv = results["iv"]
             
         # saving results
         # table
         file_path = Path.cwd()/results_tables_path/f"{depend_var}_sector_panel_ols.csv"
         with open(file_path, 'w', encoding='utf-8') as f:
-            f.write(results_ols.as_csv())  
+            f.write(res_ols.table)  
 
-        ####################
-        # PANEL
-        ####################
-        # load data
-        data = df
-
-        # sample restriction
-        data = data[(data.year > 1985)&(data.year < 2020)]
-        
-        data_iv = data
-        
-        var_list = [
-        "L_0_log_restriction_2_0", "L_0_bartik_iv",
-        "L_0_log_gdp", "L_1_log_gdp",
-        depend_var, "sector_2", 'firms', "sector", "year"]
-        
-        formula_txt = f'{depend_var} ~ C(sector) + C(year) + L_0_log_gdp  + [L_0_log_restriction_2_0 ~ L_0_bartik_iv]'
-        
-        # regression
-        data_iv = data_iv.loc[:, var_list].dropna()
-        mod_iv = IV2SLS.from_formula(formula = formula_txt, weights=data_iv['firms'], data = data_iv)
-
-        res_iv = mod_iv.fit(cov_type='heteroskedastic')
-        results_iv = res_iv.summary
-        
-        # saving results
-        # table
         file_path = Path.cwd()/results_tables_path/f"{depend_var}_sector_panel_iv.csv"
         with open(file_path, 'w', encoding='utf-8') as f:
-            f.write(results_iv.as_csv())  
-        
+            f.write(res_iv.table)
         
         # create result table
         v_name = "L_0_log_restriction_2_0"
@@ -137,19 +285,64 @@ def model_sector(config, depend_vars):
             coefs_value_iv, std_iv, nobs_iv, "",
             ]
         
+        # wild cluster bootstrap inference of the iv estimates
+        if bootstrap:
+            coef_table.add(depend_var, "L_0_log_restriction_2_0", results["bootstrap"], "all")
+        
     df_coefs = pd.DataFrame(dict1)
     df_coefs.to_csv(Path.cwd()/results_tables_path/"key_results"/"sector_panel_summary.csv") 
+    
+    if bootstrap:
+        df_boot = coef_table.to_frame()
+        df_boot.to_csv(Path.cwd()/results_tables_path/"key_results"/"sector_panel_iv_bootstrap.csv")
 
     return None
 
     
-def model_sector_age(config, depend_vars):
+@profiled
+def fit_sector_age(age, depend_vars, fe_vars):
+    """
+    fit_sector_age run the IV regressions of one age group of the sector age panel
+        (outcomes with the same sample share the design and first stage)
+    Args:
+        age [str]: age group
+        depend_vars [lst]: dependent variables
+        fe_vars [lst]: fixed effects
+    Returns:
+        dictionary of {depend_var: results}, design cache hits and misses
+    """
+    # load data (sample restriction applied when loading)
+    df_ag = PANELS["sector_age"]
+    data = df_ag[df_ag.age_coarse == age]
+    hits, misses = DESIGNS.hits, DESIGNS.misses
+
+    # y ~ fixed effects (absorbed) + L_0_log_gdp + [L_0_log_restriction_2_0 ~ L_0_bartik_iv]
+    spec = DESIGNS.spec(
+        f"sector_age_{age}", ["L_0_log_gdp"], ["L_0_log_restriction_2_0"], ["L_0_bartik_iv"],
+        weights="firms", fe_vars=fe_vars,
+        sample=SAMPLE_YEARS, sample_vars=["L_0_entry_rate", "sector_2"],
+        )
+    groups = {}
+    for depend_var in depend_vars:
+        design, mask = DESIGNS.design(data, spec, depend_var)
+        groups.setdefault(id(design), (design, mask, []))[2].append(depend_var)
+    
+    results = {}
+    for design, mask, depend_group in groups.values():
+        results.update(design.fit(data.loc[mask, depend_group]))
+    
+    return results, (DESIGNS.hits - hits, DESIGNS.misses - misses)
+
+
+def model_sector_age(config, depend_vars, jobs=1, refit=False):
     """
     model_sector_age function load the clean data and run the regression
     to study the effects of regulation on firm dynamism
     Args:
         config [str]: config file
         depend_vars [str]: dependent variables
+        jobs [int]: number of worker processes for the regressions
+        refit [bool]: fit every model again (ignore the fit store)
     Returns:
         Final data
     """
@@ -161,57 +354,83 @@ def model_sector_age(config, depend_vars):
     cleaned_data_path = Path(config["model"]["sector_age_panel"])
     results_figs_path = Path(config["model"]["results_figs_path"])
     fig_path = Path.cwd()/results_figs_path
+    fe_vars = config["model"]["iv_fixed_effects"]
     
-    df_ag = pd.read_hdf(Path.cwd()/cleaned_data_path, key="data")
-    std_reg = df_ag["L_0_log_restriction_2_0"].std()
+    # scale and age groups come from the whole panel
+    df_full = read_panel(Path.cwd()/cleaned_data_path, columns=["L_0_log_restriction_2_0", "age_coarse"])
+    std_reg = df_full["L_0_log_restriction_2_0"].std()
+    ages = df_full.age_coarse.unique()[1:]
     
-    # iv estimation
-    ceof_dict = []
-    for depend_var in depend_vars:
-        for age in df_ag.age_coarse.unique()[1:]:
-            
-            # load data
-            data = df_ag[df_ag.age_coarse == age]
-
-            # sample restriction
-            data = data[(data.year > 1985) & (data.year < 2020)]
-
-            var_lst = [
+    # fits of the store (only new or changed specifications are fitted)
+    store = FitStore(Path.cwd()/config["model"]["fit_store_path"])
+    labels = [(age, depend_var) for age in ages for depend_var in depend_vars]
+    keys = dict(zip(labels, fit_keys(fit_sector_age, Path.cwd()/cleaned_data_path, labels, config["model"])))
+    stored = set() if refit else set(store.stored(keys.values()))
+    todo = {}
+    for age, depend_var in labels:
+        if keys[(age, depend_var)] not in stored:
+            todo.setdefault(age, {})[depend_var] = keys[(age, depend_var)]
+    n_todo = sum(len(age_keys) for age_keys in todo.values())
+    print(f"fit store: {len(labels) - n_todo} stored fits, {n_todo} to fit")
+    
+    if todo:
+        # load only the regression variables of the sample years
+        var_model = [
             "L_0_log_restriction_2_0", "L_0_bartik_iv", 
             "L_0_entry_rate",
             "L_0_log_gdp",
             "sector", "year",
-            depend_var, "sector_2", 'firms'
+            "sector_2", 'firms', "age_coarse"
             ]
-            
-            formula_txt = f'{depend_var} ~ C(year) + C(sector) \
-                                        + L_0_log_gdp     \
-                                        + [L_0_log_restriction_2_0 ~ L_0_bartik_iv]'
-                
-            # regression
-            data1 = data.loc[:, var_lst].dropna()
-            mod1 = IV2SLS.from_formula(
-            formula = formula_txt, weights=data1['firms'], data = data1
+        df_ag = read_panel(
+            Path.cwd()/cleaned_data_path,
+            columns=var_model + [var for var in depend_vars if var not in var_model],
+            filters=SAMPLE_YEARS,
             )
+        
+        # iv estimation (one task per age group, only the outcomes to fit)
+        with tempfile.TemporaryDirectory() as shared_dir:
+            panels = {"sector_age": df_ag}
+            if jobs > 1:
+                panels = share_frames(panels, shared_dir)
+            cache_stats = run_tasks(
+                fit_stored,
+                [(fit_sector_age, age_keys, store.path, age, list(age_keys), fe_vars) for age, age_keys in todo.items()],
+                jobs,
+                initializer=load_panels,
+                initargs=(panels, config["model"]["design_cache_mb"] * 2**20),
+                )
+        print(f"design cache: {sum(stats[0] for stats in cache_stats)} hits, {sum(stats[1] for stats in cache_stats)} misses")
+    
+    coef_table = CoefTable(len(depend_vars) * len(ages))
+    for depend_var in depend_vars:
+        for age in ages:
+            _, res = store.get(keys[(age, depend_var)])
+            coef_table.add(depend_var, "L_0_log_restriction_2_0", res, age)
 
-            res = mod1.fit(cov_type='heteroskedastic')
-            
-            ceof_dict = coef_dict(depend_var, "L_0_log_restriction_2_0", res, ceof_dict, age)
-
-    df_coefs_age = pd.DataFrame(ceof_dict)
+    df_coefs_age = coef_table.to_frame()
     df_coefs_age = df_coefs_age.sort_values(by=['depend_var', 'age'])
 
-    for depend_var in depend_vars:
-        plot_lp(df_coefs_age, depend_var, "Sector_Age_Panel", fig_path, std_reg)
+    from Src.plots import plot_stage
+    plot_stage(
+        df_coefs_age, depend_vars, "Sector_Age_Panel", fig_path, std_reg,
+        fmt=config["model"]["plot_format"], jobs=jobs,
+        )
         
         
 @click.command()
 @click.argument("config_file", type=str, default="src/config.yaml") 
-def model_output(config_file):
+@click.option("--jobs", type=int, default=1, help="number of worker processes for the regressions")
+@click.option("--profile", is_flag=True, help="add a cProfile dump to the run report")
+@click.option("--refit", is_flag=True, help="fit every model again (ignore the fit store)")
+def model_output(config_file, jobs, profile, refit):
     """
     model_output function output results
     Args:
         config_file [str]: path to config file
+        jobs [int]: number of worker processes for the regressions
+        profile [bool]: add a cProfile dump to the run report
+        refit [bool]: fit every model again (ignore the fit store)
     Returns:
         Final data
     """
@@ -223,17 +442,21 @@ def model_output(config_file):
     config = parse_config(config_file)
     variable_list = config["model"]["dep_var"]
     variable_list.sort()
+    report_path = Path.cwd()/config["model"]["report_path"]
+    logger = set_logger(report_path/"model.log")
     
     ####################
     # Output
     ####################
-    print("running models for sector panel")
+    # time, peak memory and size of every stage (see RunReport)
+    with RunReport("model", report_path, profile, logger):
+        print("running models for sector panel")
 
-    model_sector(config, variable_list)
+        model_sector(config, variable_list, jobs, refit)
 
-    print("running models sector age panel")
-    variable_list.remove("L_0_entry_rate")
-    model_sector_age(config, variable_list)    
+        print("running models sector age panel")
+        variable_list.remove("L_0_entry_rate")
+        model_sector_age(config, variable_list, jobs, refit)
     
     
 if __name__ == "__main__":
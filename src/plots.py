@@ -0,0 +1,203 @@
+"""
+This script render the figures of the results (non-interactive Agg backend)
+"""
+
+import hashlib
+import inspect
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+from matplotlib.backends.backend_pdf import PdfPages
+
+from Src.utility import run_tasks
+from Src.profiling import profiled
+
+# columns of the coefficient rows drawn in the figures
+PLOT_COLUMNS = ["age", "Coef", "lower_ci", "upper_ci"]
+
+# file of the content hash of every rendered figure (in the figure dir)
+PLOT_INDEX = "plots_index.json"
+
+
+def draw_lp(ax, df_sub, depend_var, std):
+    """
+    draw_lp draw the local projection of one dependent variable
+    Args:
+        ax [Axes]: axes of the figure
+        df_sub [DataFrame]: coefs of the dependent variable
+        depend_var [str]: dependent variable
+        std [float]: scale of the coefs (standard deviation of the regressor)
+    Return:
+        None
+    """
+    depend_name = depend_var.replace("_", " ").title()
+
+    Age = df_sub.age.to_numpy().T
+    Coef = df_sub.Coef.to_numpy().T
+    Coef = Coef * std
+    lower_ci = - df_sub[["lower_ci"]].to_numpy().T + df_sub.Coef.to_numpy().T
+    lower_ci  = lower_ci * std
+    upper_ci = df_sub[["upper_ci"]].to_numpy().T - df_sub.Coef.to_numpy().T
+    upper_ci = upper_ci * std
+    yerr = np.vstack((lower_ci, upper_ci))
+
+    ax.scatter(Age, Coef)
+    ax.errorbar(Age, Coef, yerr = yerr, fmt = 'o',color = 'orange',
+        ecolor = 'lightgreen', elinewidth = 3, capsize=5)
+    ax.axhline(y=0, color='r', linestyle=':')
+
+    ax.set_title(f"{depend_name}".title())
+    ax.set_xlabel("Age")
+    ax.set_ylabel(f"{depend_name}".title())
+
+    return None
+
+
+@profiled
+def plot_lp(df_sub, depend_var, plot_name, fig_path, std):
+    """
+    plot_lp plot local projection graph
+    Args:
+        df_sub [DataFrame]: coefs of the dependent variable
+        depend_var [str]: dependent variable
+        plot_name [str]: name for the plot
+        fig_path [Path]: path of the figure
+        std [float]: scale of the coefs (standard deviation of the regressor)
+    Return:
+        None
+    """
+    fig, ax = plt.subplots()
+    depend_name = depend_var.replace("_", " ").title()
+    draw_lp(ax, df_sub, depend_var, std)
+
+    fig.suptitle(f'Effects of Regulation on {depend_name}')
+    fig.tight_layout()
+    fig_final_path = Path(fig_path)/f"{plot_name}_{depend_name}.png"
+
+    fig.savefig(fig_final_path, facecolor='white', transparent=False)
+    plt.close(fig)
+    return None
+
+
+def plot_pages(frames, plot_name, fig_path, std, fmt):
+    """
+    plot_pages plot every dependent variable in one file
+        - pdf: one page per dependent variable
+        - svg: one sheet with a panel per dependent variable
+    Args:
+        frames [dict]: {depend_var: coefs of the dependent variable}
+        plot_name [str]: name for the plot
+        fig_path [Path]: path of the figure
+        std [float]: scale of the coefs (standard deviation of the regressor)
+        fmt [str]: "pdf" or "svg"
+    Return:
+        None
+    """
+    fig_final_path = Path(fig_path)/f"{plot_name}.{fmt}"
+    if fmt == "pdf":
+        with PdfPages(fig_final_path) as pdf:
+            for depend_var, df_sub in frames.items():
+                fig, ax = plt.subplots()
+                draw_lp(ax, df_sub, depend_var, std)
+                fig.suptitle(f'Effects of Regulation on {depend_var.replace("_", " ").title()}')
+                fig.tight_layout()
+                pdf.savefig(fig, facecolor='white', transparent=False)
+                plt.close(fig)
+        return None
+
+    n_cols = min(3, len(frames))
+    n_rows = -(-len(frames) // n_cols)
+    fig, axes = plt.subplots(n_rows, n_cols, figsize=(5 * n_cols, 4 * n_rows), squeeze=False)
+    for ax, (depend_var, df_sub) in zip(axes.ravel(), frames.items()):
+        draw_lp(ax, df_sub, depend_var, std)
+    for ax in axes.ravel()[len(frames):]:
+        ax.set_visible(False)
+    fig.suptitle('Effects of Regulation')
+    fig.tight_layout()
+    fig.savefig(fig_final_path, facecolor='white', transparent=False)
+    plt.close(fig)
+    return None
+
+
+def plot_key(frames, plot_name, std, fmt):
+    """
+    plot_key content hash of a figure file: plotted coefficient rows, scale,
+    file format and the source code of the drawing functions
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(json.dumps(
+        [plot_name, float(std), fmt, inspect.getsource(draw_lp), inspect.getsource(plot_lp), inspect.getsource(plot_pages)]
+        ).encode())
+    for depend_var, df_sub in frames.items():
+        digest.update(depend_var.encode())
+        digest.update(pd.util.hash_pandas_object(df_sub[PLOT_COLUMNS], index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+@profiled
+def plot_stage(df, depend_vars, plot_name, fig_path, std, fmt="png", jobs=1):
+    """
+    plot_stage function that
+        - render the local projection figures of the dependent variables
+        - png: one file per dependent variable, rendered in a process pool
+        - pdf or svg: one file with every dependent variable (see plot_pages)
+        - skip the figures whose coefficient rows are unchanged (content
+          hash stored in PLOT_INDEX of the figure dir)
+    Args:
+        df [DataFrame]: Data contains coefs (see CoefTable)
+        depend_vars [lst]: dependent variables
+        plot_name [str]: name for the plot
+        fig_path [Path]: path of the figures
+        std [float]: scale of the coefs (standard deviation of the regressor)
+        fmt [str]: "png", "pdf" or "svg"
+        jobs [int]: number of worker processes
+    Return:
+        number of figure files rendered
+    """
+    fig_path = Path(fig_path)
+    fig_path.mkdir(parents=True, exist_ok=True)
+    index_path = fig_path/PLOT_INDEX
+    index = {}
+    if index_path.exists():
+        with open(index_path, "r") as f:
+            index = json.load(f)
+
+    # coefs of each dependent variable (one pass over the table)
+    groups = dict(tuple(df.groupby("depend_var", sort=False)))
+    frames = {depend_var: groups[depend_var] for depend_var in depend_vars if depend_var in groups}
+
+    # figure files and the content hash of each
+    if fmt == "png":
+        files = {
+            f"{plot_name}_{depend_var.replace('_', ' ').title()}.png": (
+                plot_key({depend_var: df_sub}, plot_name, std, fmt), (df_sub, depend_var, plot_name, fig_path, std)
+                )
+            for depend_var, df_sub in frames.items()
+            }
+    else:
+        files = {f"{plot_name}.{fmt}": (plot_key(frames, plot_name, std, fmt), (frames, plot_name, fig_path, std, fmt))}
+    todo = [
+        name for name, (key, _) in files.items()
+        if index.get(name) != key or not (fig_path/name).exists()
+        ]
+
+    if fmt == "png":
+        run_tasks(plot_lp, [files[name][1] for name in todo], jobs)
+    else:
+        for name in todo:
+            plot_pages(*files[name][1])
+
+    index.update({name: files[name][0] for name in todo})
+    path_tmp = index_path.with_suffix(".tmp")
+    with open(path_tmp, "w") as f:
+        json.dump(index, f, indent=2)
+    os.replace(path_tmp, index_path)
+
+    print(f"figures: {len(todo)} rendered, {len(files) - len(todo)} unchanged")
+    return len(todo)
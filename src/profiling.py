@@ -0,0 +1,290 @@
+"""
+This script record the time, peak memory and data size of the stages of a run
+"""
+
+import cProfile
+import functools
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+try:
+    import psutil
+except ImportError:  # optional, the current memory is read from /proc on Linux
+    psutil = None
+
+# report directory of the current run (inherited by the worker processes)
+REPORT_ENV = "RFE_REPORT_DIR"
+
+# logger of the current run and stages being recorded in this process
+LOGGER = None
+STACK = []
+
+# records of the running stages, their peak memory is sampled by a thread
+# every RSS_INTERVAL seconds while a stage is running
+RSS_INTERVAL = 0.01
+OPEN = []
+SAMPLER = None
+LOCK = threading.Lock()
+
+
+def peak_rss(who="self"):
+    """
+    peak_rss peak resident memory in MB (high-water mark since the process started)
+    Args:
+        who [str]: "self" (this process) or "children" (finished worker processes)
+    Return:
+        peak memory (nan if not available)
+    """
+    if resource is None:
+        return float("nan")
+    usage = resource.getrusage(resource.RUSAGE_SELF if who == "self" else resource.RUSAGE_CHILDREN)
+    scale = 1 if sys.platform == "darwin" else 1024       # bytes on macOS, KB on Linux
+    return usage.ru_maxrss * scale / 2**20
+
+
+def current_rss():
+    """
+    current_rss resident memory of this process in MB
+    Return:
+        current memory (nan if neither /proc nor psutil is available)
+    """
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, AttributeError, ValueError):
+        pass
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / 2**20
+    return float("nan")
+
+
+def sample_rss():
+    """
+    sample_rss update the peak memory of the running stages (sampler thread,
+    stops once no stage is running)
+    """
+    global SAMPLER
+    while True:
+        with LOCK:
+            if not OPEN:
+                SAMPLER = None
+                return
+            records = list(OPEN)
+        rss = current_rss()
+        for record in records:
+            record["peak_rss_mb"] = max(record["peak_rss_mb"], rss)
+        time.sleep(RSS_INTERVAL)
+
+
+def reset_sampler():
+    """
+    reset_sampler forget the stages and the sampler thread of the parent process (forked workers)
+    """
+    global SAMPLER, LOCK
+    OPEN.clear()
+    SAMPLER = None
+    LOCK = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_sampler)
+
+
+def data_shape(obj):
+    """
+    data_shape rows and columns of a result (first DataFrame of a tuple, list or dict)
+    """
+    if isinstance(obj, (tuple, list)):
+        obj = next((item for item in obj if hasattr(item, "shape")), None)
+    elif isinstance(obj, dict):
+        obj = next((item for item in obj.values() if hasattr(item, "shape")), None)
+    shape = getattr(obj, "shape", None)
+    if shape is None:
+        return None, None
+    return shape[0], (shape[1] if len(shape) > 1 else 1)
+
+
+def arg_label(arg):
+    """
+    arg_label label of a string, number or list of strings argument (None otherwise)
+    """
+    if isinstance(arg, (str, int, float)):
+        return str(arg)
+    if isinstance(arg, (list, tuple)) and arg and all(isinstance(item, str) for item in arg):
+        return ",".join(arg)
+    return None
+
+
+def start_sampler(record):
+    """
+    start_sampler add a running stage and start the sampler thread if needed
+    """
+    global SAMPLER
+    with LOCK:
+        OPEN.append(record)
+        if SAMPLER is None:
+            SAMPLER = threading.Thread(target=sample_rss, name="rss_sampler", daemon=True)
+            SAMPLER.start()
+
+
+@contextmanager
+def stage(name, label=None):
+    """
+    stage record the time and peak memory of a block of code
+        - only if a run report is active (see RunReport), in any process
+        - the record is a dictionary, rows and cols can be added by the block
+        - peak_rss_mb: peak resident memory of the process while the block
+          runs (memory at the start and the end, and sampled every RSS_INTERVAL
+          seconds by a thread), not the high-water mark of the process
+    Args:
+        name [str]: stage name
+        label [str]: detail of the stage (eg: dependent variable)
+    """
+    run_dir = os.environ.get(REPORT_ENV)
+    if not run_dir:
+        yield {}
+        return
+
+    record = {
+        "stage": name, "label": label, "parent": STACK[-1] if STACK else None,
+        "pid": os.getpid(), "start": time.time(),
+        "rows_in": None, "rows": None, "cols": None, "peak_rss_mb": current_rss(),
+        }
+    STACK.append(name)
+    start_sampler(record)
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        STACK.pop()
+        record["seconds"] = time.perf_counter() - start
+        with LOCK:
+            OPEN[:] = [running for running in OPEN if running is not record]
+        record["peak_rss_mb"] = max(record["peak_rss_mb"], current_rss())
+        record["path"] = ";".join(STACK + [name])
+        with open(Path(run_dir)/f"stages_{os.getpid()}.jsonl", "a") as f:
+            f.write(json.dumps(record, default=str) + "\n")
+        if LOGGER is not None:
+            LOGGER.info(
+                f"{name} {label or ''}: {record['seconds']:.3f}s, "
+                f"peak rss {record['peak_rss_mb']:.0f} MB, rows {record['rows']}, cols {record['cols']}"
+                )
+
+
+def profiled(func):
+    """
+    profiled decorator recording each call of a function as a stage
+        - rows_in: rows of the first DataFrame argument
+        - rows and cols: shape of the result
+        - label: first string, number or list of strings argument (eg: id variables)
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not os.environ.get(REPORT_ENV):
+            return func(*args, **kwargs)
+
+        label = next((arg_label(arg) for arg in args if arg_label(arg) is not None), None)
+        with stage(func.__name__, label) as record:
+            record["rows_in"] = next((len(arg) for arg in args if isinstance(arg, pd.DataFrame)), None)
+            result = func(*args, **kwargs)
+            record["rows"], record["cols"] = data_shape(result)
+        return result
+
+    return wrapper
+
+
+class RunReport:
+    """
+    RunReport report of one run (context manager)
+        - stages recorded in this and the worker processes are collected in
+          stages.json and stages.csv of a new directory of report_path
+        - stages.folded: stage stacks in the collapsed format of flamegraph tools
+        - with profile, a cProfile dump of this process (profile.prof, opened
+          with pstats or snakeviz) and the top functions (profile.txt)
+        - peak memory of each stage (see stage), and of the whole run as the
+          high-water marks of this process and of its finished workers (see peak_rss)
+    Args:
+        name [str]: run name (eg: "make_data")
+        report_path [Path]: directory of the reports
+        profile [bool]: run cProfile
+        logger [Logger]: logger of the run (see set_logger)
+    """
+
+    def __init__(self, name, report_path, profile=False, logger=None):
+        self.name = name
+        self.run_dir = Path(report_path)/f"{name}_{datetime.now():%Y%m%d_%H%M%S}"
+        self.profiler = cProfile.Profile() if profile else None
+        self.logger = logger
+
+    def __enter__(self):
+        global LOGGER
+        self.run_dir.mkdir(parents=True, exist_ok=True)
+        os.environ[REPORT_ENV] = str(self.run_dir)
+        LOGGER = self.logger
+        self.start = time.time()
+        if self.profiler is not None:
+            self.profiler.enable()
+        return self
+
+    def __exit__(self, *exc):
+        global LOGGER
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.run_dir/"profile.prof")
+            with open(self.run_dir/"profile.txt", "w") as f:
+                pstats.Stats(self.profiler, stream=f).sort_stats("cumulative").print_stats(50)
+        os.environ.pop(REPORT_ENV, None)
+
+        # stages of every process
+        stages = []
+        for path in sorted(self.run_dir.glob("stages_*.jsonl")):
+            with open(path, "r") as f:
+                stages += [json.loads(line) for line in f]
+            path.unlink()
+        stages.sort(key=lambda record: record["start"])
+
+        report = {
+            "run": self.name, "started": datetime.fromtimestamp(self.start).isoformat(),
+            "seconds": time.time() - self.start,
+            "peak_rss_mb": peak_rss(), "peak_rss_children_mb": peak_rss("children"),
+            "failed": exc[0] is not None, "stages": stages,
+            }
+        with open(self.run_dir/"stages.json", "w") as f:
+            json.dump(report, f, indent=2, default=str)
+        pd.DataFrame(stages, columns=[
+            "stage", "label", "parent", "pid", "start", "seconds", "peak_rss_mb", "rows_in", "rows", "cols",
+            ]).to_csv(self.run_dir/"stages.csv", index=False)
+
+        # flamegraph input: stack and time in microseconds (time of the children excluded)
+        folded = {}
+        recorded = {(record["path"], record["pid"]) for record in stages}
+        for record in stages:
+            path = record["path"]
+            folded[path] = folded.get(path, 0) + record["seconds"]
+            parent = path.rpartition(";")[0]
+            if (parent, record["pid"]) in recorded:
+                folded[parent] = folded.get(parent, 0) - record["seconds"]
+        with open(self.run_dir/"stages.folded", "w") as f:
+            for path, seconds in folded.items():
+                f.write(f"{path} {max(int(seconds * 1e6), 0)}\n")
+
+        if self.logger is not None:
+            self.logger.info(
+                f"{self.name} finished in {report['seconds']:.1f}s, "
+                f"peak rss {report['peak_rss_mb']:.0f} MB, report in {self.run_dir}"
+                )
+        LOGGER = None
+        return False
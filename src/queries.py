@@ -0,0 +1,519 @@
+"""
+This script build the cleaned panels and the shift share instrument with DuckDB
+queries over the raw files (out-of-core backend of make_data, same results as
+the pandas stages)
+    - data_cube, data_clean, data_sector_entry, data_final and data_patterns
+      are views of one query plan, only the used columns of the raw files are read
+    - the panels are streamed to Parquet files, DuckDB spills to duckdb_temp_path
+      above duckdb_memory_limit
+    - the RegData document x industry join and the instrument are parallel
+      queries over the raw RegData files (see regdata_duckdb)
+"""
+
+from pathlib import Path
+
+from Src.storage import BDS_COUNTS
+from Src.storage import BDS_NA_VALUES
+from Src.storage import RAW_SCHEMAS
+from Src.storage import PANEL_DTYPES
+from Src.mappings import NAICS_2_RECODE
+from Src.bartik import BARTIK_UNIT
+from Src.bartik import ShareMatrix
+from Src.profiling import profiled
+from Src.profiling import stage
+
+# SQL types of the schema and panel types
+SQL_TYPES = {
+    "int8": "TINYINT", "int16": "SMALLINT", "int32": "INTEGER", "int64": "BIGINT",
+    "float64": "DOUBLE", "category": "VARCHAR", "str": "VARCHAR",
+}
+
+
+def connect(config):
+    """
+    connect open an in-memory DuckDB database with the settings of the config
+    Args:
+        config [dict]: config (duckdb_memory_limit, duckdb_threads and duckdb_temp_path)
+    Return:
+        connection
+    """
+    try:
+        import duckdb  # optional, only used by the duckdb backend
+    except ImportError:
+        raise ImportError("the duckdb backend of make_data needs the duckdb package")
+
+    config_make = config["make_data"]
+    temp_path = Path.cwd()/config_make["duckdb_temp_path"]
+    temp_path.mkdir(parents=True, exist_ok=True)
+    settings = {"temp_directory": str(temp_path), "preserve_insertion_order": True}
+    if config_make["duckdb_memory_limit"]:
+        settings["memory_limit"] = config_make["duckdb_memory_limit"]
+    if config_make["duckdb_threads"]:
+        settings["threads"] = config_make["duckdb_threads"]
+    return duckdb.connect(config=settings)
+
+
+def name(var):
+    """
+    name quoted SQL identifier
+    """
+    return '"' + str(var).replace('"', '""') + '"'
+
+
+def literal(value):
+    """
+    literal SQL literal of a string or number
+    """
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    return str(value)
+
+
+def sql_log(expr):
+    """
+    sql_log natural log with the values of numpy (-inf at 0, nan below 0)
+    """
+    return (
+        f"CASE WHEN isnan({expr}) THEN {expr} WHEN {expr} > 0 THEN ln({expr}) "
+        f"WHEN {expr} = 0 THEN '-inf'::DOUBLE WHEN {expr} < 0 THEN 'nan'::DOUBLE END"
+        )
+
+
+def sql_naics(expr, digits):
+    """
+    sql_naics integer NAICS code of the first digits of a code or label (as naics_code)
+    """
+    return f"TRY_CAST(left(CAST({expr} AS VARCHAR), {digits}) AS BIGINT)"
+
+
+def sql_select(columns, source, where=None, group=None, window=None):
+    """
+    sql_select query of a dictionary of {column: expression}
+    Args:
+        columns [dict]: output columns (in order) and their expressions
+        source [str]: table, view or subquery
+        where [lst]: conditions
+        group [lst]: group by variables (among the columns)
+        window [str]: definition of the window w
+    Return:
+        query
+    """
+    sql = "SELECT " + ", ".join(f"{expr} AS {name(var)}" for var, expr in columns.items())
+    sql += f" FROM {source}"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    if group:
+        # by position (group variables are output columns, unambiguous in joins)
+        sql += " GROUP BY " + ", ".join(str(list(columns).index(var) + 1) for var in group)
+    if window:
+        sql += f" WINDOW w AS ({window})"
+    return sql
+
+
+def sql_panel_types(columns, source, order):
+    """
+    sql_panel_types cast the id variables to the types of PANEL_DTYPES (as write_panel)
+    and sort the panel
+    """
+    cast = {
+        var: f"CAST({name(var)} AS {SQL_TYPES[PANEL_DTYPES[var]]})"
+        if var in PANEL_DTYPES and PANEL_DTYPES[var] != "category" else name(var)
+        for var in columns
+        }
+    return sql_select(cast, f"({source})") + " ORDER BY " + ", ".join(name(var) for var in order)
+
+
+def sql_raw(path, source, key_var=None):
+    """
+    sql_raw scan of a raw file with its schema (see read_raw)
+        - columns without a type are inferred, BDS suppression flags are missing
+        - duplicated keys keep the first row (as drop_duplicates)
+    Args:
+        path [Path]: file path
+        source [str]: name of the schema (see RAW_SCHEMAS)
+        key_var [lst]: key variables (no deduplication if None)
+    Return:
+        query
+    """
+    schema = RAW_SCHEMAS[source]
+    types = ", ".join(
+        f"{literal(var)}: {literal(SQL_TYPES[dtype])}" for var, dtype in schema.items() if dtype is not None
+        )
+    nullstr = ", ".join(literal(value) for value in BDS_NA_VALUES)
+    scan = f"read_csv({literal(str(path))}, header = true, nullstr = [{nullstr}], types = {{{types}}})"
+    columns = ", ".join(name(var) for var in schema)
+    if key_var is None:
+        return f"SELECT {columns} FROM {scan}"
+    return (
+        f"SELECT {columns} FROM (SELECT {columns}, row_number() OVER () AS row_id FROM {scan}) "
+        f"QUALIFY row_number() OVER (PARTITION BY {', '.join(name(var) for var in key_var)} ORDER BY row_id) = 1"
+        )
+
+
+def sql_cube(raw, id_var, sector_dig, config):
+    """
+    sql_cube counts at the finest level of a raw table (see data_cube)
+    Args:
+        raw [str]: raw table (see sql_raw)
+        id_var [lst]: id variables (sector, fage, and fsize)
+        sector_dig [int]: sector digits
+        config [dict]: config (age and size buckets)
+    Return:
+        query, id variables of the cube
+    """
+    buckets = config["make_data"]["age_buckets"]
+    sizes = config["make_data"]["large_firm_sizes"]
+    ids = {"sector": sql_naics(name("sector"), sector_dig)}
+    cube_id = [var for var in id_var if var not in ["fage", "fsize"]]
+    if "fage" in id_var:
+        cases = " ".join(f"WHEN {literal(fage)} THEN {literal(age)}" for fage, age in buckets.items())
+        ids["age_coarse"] = f"CASE {name('fage')} {cases} ELSE {literal(config['make_data']['age_default'])} END"
+        cube_id.append("age_coarse")
+    if "fsize" in id_var:
+        ids["large_firm"] = f"CASE WHEN {name('fsize')} IN ({', '.join(literal(size) for size in sizes)}) THEN 1 ELSE 0 END"
+        cube_id.append("large_firm")
+
+    keys = ["year"] + cube_id
+    rows = sql_select(
+        {"year": name("year"), **{var: ids[var] for var in cube_id}, **{var: name(var) for var in BDS_COUNTS}},
+        f"({raw})", where=[f"{name('firms')} IS NOT NULL", f"{name('emp')} IS NOT NULL"],
+        )
+    # sums of missing counts are 0 (as pandas)
+    sql = sql_select(
+        {**{var: name(var) for var in keys}, **{var: f"coalesce(sum({name(var)}), 0)" for var in BDS_COUNTS}},
+        f"({rows})", where=[f"{name(var)} IS NOT NULL" for var in keys], group=keys,
+        )
+    return sql, cube_id
+
+
+def sql_clean(cube, id_var, config):
+    """
+    sql_clean panel of one level of a cube (see data_clean)
+    Args:
+        cube [str]: counts cube
+        id_var [lst]: id variables (sector, age_coarse, and large_firm)
+        config [dict]: config
+    Return:
+        query, columns
+    """
+    keys = ["year"] + id_var
+    columns = {**{var: name(var) for var in keys}, **{var: f"sum({name(var)})" for var in BDS_COUNTS}}
+    sql = sql_select(columns, cube, group=keys) + f" HAVING sum({name('firms')}) > 0 AND sum({name('emp')}) > 0"
+
+    # rates
+    columns = {var: name(var) for var in columns}
+    rates = {
+        "estabs_entry_rate": ("estabs_entry", "estabs"), "estabs_exit_rate": ("estabs_exit", "estabs"),
+        "job_creation_rate": ("job_creation", "denom"), "job_destruction_rate": ("job_destruction", "denom"),
+        "net_job_creation_rate": ("net_job_creation", "denom"),
+        }
+    columns.update({var: f"{name(num)} / {name(den)}" for var, (num, den) in rates.items()})
+    sql = sql_select(columns, f"({sql})")
+
+    columns = {var: name(var) for var in columns}
+    creation, destruction = name("job_creation_rate"), name("job_destruction_rate")
+    columns["reallocation_rate"] = f"{creation} + {destruction} - abs({creation} - {destruction})"
+    columns["death"] = name("firmdeath_firms")
+    columns["log_emp"] = sql_log(name("emp"))
+    columns["log_avg_emp"] = f"{sql_log(name('emp'))} - {sql_log(name('firms'))}"
+    columns["death_rate"] = f"{name('firmdeath_firms')} / {name('firms')}"
+    for naics in range(2, 5):
+        columns[f"sector_{naics}"] = sql_naics(name("sector"), naics)
+    recode = " ".join(f"WHEN {code} THEN {new_code}" for code, new_code in NAICS_2_RECODE.items())
+    columns["sector_2"] = f"CASE {columns['sector_2']} {recode} ELSE {columns['sector_2']} END"
+    sql = sql_select(columns, f"({sql})")
+
+    # lags and changes by id group (see lag_variables)
+    lag_var = config["make_data"]["dep_var"] + ["death_rate", "log_avg_emp", "log_emp", "emp", "firms"]
+    columns = {var: name(var) for var in columns}
+    for var in lag_var:
+        for lags in range(0, config["make_data"]["n_lags"]):
+            if lags == 0:
+                columns[f"L_{lags}_{var}"] = name(var)
+            elif lags > 0:
+                columns[f"L_{lags}_{var}"] = f"lag({name(var)}, {lags}) OVER w"
+            else:
+                columns[f"L_{lags}_{var}"] = f"lead({name(var)}, {-lags}) OVER w"
+    for var in lag_var:
+        columns[f"{var}_chg"] = f"{name(var)} - lag({name(var)}, 1) OVER w"
+    window = f"PARTITION BY {', '.join(name(var) for var in id_var)} ORDER BY {name('year')}"
+    sql = sql_select(columns, f"({sql})", window=window)
+
+    return sql, list(columns)
+
+
+def sql_sector_entry(clean, id_var):
+    """
+    sql_sector_entry entry and incumbent firms (see data_sector_entry)
+    """
+    keys = ["year"] + id_var
+    entry = sql_select(
+        {**{var: name(var) for var in keys}, "entry": f"sum({name('firms')})"},
+        clean, where=[f"{name('age_coarse')} = '00'"], group=keys,
+        )
+    incumbents = sql_select(
+        {**{var: name(var) for var in keys}, "incumbents": f"sum({name('firms')})"},
+        clean, where=[f"{name('age_coarse')} != '00'"], group=keys,
+        )
+    on = " AND ".join(f"e.{name(var)} = i.{name(var)}" for var in keys)
+    return f"SELECT e.*, i.{name('incumbents')} FROM ({entry}) e LEFT JOIN ({incumbents}) i ON {on}"
+
+
+def sql_final(clean, clean_columns, regdata_var, entry, id_var, n_lags=3):
+    """
+    sql_final merge regulation, gdp and entry of the lag years (see data_final)
+    Args:
+        clean [str]: cleaned panel
+        clean_columns [lst]: columns of the cleaned panel
+        regdata_var [lst]: variables of the regdata table
+        entry [str]: entry table (see sql_sector_entry)
+        id_var [lst]: id variables
+        n_lags [int]: number of lag years to merge
+    Return:
+        query
+    """
+    merge_var = [var for var in id_var if var != "age_coarse"]
+    year = f"c.{name('year')}"
+    joins = []
+    new_cols = {}
+    for lags in range(0, n_lags):
+        r, g, e = f"r{lags}", f"g{lags}", f"e{lags}"
+        joins += [
+            f"LEFT JOIN regdata {r} ON {r}.{name('year')} = {year} - {lags} AND {r}.{name('sector_reg')} = c.{name('sector_2')}",
+            f"LEFT JOIN gdp {g} ON {g}.{name('year')} = {year} - {lags} AND {g}.{name('sector_2')} = c.{name('sector_2')}",
+            f"LEFT JOIN {entry} {e} ON {e}.{name('year')} = {year} - {lags} AND "
+            + " AND ".join(f"{e}.{name(var)} = c.{name(var)}" for var in merge_var),
+            ]
+        new_cols[f"L_{lags}_year"] = f"CAST({year} - {lags} AS SMALLINT)"
+        new_cols.update({f"L_{lags}_{var}": f"{r}.{name(var)}" for var in regdata_var})
+        new_cols[f"L_{lags}_gdp"] = f"{g}.{name('gdp')}"
+        new_cols[f"L_{lags}_entry"] = f"{e}.{name('entry')}"
+        new_cols[f"L_{lags}_incumbents"] = f"{e}.{name('incumbents')}"
+        new_cols[f"L_{lags}_log_restriction_2_0"] = sql_log(f"{r}.{name('industry_restrictions_2_0')}")
+        new_cols[f"L_{lags}_log_gdp"] = sql_log(f"{g}.{name('gdp')}")
+        new_cols[f"L_{lags}_log_emp"] = sql_log(f"c.{name(f'L_{lags}_emp')}")
+        new_cols[f"L_{lags}_entry_rate"] = f"{e}.{name('entry')} / {e}.{name('incumbents')}"
+
+    # existing columns are replaced in place, the new ones are appended
+    columns = {var: new_cols.get(var, f"c.{name(var)}") for var in clean_columns}
+    columns.update({var: expr for var, expr in new_cols.items() if var not in columns})
+    sql = sql_select(columns, f"{clean} c " + " ".join(joins))
+
+    # final restrictions and change variables
+    columns = {var: name(var) for var in columns}
+    for lags in range(0, n_lags - 1):
+        pre = lags + 1
+        columns[f"L_{lags}_chg_log_restriction_2_0"] = f"{name(f'L_{lags}_log_restriction_2_0')} - {name(f'L_{pre}_log_restriction_2_0')}"
+        columns[f"L_{lags}_chg_bartik_iv"] = f"{name(f'L_{lags}_bartik_iv')} - {name(f'L_{pre}_bartik_iv')}"
+        columns[f"L_{lags}_chg_log_gdp"] = f"{name(f'L_{lags}_log_gdp')} - {name(f'L_{pre}_log_gdp')}"
+        columns[f"L_{lags}_chg_log_emp"] = f"{name(f'L_{lags}_log_emp')} - {name(f'L_{pre}_emp')}"
+        columns[f"L_{lags}_chg_entry_rate"] = f"{name(f'L_{lags}_entry_rate')} - {name(f'L_{pre}_entry_rate')}"
+        columns[f"L_{lags}_emp_growth"] = (
+            f"2 * ({name(f'L_{lags}_emp')} - {name(f'L_{pre}_emp')}) / ({name(f'L_{lags}_emp')} + {name(f'L_{pre}_emp')})"
+            )
+    where = [
+        f"{name('L_0_incumbents')} > 30",
+        f"{name('sector_2')} IS DISTINCT FROM 11",
+        f"{name('sector_2')} IS DISTINCT FROM 92",
+        ]
+    sql = sql_select(columns, f"({sql})", where=where)
+
+    return sql_panel_types(columns, sql, ["year"] + id_var)
+
+
+def sql_patterns(clean, regdata_var):
+    """
+    sql_patterns aggregate data by year and 2 digit sector (see data_patterns)
+    Args:
+        clean [str]: cleaned sector-age panel
+        regdata_var [lst]: variables of the regdata table
+    Return:
+        query
+    """
+    keys = ["year", "sector_2"]
+    var_lst = ["death", "firms", "emp", "estabs", "estabs_entry", "estabs_exit", "job_creation", "job_destruction", "net_job_creation", "denom"]
+    agg = sql_select(
+        {**{var: name(var) for var in keys}, **{var: f"sum({name(var)})" for var in var_lst}}, clean, group=keys,
+        )
+    entry = sql_sector_entry(clean, ["sector_2"])
+
+    columns = {"sector_2": f"a.{name('sector_2')}", "year": f"a.{name('year')}"}
+    columns.update({var: f"a.{name(var)}" for var in var_lst})
+    columns.update({var: f"r.{name(var)}" for var in regdata_var})
+    columns.update({"gdp": f"g.{name('gdp')}", "entry": f"e.{name('entry')}", "incumbents": f"e.{name('incumbents')}"})
+    rates = {
+        "entry_rate": ("entry", "firms"), "death_rate": ("death", "firms"),
+        "estabs_entry_rate": ("estabs_entry", "estabs"), "estabs_exit_rate": ("estabs_exit", "estabs"),
+        "job_creation_rate": ("job_creation", "denom"), "job_destruction_rate": ("job_destruction", "denom"),
+        "net_job_creation_rate": ("net_job_creation", "denom"),
+        }
+    columns.update({var: f"{columns[num]} / {columns[den]}" for var, (num, den) in rates.items()})
+    source = (
+        f"({agg}) a "
+        f"LEFT JOIN regdata r ON r.{name('sector_reg')} = a.{name('sector_2')} AND r.{name('year')} = a.{name('year')} "
+        f"LEFT JOIN gdp g ON g.{name('sector_2')} = a.{name('sector_2')} AND g.{name('year')} = a.{name('year')} "
+        f"LEFT JOIN ({entry}) e ON e.{name('sector_2')} = a.{name('sector_2')} AND e.{name('year')} = a.{name('year')}"
+        )
+    return sql_panel_types(columns, sql_select(columns, source), keys)
+
+
+def panels_duckdb(config, regdata, gdp, cleaned_data_path):
+    """
+    panels_duckdb build and store the panels and the aggregate pattern data with DuckDB
+        - the BDS files are scanned by the queries, only the counts cubes are
+          kept as tables (smaller than the raw files)
+        - regdata and gdp (small) are registered pandas tables
+    Args:
+        config [dict]: config
+        regdata [DataFrame]: regulation and shift share instrument (see data_regdata)
+        gdp [DataFrame]: gdp by sector and year
+        cleaned_data_path [Path]: directory of the panels
+    Return:
+        dictionary of {panel: rows}
+    """
+    if config["make_data"]["storage_format"] != "parquet":
+        raise ValueError("panels_duckdb: the duckdb backend stores the panels as parquet (storage_format)")
+
+    con = connect(config)
+    con.register("regdata", regdata)
+    con.register("gdp", gdp)
+    regdata_var = [var for var in regdata.columns if var not in ["year", "sector_reg"]]
+    n_lags = config["make_data"]["n_lags"]
+    data_file_path = Path(config["make_data"]["data_file_path"])
+
+    # counts cubes (see data_cube)
+    cube_id = {}
+    for table, path, source, id_var, sector_dig in [
+        ("cube_ag", "bds_naics_4_path", "bds_naics_4", ["sector", "fage"], 4),
+        ("cube_sz_ag", "bds_sector_size", "bds_sector_size", ["sector", "fsize", "fage"], 2),
+        ]:
+        raw = sql_raw(data_file_path/config["make_data"][path], source, ["year"] + id_var)
+        with stage("data_cube", table) as record:
+            sql, cube_id[table] = sql_cube(raw, id_var, sector_dig, config)
+            con.execute(f"CREATE TEMP TABLE {table} AS {sql}")
+            record["rows"] = con.execute(f"SELECT count(*) FROM {table}").fetchone()[0]
+
+    # panels of each level (see data_clean), entry (see data_sector_entry)
+    clean_id = {
+        "clean_sec": ("cube_ag", ["sector"]),
+        "clean_sec_ag": ("cube_ag", ["sector", "age_coarse"]),
+        "clean_sec_sz": ("cube_sz_ag", ["sector", "large_firm"]),
+        "clean_sec_sz_ag": ("cube_sz_ag", ["sector", "age_coarse", "large_firm"]),
+        }
+    clean_columns = {}
+    for view, (cube, id_var) in clean_id.items():
+        sql, clean_columns[view] = sql_clean(cube, id_var, config)
+        con.execute(f"CREATE TEMP VIEW {view} AS {sql}")
+    con.execute(f"CREATE TEMP VIEW entry_4 AS {sql_sector_entry('clean_sec_ag', ['sector'])}")
+    con.execute(f"CREATE TEMP VIEW entry_sz_2 AS {sql_sector_entry('clean_sec_sz_ag', ['sector', 'large_firm'])}")
+
+    # final panels (see data_final) and aggregate data (see data_patterns)
+    panels = {
+        "sector_panel": sql_final("clean_sec", clean_columns["clean_sec"], regdata_var, "entry_4", ["sector"], n_lags),
+        "sector_size_panel": sql_final(
+            "clean_sec_sz", clean_columns["clean_sec_sz"], regdata_var, "entry_sz_2", ["sector", "large_firm"], n_lags,
+            ),
+        "sector_age_panel": sql_final(
+            "clean_sec_ag", clean_columns["clean_sec_ag"], regdata_var, "entry_4", ["sector", "age_coarse"], n_lags,
+            ),
+        "sector_age_size_panel": sql_final(
+            "clean_sec_sz_ag", clean_columns["clean_sec_sz_ag"], regdata_var, "entry_sz_2",
+            ["sector", "large_firm", "age_coarse"], n_lags,
+            ),
+        "agg_pattern": sql_patterns("clean_sec_ag", regdata_var),
+        }
+    rows = {}
+    for panel, sql in panels.items():
+        path = Path.cwd()/cleaned_data_path/f"{panel}.parquet"
+        with stage("panels_duckdb", panel) as record:
+            rows[panel] = con.execute(
+                f"COPY ({sql}) TO {literal(str(path))} (FORMAT parquet, COMPRESSION zstd, ROW_GROUP_SIZE 50000)"
+                ).fetchone()[0]
+            record["rows"], record["cols"] = rows[panel], len(con.execute(f"DESCRIBE ({sql})").fetchall())
+    con.close()
+
+    return rows
+
+
+@profiled
+def regdata_duckdb(config):
+    """
+    regdata_duckdb regulation and shift share instrument with DuckDB (see data_regdata)
+        - sums by year, industry and unit of the document x industry join
+          (see data_regdata_sums), kept as a table
+        - initial shares of the baseline years, leave one out log restrictions
+          and bartik_iv (see bartik_instrument)
+    Args:
+        config [dict]: config
+    Returns:
+        Reg data, initial shares (ShareMatrix)
+    """
+    config_make = config["make_data"]
+    mode = config_make["bartik_mode"]
+    unit = BARTIK_UNIT[mode]
+    data_file_path = Path(config_make["data_file_path"])
+    con = connect(config)
+
+    # documents (first row of each document_id) and their year
+    doc = sql_raw(data_file_path/config_make["regdata_doc_path"], "regdata_doc", ["document_id"])
+    doc = sql_select({
+        "document_id": name("document_id"), "year": f"TRY_CAST(left({name('date')}, 4) AS BIGINT)",
+        unit: name(unit), "restrictions_2_0": name("restrictions_2_0"),
+        }, f"({doc})")
+    ind = sql_raw(data_file_path/config_make["regdata_ind_path"], "regdata_ind")
+
+    # sums by year, industry and unit (documents without year or unit are dropped)
+    keys = ["year", "industry", unit]
+    merge = sql_select(
+        {
+            "year": f"d.{name('year')}", "industry": f"i.{name('industry')}", unit: f"d.{name(unit)}",
+            "reg_s_d": f"coalesce(sum(i.{name('probability')} * d.{name('restrictions_2_0')}), 0)",
+            "restrictions_2_0": f"coalesce(sum(d.{name('restrictions_2_0')}), 0)",
+            },
+        f"({ind}) i JOIN ({doc}) d ON i.{name('document_id')} = d.{name('document_id')}",
+        where=[f"d.{name(var)} IS NOT NULL" for var in ["year", unit]] + [f"i.{name('industry')} IS NOT NULL"],
+        group=keys,
+        )
+    with stage("data_regdata_sums", unit) as record:
+        con.execute(f"CREATE TEMP TABLE regdata_sums AS {merge}")
+        record["rows"] = con.execute("SELECT count(*) FROM regdata_sums").fetchone()[0]
+
+    # initial shares (pooled over the baseline years, only non-zero shares)
+    years = ", ".join(literal(year) for year in config_make["bartik_baseline_years"])
+    init = sql_select(
+        {"industry": name("industry"), unit: name(unit), "reg_s_d": f"sum({name('reg_s_d')})"},
+        "regdata_sums", where=[f"{name('year')} IN ({years})"], group=["industry", unit],
+        )
+    share = (
+        f"SELECT {name('industry')}, {name(unit)}, CASE WHEN {name('reg_s_d')} > 0 THEN {name('reg_s_d')} / "
+        f"sum({name('reg_s_d')}) OVER (PARTITION BY {name('industry')}) ELSE 0 END AS {name('share_init')} FROM ({init})"
+        )
+    con.execute(f"CREATE TEMP TABLE share AS {share}")
+    df_init = con.execute(f"SELECT * FROM share ORDER BY {name('industry')}, {name(unit)}").df()
+    df_share = ShareMatrix.from_frame(df_init, unit)
+
+    # log restrictions of the unit (leave the industry out in mode 1), 0 if missing (-inf is kept, see bartik_instrument)
+    restrictions = f"m.{name('restrictions_2_0')}"
+    log_reg_d = sql_log(f"{restrictions} - m.{name('reg_s_d')}" if mode == 1 else restrictions)
+    log_one_out = f"CASE WHEN {restrictions} > 0 AND NOT isnan({log_reg_d}) THEN {log_reg_d} ELSE 0 END"
+    iv = sql_select(
+        {"year": f"m.{name('year')}", "industry": f"m.{name('industry')}", "bartik_iv": f"sum(s.{name('share_init')} * {log_one_out})"},
+        f"regdata_sums m JOIN share s ON s.{name('industry')} = m.{name('industry')} AND s.{name(unit)} = m.{name(unit)}",
+        where=[f"s.{name('share_init')} != 0"], group=["year", "industry"],
+        )
+
+    # aggregate data by year and industry
+    regdata = sql_select(
+        {"year": name("year"), "industry": name("industry"), "industry_restrictions_2_0": f"sum({name('reg_s_d')})"},
+        "regdata_sums", group=["year", "industry"],
+        )
+    regdata = (
+        f"SELECT r.{name('year')}, r.{name('industry')} AS {name('sector_reg')}, r.{name('industry_restrictions_2_0')}, "
+        f"coalesce(iv.{name('bartik_iv')}, 0) AS {name('bartik_iv')} FROM ({regdata}) r "
+        f"LEFT JOIN ({iv}) iv ON iv.{name('year')} = r.{name('year')} AND iv.{name('industry')} = r.{name('industry')} "
+        f"ORDER BY r.{name('year')}, r.{name('industry')}"
+        )
+    regdata = con.execute(regdata).df()
+    con.close()
+
+    return regdata, df_share
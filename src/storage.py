@@ -0,0 +1,241 @@
+"""
+This script load the raw files and store and load the cleaned panels
+(Parquet, Feather, HDF or CSV)
+"""
+
+import operator
+from pathlib import Path
+import pandas as pd
+
+from Src.profiling import profiled
+
+# explicit types of the id variables (other columns keep their types)
+PANEL_DTYPES = {
+    "year": "int16",
+    "sector": "int32",
+    "sector_2": "int16",
+    "sector_3": "int16",
+    "sector_4": "int32",
+    "large_firm": "int8",
+    "age_coarse": "category",
+}
+
+# additive BDS measures (suppressed cells are missing)
+BDS_COUNTS = [
+    'firms', 'estabs', 'emp', 'denom',
+    'estabs_entry', 'estabs_exit', 'job_creation',
+    'job_creation_births', 'job_creation_continuers',
+    'job_destruction', 'job_destruction_deaths',
+    'job_destruction_continuers', 'job_destruction_rate_deaths',
+    'net_job_creation', 'firmdeath_firms', 'firmdeath_estabs',
+    'firmdeath_emp'
+    ]
+BDS_NA_VALUES = ["(D)", "(S)", "(X)", "(N)"]
+
+# columns read from each raw file and their types
+#   - counts stay float64: sums must be exact (cells can exceed the float32 integer range)
+#   - columns without a type are inferred
+RAW_SCHEMAS = {
+    "bds_naics_4": {
+        "year": "int16", "sector": "int32", "fage": "category",
+        **{var: "float64" for var in BDS_COUNTS},
+        },
+    "bds_sector_size": {
+        "year": "int16", "sector": "category", "fage": "category", "fsize": "category",
+        **{var: "float64" for var in BDS_COUNTS},
+        },
+    "regdata_origin": {
+        "year": "int16", "NAICS": "int32",
+        "industry_restrictions_1_0": "float64", "industry_restrictions_2_0": "float64",
+        },
+    "regdata_doc": {
+        "document_id": "int64", "date": "str", "agency": "category",
+        "document_reference": None, "restrictions_2_0": "float64",
+        },
+    "regdata_ind": {
+        "document_id": "int64", "industry": "int32", "probability": "float64",
+        },
+    "gdp": {
+        "sector_2": "int32",
+        },
+}
+
+OPERATORS = {
+    "==": operator.eq, "=": operator.eq, "!=": operator.ne,
+    ">": operator.gt, ">=": operator.ge, "<": operator.lt, "<=": operator.le,
+}
+
+FORMATS = {".parquet": "parquet", ".feather": "feather", ".h5": "hdf", ".csv": "csv"}
+
+
+def panel_dtypes(df):
+    """
+    panel_dtypes cast the id variables to compact types
+        - integer sector and year codes, categorical age groups
+    Args:
+        df [DataFrame]: cleaned panel
+    Return:
+        DataFrame with the types of PANEL_DTYPES
+    """
+    dtypes = {}
+    for var, dtype in PANEL_DTYPES.items():
+        if var not in df.columns:
+            continue
+        # integer codes only if nothing is missing
+        if dtype.startswith("int") and df[var].isna().any():
+            continue
+        dtypes[var] = dtype
+
+    return df.astype(dtypes)
+
+
+def uniform_objects(df):
+    """
+    uniform_objects one type per object column (raw csv columns can mix str and int)
+        - mixed columns are converted to str, missing values are kept
+        - applied when the raw files are loaded, so the stages get the same
+          frames in this process and in the worker processes (see share_frames)
+    Args:
+        df [DataFrame]: raw data
+    Return:
+        DataFrame
+    """
+    for var in df.columns[df.dtypes == object]:
+        if pd.api.types.infer_dtype(df[var], skipna=True) not in ["string", "empty"]:
+            df[var] = df[var].where(df[var].isna(), df[var].astype(str))
+    return df
+
+
+def read_raw(path, source, engine="pyarrow", **kwargs):
+    """
+    read_raw load a raw csv file with its schema
+        - only the columns of the schema are read (except for wide files
+          whose schema only types the id columns, eg: gdp)
+        - the types are applied while parsing, BDS suppression flags are missing
+        - object columns have one type (see uniform_objects)
+    Args:
+        path [Path]: file path
+        source [str]: name of the schema (see RAW_SCHEMAS)
+        engine [str]: read_csv engine ("c" if reading in chunks)
+        kwargs: other arguments of read_csv
+    Return:
+        DataFrame (or chunk iterator)
+    """
+    schema = RAW_SCHEMAS[source]
+    dtype = {var: dtype for var, dtype in schema.items() if dtype is not None}
+    usecols = None if source == "gdp" else list(schema)
+    df = pd.read_csv(
+        path, engine=engine, usecols=usecols, dtype=dtype, na_values=BDS_NA_VALUES, **kwargs
+        )
+    if kwargs.get("chunksize"):
+        return (uniform_objects(chunk) for chunk in df)
+    return uniform_objects(df)
+
+
+@profiled
+def write_panel(df, path, compression="zstd", row_group_size=50_000):
+    """
+    write_panel store a cleaned panel, the format is given by the file suffix
+    Args:
+        df [DataFrame]: cleaned panel
+        path [Path]: file path (.parquet, .feather, .h5 or .csv)
+        compression [str]: compression codec for Parquet and Feather
+        row_group_size [int]: rows per Parquet row group (unit of predicate pushdown)
+    Return:
+        None
+    """
+    path = Path(path)
+    fmt = FORMATS[path.suffix]
+    if fmt in ["parquet", "feather"]:
+        df = panel_dtypes(df).reset_index(drop=True)
+
+    if fmt == "parquet":
+        df.to_parquet(path, compression=compression, row_group_size=row_group_size, index=False)
+    elif fmt == "feather":
+        df.to_feather(path, compression=compression)
+    elif fmt == "hdf":
+        # table format: read_panel can select columns
+        df.to_hdf(path, key="data", mode="w", format="table")
+    else:
+        df.to_csv(path)
+
+    return None
+
+
+def panel_columns(path):
+    """
+    panel_columns columns of a cleaned panel
+        - Parquet and Feather: read from the schema (no data is loaded)
+        - HDF and CSV: read with no rows
+    Args:
+        path [Path]: file path (.parquet, .feather, .h5 or .csv)
+    Return:
+        list of columns
+    """
+    path = Path(path)
+    if path.suffix not in FORMATS:
+        raise ValueError(f"panel_columns: unknown panel format {path.suffix} of {path} (.parquet, .feather, .h5 or .csv)")
+    fmt = FORMATS[path.suffix]
+
+    if fmt in ["parquet", "feather"]:
+        import pyarrow.dataset as ds
+        return ds.dataset(path, format=fmt).schema.names
+    if fmt == "hdf":
+        return list(pd.read_hdf(path, key="data", stop=0).columns)
+    return list(pd.read_csv(path, index_col=0, nrows=0).columns)
+
+
+@profiled
+def read_panel(path, columns=None, filters=None):
+    """
+    read_panel load a cleaned panel
+        - Parquet and Feather only read the selected columns (projection)
+          and apply the filters while scanning (predicate pushdown)
+        - HDF (table format) only reads the selected columns and the filter
+          columns, CSV is loaded, both are filtered and selected after loading
+    Args:
+        path [Path]: file path (.parquet, .feather, .h5 or .csv)
+        columns [lst]: columns to load (all if None)
+        filters [lst]: list of (column, op, value) conditions, eg: [("year", ">", 1985)]
+    Return:
+        DataFrame
+    """
+    path = Path(path)
+    fmt = FORMATS[path.suffix]
+
+    if fmt in ["parquet", "feather"]:
+        import pyarrow.dataset as ds
+        import pyarrow.parquet as pq
+        dataset = ds.dataset(path, format=fmt)
+        expression = pq.filters_to_expression(filters) if filters else None
+        table = dataset.to_table(columns=columns, filter=expression)
+        df = table.to_pandas()
+        # categorical id variables stored as strings (eg: by the duckdb backend)
+        category = [
+            var for var, dtype in PANEL_DTYPES.items()
+            if dtype == "category" and var in df.columns and df[var].dtype == object
+            ]
+        return df.astype({var: "category" for var in category})
+
+    if fmt == "hdf":
+        # fixed format stores (written before the table format) are loaded in full
+        with pd.HDFStore(path, mode="r") as store:
+            is_table = store.get_storer("data").is_table
+        read_columns = None
+        if columns is not None and is_table:
+            read_columns = list(dict.fromkeys(list(columns) + [var for var, _, _ in filters or []]))
+        df = pd.read_hdf(path, key="data", columns=read_columns)
+    else:
+        df = pd.read_csv(path, index_col=0)
+
+    for var, op, value in filters or []:
+        if op == "in":
+            df = df[df[var].isin(value)]
+        elif op == "not in":
+            df = df[~df[var].isin(value)]
+        else:
+            df = df[OPERATORS[op](df[var], value)]
+    if columns is not None:
+        df = df.loc[:, columns]
+
+    return df
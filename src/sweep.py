@@ -0,0 +1,318 @@
+"""
+This script run grids of model specifications (robustness sweeps) declared in the config file
+"""
+
+import hashlib
+import itertools
+import json
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import as_completed
+from pathlib import Path
+
+import click
+import numpy as np
+import pandas as pd
+
+from Src.utility import parse_config
+from Src.utility import set_logger
+from Src.storage import read_panel
+from Src.storage import panel_columns
+from Src.estimators import DesignCache
+from Src.cache import file_digest
+from Src.profiling import profiled
+from Src.profiling import RunReport
+
+# columns of the results table
+RESULT_COLUMNS = [
+    "spec_id", "panel", "group", "sample", "regressors", "fixed_effects", "se_type",
+    "outcome", "parameter", "coef", "std_error", "tstat", "pvalue",
+    "lower_ci", "upper_ci", "nobs", "error",
+    ]
+
+# source files whose changes invalidate the checkpoints
+CODE_FILES = ["sweep.py", "estimators.py"]
+
+# samples and designs of the fit tasks (in each worker process)
+PANELS = {}
+DESIGNS = DesignCache()
+
+
+def init_worker(design_cache_bytes=2**30):
+    """
+    init_worker clear the samples and designs of a worker process
+    (run once in each worker process)
+    Args:
+        design_cache_bytes [int]: memory limit of the design cache
+    Returns:
+        None
+    """
+    PANELS.clear()
+    DESIGNS.clear()
+    DESIGNS.max_bytes = design_cache_bytes
+
+
+def sweep_tasks(config):
+    """
+    sweep_tasks function that
+        - expand the grid of the sweep section: panels (and their groups)
+          x samples x regressor sets x fixed effects
+        - every task fits all outcomes and standard error types, so the
+          outcomes and standard errors of a task share the designs
+        - each task has a key (hash of the specification, the content of
+          the panel file and the source code) used to checkpoint its results
+    Args:
+        config [dict]: config file
+    Returns:
+        list of tasks (dictionaries)
+    """
+    config_sweep = config["sweep"]
+    code = [file_digest(Path(__file__).parent/file) for file in CODE_FILES]
+
+    tasks = []
+    for panel, group_var in config_sweep["panels"].items():
+        path = Path.cwd()/config["model"][f"{panel}_panel"]
+        digest = file_digest(path)
+        columns = panel_columns(path)
+        outcomes = [var for var in config_sweep["outcomes"] if var in columns]
+
+        # columns of the panel used by the grid (loaded once per sample)
+        panel_vars = [config_sweep["weights"], config_sweep["cluster"], group_var]
+        for var_sets in config_sweep["regressors"].values():
+            panel_vars += var_sets.get("exog", []) + var_sets.get("endog", []) + var_sets.get("instr", [])
+        for fe_vars in config_sweep["fixed_effects"].values():
+            panel_vars += [var for fe_var in fe_vars for var in ([fe_var] if isinstance(fe_var, str) else fe_var)]
+        for filters in config_sweep["samples"].values():
+            panel_vars += [var for var, _, _ in filters]
+        panel_vars = [var for var in dict.fromkeys(panel_vars + outcomes) if var in columns]
+
+        # groups of the panel (eg: each age group), fitted separately
+        groups = [None]
+        if group_var:
+            groups = sorted(read_panel(path, columns=[group_var])[group_var].dropna().unique())
+
+        grid = itertools.product(
+            groups, config_sweep["samples"].items(),
+            config_sweep["regressors"].items(), config_sweep["fixed_effects"].items(),
+            )
+        for group, (sample, filters), (regressors, var_lst), (fe_name, fe_vars) in grid:
+            task = {
+                "panel": panel, "path": str(path), "columns": panel_vars, "group_var": group_var,
+                "group": None if group is None else str(group),
+                "sample": str(sample), "filters": [list(condition) for condition in filters],
+                "regressors": regressors,
+                "exog": var_lst.get("exog", []), "endog": var_lst.get("endog", []),
+                "instr": var_lst.get("instr", []),
+                "fixed_effects": fe_name, "fe_vars": fe_vars,
+                "weights": config_sweep["weights"], "cluster": config_sweep["cluster"],
+                "se_types": config_sweep["se_types"], "outcomes": outcomes,
+                }
+            # the panel enters the key by its content (not its path and columns)
+            spec = {var: value for var, value in task.items() if var not in ["path", "columns"]}
+            text = json.dumps([spec, digest, code], sort_keys=True, default=str)
+            task["key"] = hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+            tasks.append(task)
+
+    return tasks
+
+
+def task_variables(task):
+    """
+    task_variables regressors, fixed effects, weights and cluster variables of a task
+    """
+    var_lst = task["exog"] + task["endog"] + task["instr"] + [task["weights"], task["cluster"]]
+    var_lst += [var for fe_var in task["fe_vars"] for var in ([fe_var] if isinstance(fe_var, str) else fe_var)]
+    return [var for var in dict.fromkeys(var_lst) if var is not None]
+
+
+def load_sample(task):
+    """
+    load_sample sample of a task, loaded once per panel and sample in each process
+        - only the columns of the grid are read, the sample filters are
+          applied while scanning the panel file
+    Args:
+        task [dict]: task (see sweep_tasks)
+    Returns:
+        DataFrame
+    """
+    key = (task["path"], task["sample"])
+    if key not in PANELS:
+        PANELS[key] = read_panel(
+            task["path"], columns=task["columns"],
+            filters=[tuple(condition) for condition in task["filters"]] or None,
+            )
+
+    df = PANELS[key]
+    if task["group_var"]:
+        df = df[df[task["group_var"]].astype(str) == task["group"]]
+    return df
+
+
+@profiled
+def fit_task(task):
+    """
+    fit_task fit every outcome and standard error type of one task
+        - outcomes with the same estimation sample share the design (see DesignCache)
+        - robust (HC0) and cluster robust standard errors of the same fit
+        - specifications that cannot be estimated (eg: regressors absorbed by
+          the fixed effects, singular matrices, variables not in the panel)
+          are reported in the error column
+    Args:
+        task [dict]: task (see sweep_tasks)
+    Returns:
+        DataFrame of results (columns of RESULT_COLUMNS)
+    """
+    data = load_sample(task)
+    group = "" if task["group"] is None else f"_{task['group']}"
+    spec = DESIGNS.spec(
+        f"{task['panel']}{group}", task["exog"], task["endog"], task["instr"],
+        weights=task["weights"], fe_vars=task["fe_vars"],
+        sample=task["sample"], sample_vars=[task["cluster"]],
+        )
+
+    rows = []
+    labels = {
+        "panel": task["panel"], "group": task["group"], "sample": task["sample"],
+        "regressors": task["regressors"], "fixed_effects": task["fixed_effects"],
+        }
+
+    # outcomes of each design
+    groups = {}
+    errors = {}
+    missing = [var for var in task_variables(task) if var not in data.columns]
+    for depend_var in task["outcomes"]:
+        if missing:
+            errors[depend_var] = f"variables not in the panel: {', '.join(missing)}"
+            continue
+        try:
+            design, mask = DESIGNS.design(data, spec, depend_var)
+        except (ValueError, np.linalg.LinAlgError) as error:
+            errors[depend_var] = str(error)
+            continue
+        groups.setdefault(id(design), (design, mask, []))[2].append(depend_var)
+
+    for design, mask, depend_group in groups.values():
+        y = data.loc[mask, depend_group]
+        for se_type in task["se_types"]:
+            clusters = data.loc[mask, task["cluster"]] if se_type == "clustered" else None
+            for depend_var, res in design.fit(y, clusters=clusters).items():
+                ci = res.conf_int()
+                for var in res.params.index:
+                    rows.append({
+                        **labels, "se_type": se_type, "outcome": depend_var, "parameter": var,
+                        "coef": res.params[var], "std_error": res.std_errors[var],
+                        "tstat": res.tstats[var], "pvalue": res.pvalues[var],
+                        "lower_ci": ci.loc[var, "lower"], "upper_ci": ci.loc[var, "upper"],
+                        "nobs": res.nobs, "error": None,
+                        })
+
+    for depend_var, error in errors.items():
+        for se_type in task["se_types"]:
+            rows.append({**labels, "se_type": se_type, "outcome": depend_var, "error": error})
+
+    df = pd.DataFrame(rows, columns=RESULT_COLUMNS)
+    df["spec_id"] = task["key"]
+    numeric = ["coef", "std_error", "tstat", "pvalue", "lower_ci", "upper_ci", "nobs"]
+    df[numeric] = df[numeric].astype("float64")
+    return df
+
+
+def run_task(task, checkpoint_path):
+    """
+    run_task fit a task and checkpoint its results
+    Args:
+        task [dict]: task (see sweep_tasks)
+        checkpoint_path [Path]: directory of the checkpoints
+    Returns:
+        key of the task
+    """
+    df = fit_task(task)
+    path = Path(checkpoint_path)/f"{task['key']}.parquet"
+    # write then rename: an interrupted write never looks like a finished task
+    df.to_parquet(path.with_suffix(".tmp"), index=False)
+    path.with_suffix(".tmp").replace(path)
+    return task["key"]
+
+
+def run_sweep(config, jobs=1, restart=False):
+    """
+    run_sweep function that
+        - expand the grid of specifications (see sweep_tasks)
+        - skip the tasks with a checkpoint (resume an interrupted sweep)
+        - fit the other tasks in a process pool with a progress bar
+        - collect the checkpoints of the grid in one tidy results table
+    Args:
+        config [dict]: config file
+        jobs [int]: number of worker processes
+        restart [bool]: ignore the checkpoints and fit every task
+    Returns:
+        DataFrame of results
+    """
+    results_path = Path.cwd()/config["sweep"]["results_path"]
+    checkpoint_path = results_path/"checkpoints"
+    checkpoint_path.mkdir(parents=True, exist_ok=True)
+    design_cache_bytes = config["model"]["design_cache_mb"] * 2**20
+
+    tasks = sweep_tasks(config)
+    todo = [
+        task for task in tasks
+        if restart or not (checkpoint_path/f"{task['key']}.parquet").exists()
+        ]
+    n_specs = sum(len(task["outcomes"]) * len(task["se_types"]) for task in tasks)
+    print(f"sweep: {len(tasks)} tasks ({n_specs} specifications), {len(tasks) - len(todo)} checkpointed")
+
+    # most expensive tasks first (panels split in groups are smaller)
+    todo.sort(key=lambda task: (task["group_var"] is not None, task["panel"], task["sample"]))
+    with click.progressbar(length=len(todo), label="fitting") as bar:
+        if jobs <= 1:
+            init_worker(design_cache_bytes)
+            for task in todo:
+                run_task(task, checkpoint_path)
+                bar.update(1)
+        else:
+            with ProcessPoolExecutor(
+                max_workers=jobs, initializer=init_worker, initargs=(design_cache_bytes,)
+                ) as executor:
+                futures = [executor.submit(run_task, task, checkpoint_path) for task in todo]
+                for future in as_completed(futures):
+                    future.result()
+                    bar.update(1)
+
+    df = pd.concat(
+        [pd.read_parquet(checkpoint_path/f"{task['key']}.parquet") for task in tasks],
+        ignore_index=True,
+        )
+    df.to_csv(results_path/"sweep_results.csv", index=False)
+    n_errors = df.loc[df.error.notna(), ["spec_id", "outcome"]].drop_duplicates().shape[0]
+    print(f"sweep: {len(df)} estimates, {n_errors} specifications failed, results in {results_path}")
+
+    return df
+
+
+@click.command()
+@click.argument("config_file", type=str, default="src/config.yaml")
+@click.option("--jobs", type=int, default=1, help="number of worker processes for the regressions")
+@click.option("--restart", is_flag=True, help="ignore the checkpoints of previous runs")
+@click.option("--profile", is_flag=True, help="add a cProfile dump to the run report")
+def sweep_output(config_file, jobs, restart, profile):
+    """
+    sweep_output function run the specification grid of the sweep section
+    Args:
+        config_file [str]: path to config file
+        jobs [int]: number of worker processes for the regressions
+        restart [bool]: ignore the checkpoints of previous runs
+        profile [bool]: add a cProfile dump to the run report
+    Returns:
+        None
+    """
+    print("loading config file")
+    config = parse_config(config_file)
+    report_path = Path.cwd()/config["sweep"]["report_path"]
+    logger = set_logger(report_path/"sweep.log")
+
+    # time, peak memory and size of every stage (see RunReport)
+    with RunReport("sweep", report_path, profile, logger):
+        run_sweep(config, jobs, restart)
+
+
+if __name__ == "__main__":
+    sweep_output()
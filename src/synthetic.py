@@ -0,0 +1,160 @@
+"""
+This script generate synthetic BDS, RegData and GDP files with the schemas of
+the raw data (used by the benchmarks, the real data are not in the repository)
+"""
+
+from pathlib import Path
+import pandas as pd
+import numpy as np
+
+FAGE = [
+    "a) 0", "b) 1", "c) 2", "d) 3", "e) 4", "f) 5", "g) 6 to 10", "h) 11 to 15",
+    "i) 16 to 20", "j) 21 to 25", "k) 26+", "l) Left Censored",
+    ]
+FSIZE = [
+    "a) 1 to 4", "b) 5 to 9", "c) 10 to 19", "d) 20 to 99", "e) 100 to 499",
+    "f) 500 to 999", "g) 1000 to 2499", "h) 2500 to 4999", "i) 5000 to 9999", "j) 10000+",
+    ]
+SECTORS = [
+    "11", "21", "22", "23", "31-33", "42", "44-45", "48-49", "51",
+    "52", "53", "54", "56", "61", "62", "71", "72", "81",
+    ]
+RATES = [
+    "job_creation_rate", "net_job_creation_rate", "job_destruction_rate",
+    "estabs_exit_rate", "estabs_entry_rate", "reallocation_rate",
+    ]
+
+
+def bds_counts(rng, n):
+    """
+    bds_counts random BDS measures of n rows
+    Args:
+        rng [Generator]: random number generator
+        n [int]: number of rows
+    Return:
+        dictionary of columns
+    """
+    firms = rng.integers(0, 3000, n)
+    emp = firms * rng.integers(1, 50, n)
+    counts = {
+        "firms": firms, "estabs": firms + rng.integers(0, 200, n),
+        "emp": emp, "denom": emp + rng.integers(0, 100, n),
+        "estabs_entry": rng.integers(0, 100, n), "estabs_exit": rng.integers(0, 100, n),
+        "job_creation": rng.integers(0, 1000, n), "job_creation_births": rng.integers(0, 500, n),
+        "job_creation_continuers": rng.integers(0, 500, n), "job_destruction": rng.integers(0, 1000, n),
+        "job_destruction_deaths": rng.integers(0, 500, n), "job_destruction_continuers": rng.integers(0, 500, n),
+        "job_destruction_rate_deaths": rng.random(n), "firmdeath_firms": rng.integers(0, 100, n),
+        "firmdeath_estabs": rng.integers(0, 100, n), "firmdeath_emp": rng.integers(0, 1000, n),
+        }
+    counts["net_job_creation"] = counts["job_creation"] - counts["job_destruction"]
+    for var in RATES:
+        counts[var] = rng.random(n)
+    return counts
+
+
+def bds_table(rng, index, suppressed=0.02):
+    """
+    bds_table BDS table of an index (year, sector, fage[, fsize]) with suppressed cells
+    """
+    df = pd.concat([index, pd.DataFrame(bds_counts(rng, len(index)))], axis=1)
+    df[["emp", "job_creation"]] = df[["emp", "job_creation"]].astype(object)
+    df.loc[rng.random(len(df)) < suppressed, "emp"] = "(D)"
+    df.loc[rng.random(len(df)) < suppressed / 2, "job_creation"] = "(S)"
+    return df
+
+
+def synthetic_sectors(scale):
+    """
+    synthetic_sectors 2 digit sectors and 4 digit industries of a scale
+        - scale 1: the BDS sectors with 3 industries each
+        - larger scales add 2 digit codes (up to all unused codes) and
+          industries of each sector
+    Args:
+        scale [int]: size multiple
+    Return:
+        2 digit sectors, 4 digit industries
+    """
+    used = {int(sector[:2]) for sector in SECTORS} | {32, 33, 45, 49}
+    sectors = SECTORS + [str(code) for code in range(10, 100) if code not in used]
+    sectors = sectors[:len(SECTORS) * scale]
+    industries = [f"{sector[:2]}{code:02d}" for code in range(1, 100) for sector in sectors]
+    return sectors, industries[:3 * len(SECTORS) * scale]
+
+
+def synthetic_data(data_dir, config, scale=1, years=range(1978, 2020), seed=0):
+    """
+    synthetic_data write synthetic raw files with the schemas of data_load and data_regdata
+        - BDS sector (4 digit) x fage and sector (2 digit) x fsize x fage tables
+        - RegData industries, documents and industry probabilities
+        - BEA GDP by 2 digit sector
+    Args:
+        data_dir [Path]: directory of the raw files (data_file_path)
+        config [dict]: config (file paths of the make_data section)
+        scale [int]: size multiple (1, 10, 100, ...)
+        years [range]: years of the data
+        seed [int]: random seed
+    Return:
+        dictionary of {file: rows}
+    """
+    rng = np.random.default_rng(seed)
+    data_dir = Path(data_dir)
+    paths = {
+        var: data_dir/config["make_data"][var]
+        for var in [
+            "regdata_origin_path", "regdata_doc_path", "regdata_ind_path",
+            "bds_naics_4_path", "bds_sector_size", "gdp_path",
+            ]
+        }
+    for path in paths.values():
+        path.parent.mkdir(parents=True, exist_ok=True)
+    years = list(years)
+    sectors, industries = synthetic_sectors(scale)
+    sector_codes = sorted({int(sector[:2]) for sector in sectors} | {32, 33, 45, 49, 92})
+    rows = {}
+
+    # BDS tables
+    index = pd.MultiIndex.from_product([years, industries, FAGE], names=["year", "sector", "fage"])
+    df = bds_table(rng, index.to_frame(index=False))
+    df.to_csv(paths["bds_naics_4_path"], index=False)
+    rows["bds_naics_4_path"] = len(df)
+
+    index = pd.MultiIndex.from_product([years, sectors, FAGE, FSIZE], names=["year", "sector", "fage", "fsize"])
+    df = bds_table(rng, index.to_frame(index=False))
+    df.to_csv(paths["bds_sector_size"], index=False)
+    rows["bds_sector_size"] = len(df)
+
+    # GDP (years in columns)
+    df = pd.DataFrame({"sector_2": sorted({int(sector[:2]) for sector in sectors})})
+    df = pd.concat([df, pd.DataFrame(rng.random((len(df), len(years))) * 1e5, columns=[str(year) for year in years])], axis=1)
+    df.to_csv(paths["gdp_path"], index=False)
+    rows["gdp_path"] = len(df)
+
+    # RegData industries
+    df = pd.MultiIndex.from_product([years, sector_codes], names=["year", "NAICS"]).to_frame(index=False)
+    df["industry_restrictions_1_0"] = rng.random(len(df))
+    df["industry_restrictions_2_0"] = rng.random(len(df))
+    df.to_csv(paths["regdata_origin_path"], index=False)
+    rows["regdata_origin_path"] = len(df)
+
+    # RegData documents (baseline year always present, a few duplicated documents)
+    n_doc = 3000 * scale
+    df_doc = pd.DataFrame({
+        "document_id": np.arange(n_doc),
+        "date": [f"{year}-01-01" for year in rng.choice(years, n_doc)],
+        "agency": rng.choice([f"agency_{i}" for i in range(40)], n_doc),
+        "document_reference": rng.integers(0, 500 * scale, n_doc),
+        "restrictions_2_0": rng.integers(1, 500, n_doc),
+        })
+    df_doc.loc[0, "date"] = f"{config['make_data']['bartik_baseline_years'][0]}-01-01"
+    df_doc = pd.concat([df_doc, df_doc.iloc[:5]])
+    df_doc.to_csv(paths["regdata_doc_path"], index=False)
+    rows["regdata_doc_path"] = len(df_doc)
+
+    # RegData industry probabilities (half of the document x industry pairs)
+    df = pd.MultiIndex.from_product([np.arange(n_doc), sector_codes], names=["document_id", "industry"]).to_frame(index=False)
+    df = df[rng.random(len(df)) < 0.5].reset_index(drop=True)
+    df["probability"] = rng.random(len(df))
+    df.to_csv(paths["regdata_ind_path"], index=False)
+    rows["regdata_ind_path"] = len(df)
+
+    return rows
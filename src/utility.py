@@ -1,15 +1,14 @@
 import logging
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-from matplotlib.ticker import MaxNLocator
-from matplotlib import gridspec
-import yaml
-import copy
+
+from Src.profiling import profiled
 
 
 def parse_config(config_file):
+    import yaml
     file_path = Path.cwd() / config_file
     with open(file_path, "r") as f:
         config = yaml.safe_load(f)
@@ -35,6 +34,69 @@ def set_logger(log_path):
     logger.info(f"Finished logger configuration!")
     return logger
 
+def run_tasks(func, tasks, jobs=1, initializer=None, initargs=()):
+    """
+    run_tasks run func(*task) for every task, in a process pool if jobs > 1
+    Args:
+        func [function]: module level function to run
+        tasks [lst]: list of argument tuples
+        jobs [int]: number of worker processes
+        initializer [function]: run once in each worker (or here if jobs == 1)
+        initargs [tuple]: arguments of initializer
+    Return:
+        list of results in the order of tasks
+    """
+    if jobs <= 1 or len(tasks) <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        return [func(*task) for task in tasks]
+    
+    with ProcessPoolExecutor(
+        max_workers=min(jobs, len(tasks)), initializer=initializer, initargs=initargs
+        ) as executor:
+        futures = [executor.submit(func, *task) for task in tasks]
+        return [future.result() for future in futures]
+
+
+def share_frames(frames, shared_dir):
+    """
+    share_frames write dataframes to uncompressed Feather files that
+    worker processes memory-map (see load_shared) instead of unpickling copies
+    Args:
+        frames [dict]: {name: DataFrame}
+        shared_dir [Path]: directory for the shared files
+    Return:
+        dictionary of {name: Path}
+    """
+    paths = {}
+    for name, df in frames.items():
+        # object columns have one type since the raw files are loaded (see storage.uniform_objects)
+        df = df.reset_index(drop=True)
+        path = Path(shared_dir)/f"{name}.feather"
+        df.to_feather(path, compression="uncompressed")
+        paths[name] = path
+    
+    return paths
+
+
+def load_shared(df):
+    """
+    load_shared load a dataframe shared by share_frames
+    Args:
+        df [Path or DataFrame]: shared file (or a dataframe, returned as it is)
+    Return:
+        DataFrame
+    """
+    if isinstance(df, pd.DataFrame):
+        return df
+    
+    import pyarrow.feather as feather
+
+    table = feather.read_table(df, memory_map=True)
+    return table.to_pandas(split_blocks=True)
+
+
+@profiled
 def lag_variable(df, time_var, id_var, var, lags):
     """
     lag_variable create lag variables by groups   
@@ -46,85 +108,183 @@ def lag_variable(df, time_var, id_var, var, lags):
         lags: number of lags (1 means one lag)
     """
 
+    return lag_variables(df, time_var, id_var, var[:1], [lags])
+
+
+@profiled
+def lag_variables(df, time_var, id_var, var_lst, lags_lst, change=False):
+    """
+    lag_variables create all lag variables by groups in one pass
+        - sort the panel and factorize the id variables once
+        - shift every variable by position within each id group
+        - L_{lags}_{var} (and {var}_chg = var - L_1_{var}) as in lag_variable
+    Args:
+        df [DataFrame]: dataframe
+        time_var [lst]: time variable
+        id_var [list of string]: id variable
+        var_lst [lst]: lagged variables
+        lags_lst [lst]: numbers of lags (negative numbers give leads)
+        change [bool]: also create the {var}_chg variables
+    Return:
+        dataframe sorted by time and id variables with the new columns
+    """
     index_var = time_var + id_var
     df = df.sort_values(by=index_var)
-    df = df.set_index(index_var)
-    df_shift = df[var]
-    
-    shifted = df_shift.groupby(level=id_var).shift(lags)
-    shifted = shifted.rename(columns={var[0]: f"L_{lags}_{var[0]}"})
-    df = df.join(shifted)
-    df = df.reset_index()
-    
+    df = df[index_var + [col for col in df.columns if col not in index_var]]
+    df = df.reset_index(drop=True)
+
+    # position of each row within its id group (ordered by time)
+    group = df.groupby(id_var, sort=False).ngroup().to_numpy()
+    order = np.lexsort((np.arange(len(df)), group))
+    group_sorted = group[order]
+
+    # rows whose shifted position stays in the same id group
+    valid = {}
+    for lags in lags_lst:
+        if lags == 0:
+            continue
+        same = np.zeros(len(df), dtype=bool)
+        if lags > 0:
+            same[lags:] = group_sorted[lags:] == group_sorted[:-lags]
+        else:
+            same[:lags] = group_sorted[:lags] == group_sorted[-lags:]
+        valid[lags] = same
+
+    new_cols = {}
+    for var in var_lst:
+        values = df[var].to_numpy()
+        if values.dtype.kind in "iub":
+            values_lag = values.astype(np.float64)
+        else:
+            values_lag = values
+        values_sorted = values_lag[order]
+        for lags in lags_lst:
+            if lags == 0:
+                new_cols[f"L_{lags}_{var}"] = values.copy()
+                continue
+            shifted = np.full(len(df), np.nan, dtype=values_sorted.dtype)
+            source = np.roll(values_sorted, lags)
+            shifted[valid[lags]] = source[valid[lags]]
+            lagged = np.empty_like(shifted)
+            lagged[order] = shifted
+            new_cols[f"L_{lags}_{var}"] = lagged
+
+    if change:
+        for var in var_lst:
+            new_cols[f"{var}_chg"] = df[var].to_numpy() - new_cols[f"L_1_{var}"]
+
+    df_new = pd.DataFrame(new_cols, index=df.index)
+    df = pd.concat([df.drop(columns=df_new.columns, errors="ignore"), df_new], axis=1)
+
     return df
 
-def coef_dict(depend_var, v_name, res, ceof_dict, age):
+@profiled
+def lag_lookup(df, table, time_var, left_on, right_on, lags_lst):
     """
-    coef_dict create dictionary of estimates and C.I. for selected parameters 
+    lag_lookup gather lagged values of a (time, key) table for every row of a panel
+        - index the table on its time and key variables once
+        - look up the lagged time of every row by integer positions
+        - rows without a match get missing values (as a left merge), every
+          row if the table is empty
     Args:
-        v_name [list]: list of parameters
-        res []: regression results
-        ceof_dict [lst]: list to append 
-        
+        df [DataFrame]: panel
+        table [DataFrame]: table unique on time and key variables
+        time_var [str]: time variable (in both df and table)
+        left_on [lst]: key variables in df
+        right_on [lst]: key variables in table
+        lags_lst [lst]: numbers of lags
     Return:
-        new dictionary
-    """
-    temp_dict = copy.deepcopy(ceof_dict)
-    dict1 = {}
-    coefs_value = res.params[v_name]
-    std = res.std_errors[v_name]
-    lower_ci = res.conf_int().loc[v_name, "lower"]
-    upper_ci = res.conf_int().loc[v_name, "upper"]
-    p_value = res.pvalues[v_name]
-    nobs = res.nobs
-    sign = (lower_ci * upper_ci > 0)
-    dict1.update({"depend_var": depend_var, "age": age, "Coef": coefs_value,
-                "std":std, "lower_ci": lower_ci, "upper_ci": upper_ci,
-                "p values":p_value, "significance": sign, "# obs":nobs}) 
-    temp_dict.append(dict1)
-    
-    return temp_dict
+        dictionary of {L_{lags}_{var}: array} aligned with the rows of df
+    """
+    value_var = [col for col in table.columns if col not in [time_var] + right_on]
+    if table.empty:
+        # no row has a match (as a left merge with an empty table)
+        return {f"L_{lags}_{var}": np.full(len(df), np.nan) for lags in lags_lst for var in value_var}
+
+    index = pd.MultiIndex.from_frame(table[[time_var] + right_on])
+    if not index.is_unique:
+        raise pd.errors.MergeError(
+            f"lag_lookup: table is not unique on {[time_var] + right_on}"
+            )
+    values = {var: table[var].to_numpy() for var in value_var}
+
+    time = df[time_var].to_numpy()
+    keys = [df[var].to_numpy() for var in left_on]
+
+    lagged = {}
+    for lags in lags_lst:
+        query = pd.MultiIndex.from_arrays([time - lags] + keys)
+        pos = index.get_indexer(query)
+        found = pos >= 0
+        for var in value_var:
+            column = values[var].take(pos)
+            if not found.all():
+                if column.dtype.kind in "iub":
+                    column = column.astype(np.float64)
+                column[~found] = np.nan
+            lagged[f"L_{lags}_{var}"] = column
 
+    return lagged
 
-def plot_lp(df, depend_var, plot_name, fig_path, std):
+
+class CoefTable:
     """
-    plot_lp plot local projection graph
+    CoefTable table of estimates and C.I. for selected parameters of many fits
+        - numeric columns are arrays grown by doubling (each add is O(1) amortized)
+        - all parameters of a fit are read in one pass (conf_int is called once)
+        - columns: depend_var, parameter, age, Coef, std, lower_ci, upper_ci,
+          p values, significance and # obs
     Args:
-        df [DataFrame]: Data contains coefs
-        depend_var [str]: dependent variable
-        plot_name [str]: name for the plot 
-        var_names [lst]: lst of string of variable names
-        fig_path [Path]: path of the figure
-    Return:
-        None
-    """
-    fig, ax = plt.subplots()
-    depend_name = depend_var.replace("_", " ").title()
-
-    df_sub = df[df.depend_var == depend_var]
-    Age = df_sub.age.to_numpy().T
-    Coef = df_sub.Coef.to_numpy().T 
-    Coef = Coef * std
-    lower_ci = - df_sub[["lower_ci"]].to_numpy().T + df_sub.Coef.to_numpy().T 
-    lower_ci  = lower_ci * std
-    upper_ci = df_sub[["upper_ci"]].to_numpy().T - df_sub.Coef.to_numpy().T 
-    upper_ci = upper_ci * std
-    yerr = np.vstack((lower_ci, upper_ci))
-
-    ax.scatter(Age, Coef)
-    ax.errorbar(Age, Coef, yerr = yerr, fmt = 'o',color = 'orange', 
-        ecolor = 'lightgreen', elinewidth = 3, capsize=5)   
-    ax.axhline(y=0, color='r', linestyle=':')
-
-    ax.set_title(f"{depend_name}".title())
-    ax.set_xlabel("Age")
-    ax.set_ylabel(f"{depend_name}".title())
-
-    fig.suptitle(f'Effects of Regulation on {depend_name}')        
-    fig.tight_layout()
-    fig_final_path = fig_path/f"{plot_name}_{depend_name}.png"
-    
-    fig.savefig(fig_final_path, facecolor='white', transparent=False)
-    plt.close(fig)
-    return None
+        capacity [int]: initial number of rows
+    """
+
+    VALUES = ["Coef", "std", "lower_ci", "upper_ci", "p values"]
+
+    def __init__(self, capacity=64):
+        self.n_rows = 0
+        self.values = np.empty((capacity, len(self.VALUES)))
+        self.nobs = np.empty(capacity, dtype=np.int64)
+        self.labels = {"depend_var": [], "parameter": [], "age": []}
+
+    def __len__(self):
+        return self.n_rows
+
+    def add(self, depend_var, v_name, res, age):
+        """
+        add append the estimates of selected parameters of one fit
+        Args:
+            depend_var [str]: dependent variable
+            v_name [str or lst]: parameter or list of parameters
+            res []: regression results (params, std_errors, conf_int, pvalues and nobs)
+            age [str]: age group (or label of the sample)
+        Return:
+            None
+        """
+        v_name = [v_name] if isinstance(v_name, str) else list(v_name)
+        ci = res.conf_int()
+        values = np.column_stack([
+            res.params[v_name], res.std_errors[v_name],
+            ci.loc[v_name, "lower"], ci.loc[v_name, "upper"], res.pvalues[v_name],
+            ])
+
+        n_new = self.n_rows + len(v_name)
+        if n_new > len(self.values):
+            capacity = max(2 * len(self.values), n_new)
+            self.values = np.resize(self.values, (capacity, len(self.VALUES)))
+            self.nobs = np.resize(self.nobs, capacity)
+        self.values[self.n_rows:n_new] = values
+        self.nobs[self.n_rows:n_new] = res.nobs
+        self.labels["depend_var"] += [depend_var] * len(v_name)
+        self.labels["parameter"] += v_name
+        self.labels["age"] += [age] * len(v_name)
+        self.n_rows = n_new
 
+    def to_frame(self):
+        """
+        to_frame DataFrame of the collected rows
+        """
+        df = pd.DataFrame(self.labels)
+        df[self.VALUES] = self.values[:self.n_rows]
+        df["significance"] = df["lower_ci"] * df["upper_ci"] > 0
+        df["# obs"] = self.nobs[:self.n_rows]
+        return df
@@ -0,0 +1,89 @@
+"""
+Shared fixtures of the tests: the Src package and synthetic raw data (see Src.synthetic)
+"""
+
+import importlib.util
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+# the package is imported as Src: the src folder on case-insensitive file systems,
+# registered under that name on the others
+try:
+    import Src
+except ImportError:
+    spec = importlib.util.spec_from_file_location(
+        "Src", ROOT/"src"/"__init__.py", submodule_search_locations=[str(ROOT/"src")]
+        )
+    Src = importlib.util.module_from_spec(spec)
+    sys.modules["Src"] = Src
+    spec.loader.exec_module(Src)
+
+
+@pytest.fixture(scope="session")
+def synthetic_config(tmp_path_factory):
+    """
+    synthetic_config config of a run on synthetic raw data (scale 1, every path in a temporary dir)
+    """
+    from Src.utility import parse_config
+    from Src.benchmark import benchmark_config
+    from Src.synthetic import synthetic_data
+
+    work_dir = tmp_path_factory.mktemp("synthetic")
+    config = benchmark_config(parse_config(ROOT/"src"/"config.yaml"), work_dir)
+    config["make_data"]["duckdb_temp_path"] = str(work_dir/"tmp")
+    config["model"]["bootstrap_reps"] = 0
+    synthetic_data(work_dir/"raw", config, scale=1, seed=0)
+    return config
+
+
+def make_panels(config, work_dir, jobs=1):
+    """
+    make_panels run make_data with the config in work_dir (raw data of config, jobs worker processes)
+    Return:
+        config of the run (panel paths of the model section in work_dir)
+    """
+    import yaml
+    from Src.benchmark import benchmark_config
+    from Src.make_data import data_output
+
+    config_run = benchmark_config(config, work_dir)
+    config_run["make_data"]["data_file_path"] = config["make_data"]["data_file_path"]
+    Path(config_run["make_data"]["cleaned_data_path"]).mkdir(parents=True, exist_ok=True)
+    with open(work_dir/"config.yaml", "w") as f:
+        yaml.safe_dump(config_run, f, sort_keys=False)
+    data_output(str(work_dir/"config.yaml"), jobs, use_cache=False)
+    return config_run
+
+
+@pytest.fixture(scope="session")
+def synthetic_panels(synthetic_config, tmp_path_factory):
+    """
+    synthetic_panels config of the cleaned panels of the synthetic raw data (pandas backend)
+    """
+    return make_panels(synthetic_config, tmp_path_factory.mktemp("panels"))
+
+
+@pytest.fixture(scope="session")
+def parallel_panels(synthetic_config, tmp_path_factory):
+    """
+    parallel_panels config of the cleaned panels built by 2 worker processes (pandas backend)
+    """
+    return make_panels(synthetic_config, tmp_path_factory.mktemp("jobs"), jobs=2)
+
+
+@pytest.fixture(scope="session")
+def duckdb_panels(synthetic_config, tmp_path_factory):
+    """
+    duckdb_panels config of the cleaned panels built by the duckdb backend (BDS and RegData queries)
+    """
+    import copy
+
+    config = copy.deepcopy(synthetic_config)
+    config["make_data"]["backend"] = "duckdb"
+    config["make_data"]["regdata_backend"] = "duckdb"
+    return make_panels(config, tmp_path_factory.mktemp("duckdb"))
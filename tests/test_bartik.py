@@ -0,0 +1,80 @@
+"""
+Tests of the shift share instrument against the instrument of the first version of the project
+"""
+
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from Src.bartik import bartik_instrument
+from Src.bartik import BARTIK_UNIT
+from Src.make_data import data_regdata_sums
+from Src.storage import read_raw
+
+
+def bartik_baseline(df_merge, baseline_years, mode):
+    """
+    bartik_baseline instrument of the first version of the project: initial shares
+    merged on every row (missing if none), groupby sum of share * log restrictions
+    (missing products are skipped, -inf with a positive share is kept)
+    """
+    unit = BARTIK_UNIT[mode]
+    df_init = df_merge.loc[df_merge.year.isin(baseline_years)]
+    df_init = df_init.groupby(["industry", unit])["reg_s_d"].sum().reset_index()
+    reg_s_init = df_init.groupby("industry")["reg_s_d"].transform("sum")
+    df_init["share_init"] = np.where(df_init["reg_s_d"] > 0, df_init["reg_s_d"] / reg_s_init, 0)
+
+    df = df_merge.merge(df_init[["industry", unit, "share_init"]], how="left", on=["industry", unit])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if mode == 1:
+            log_reg_d = np.log(df["restrictions_2_0"] - df["reg_s_d"])
+        else:
+            log_reg_d = np.log(df["restrictions_2_0"])
+    df["log_reg_d_one_out"] = np.where(df["restrictions_2_0"] > 0, log_reg_d, 0)
+    df["bartik_iv"] = df["log_reg_d_one_out"] * df["share_init"]
+    df["industry_restrictions_2_0"] = df["reg_s_d"]
+    return df.groupby(["year", "industry"])[["industry_restrictions_2_0", "bartik_iv"]].sum().reset_index()
+
+
+@pytest.fixture(scope="module", params=[1, 2])
+def regdata_sums(request, synthetic_config):
+    """
+    regdata_sums sums by year, industry and unit of the synthetic RegData (each instrument mode)
+    """
+    config_make = synthetic_config["make_data"]
+    data_file_path = Path(config_make["data_file_path"])
+    df_doc = read_raw(data_file_path/config_make["regdata_doc_path"], "regdata_doc")
+    df_ind = read_raw(data_file_path/config_make["regdata_ind_path"], "regdata_ind")
+    df_doc = df_doc.drop_duplicates("document_id")
+    df_doc["year"] = pd.to_numeric(df_doc.date.str.slice(0, 4))
+    doc_var = ["year", "document_id", "agency", "document_reference", "restrictions_2_0"]
+    mode = request.param
+    return data_regdata_sums(df_doc[doc_var], df_ind, unit=BARTIK_UNIT[mode]), mode
+
+
+def check_instrument(df_merge, mode):
+    baseline_years = [1986]
+    df_iv, _ = bartik_instrument(df_merge, baseline_years, mode)
+    df_ref = bartik_baseline(df_merge, baseline_years, mode)
+
+    df_iv = df_iv.sort_values(["year", "industry"]).reset_index(drop=True)
+    pd.testing.assert_frame_equal(df_iv, df_ref[df_iv.columns], check_dtype=False, rtol=1e-10)
+    return df_iv
+
+
+def test_bartik_matches_baseline(regdata_sums):
+    check_instrument(*regdata_sums)
+
+
+def test_bartik_keeps_infinite_logs(regdata_sums):
+    df_merge, mode = regdata_sums
+    df_merge = df_merge.copy()
+    # units of one industry only: the leave one out restrictions are zero (log is -inf)
+    rows = df_merge.sample(frac=0.2, random_state=0).index
+    df_merge.loc[rows, "restrictions_2_0"] = df_merge.loc[rows, "reg_s_d"]
+    df_merge.loc[df_merge.index[:5], "restrictions_2_0"] = 0
+    df_iv = check_instrument(df_merge, mode)
+    if mode == 1:
+        assert np.isneginf(df_iv["bartik_iv"]).any()
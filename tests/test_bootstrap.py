@@ -0,0 +1,106 @@
+"""
+Tests of the wild cluster bootstrap against a loop of 2SLS fits of the replicate data
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from Src.bootstrap import bootstrap_weights
+from Src.bootstrap import wild_cluster_bootstrap
+from Src.estimators import IVDesign
+from Src.estimators import fe_codes
+
+DEPEND_VAR = "job_creation_rate"
+REPS = 19
+SEED = 7
+
+
+@pytest.fixture(scope="module")
+def sector_design(synthetic_panels):
+    """
+    sector_design IV design of the synthetic sector panel (sector and year fixed effects)
+    """
+    df = pd.read_parquet(synthetic_panels["model"]["sector_panel"])
+    var_lst = ["L_0_log_gdp", "L_0_log_restriction_2_0", "L_0_bartik_iv", "firms", "sector", "sector_2", "year"]
+    df = df[var_lst + [DEPEND_VAR]].dropna()
+    df = df[df.firms > 0].reset_index(drop=True)
+    design = IVDesign(
+        df[["L_0_log_gdp"]], df[["L_0_log_restriction_2_0"]], df[["L_0_bartik_iv"]],
+        weights=df["firms"], fe=fe_codes(df, ["sector", "year"]),
+        )
+    return design, df[[DEPEND_VAR]], df["sector_2"]
+
+
+def fit_2sls(x, z, y, cluster_code):
+    """
+    fit_2sls 2SLS coefficients and cluster robust standard errors of one data set
+    """
+    xhat = z @ np.linalg.lstsq(z, x, rcond=None)[0]
+    params = np.linalg.lstsq(xhat, y, rcond=None)[0]
+    xa = xhat @ np.linalg.inv(xhat.T @ xhat)
+    scores = pd.DataFrame(xa * (y - x @ params)[:, None]).groupby(cluster_code).sum().to_numpy()
+    n_clusters = scores.shape[0]
+    return params, np.sqrt((scores ** 2).sum(axis=0) * n_clusters / (n_clusters - 1))
+
+
+def replicate_data(x, z, k_exog, params, u, v_obs):
+    """
+    replicate_data outcome and regressors of one replicate (efficient first stage
+    on the instruments and the structural residuals, same weights in both equations)
+    """
+    coef = np.linalg.lstsq(np.column_stack([z, u]), x[:, k_exog:], rcond=None)[0]
+    x_fit = x.copy()
+    x_fit[:, k_exog:] = z @ coef[:z.shape[1]]
+    x_boot = x_fit + (x - x_fit) * v_obs[:, None]
+    return x_boot @ params + u * v_obs, x_boot
+
+
+def test_bootstrap_matches_loop_of_fits(sector_design):
+    design, y, clusters = sector_design
+    res = wild_cluster_bootstrap(design, y, clusters, reps=REPS, seed=SEED, chunk_size=5)
+
+    x, z, yy = design.x, design.z, design.transform(y)[:, 0]
+    k_exog = x.shape[1] - len(design.endog)
+    j = design.names.index("L_0_log_restriction_2_0")
+    cluster_code = pd.factorize(np.asarray(clusters), sort=True)[0]
+    weights = bootstrap_weights(np.random.default_rng(SEED), REPS, cluster_code.max() + 1, "webb")
+
+    params, se = fit_2sls(x, z, yy, cluster_code)
+    np.testing.assert_allclose(res.params.iloc[0], params[j], rtol=1e-8)
+    np.testing.assert_allclose(res.std_errors.iloc[0], se[j], rtol=1e-8)
+
+    # restricted 2SLS (coefficient is zero)
+    free = [i for i in range(x.shape[1]) if i != j]
+    params_r = np.zeros(x.shape[1])
+    params_r[free] = fit_2sls(x[:, free], z, yy, cluster_code)[0]
+
+    tstats_res, tstats_unr, params_boot = [], [], []
+    for v in weights:
+        v_obs = v[cluster_code]
+        y_boot, x_boot = replicate_data(x, z, k_exog, params_r, yy - x @ params_r, v_obs)
+        params_b, se_b = fit_2sls(x_boot, z, y_boot, cluster_code)
+        tstats_res.append(params_b[j] / se_b[j])
+
+        y_boot, x_boot = replicate_data(x, z, k_exog, params, yy - x @ params, v_obs)
+        params_b, se_b = fit_2sls(x_boot, z, y_boot, cluster_code)
+        tstats_unr.append((params_b[j] - params[j]) / se_b[j])
+        params_boot.append(params_b[j])
+
+    np.testing.assert_allclose(res.params_boot.iloc[:, 0], params_boot, rtol=1e-7)
+    np.testing.assert_allclose(res.tstats_boot.iloc[:, 0], tstats_unr, rtol=1e-6, atol=1e-8)
+    pvalue = np.mean(np.abs(tstats_res) >= abs(params[j] / se[j]))
+    assert res.pvalues.iloc[0] == pytest.approx(pvalue)
+
+
+def test_bootstrap_threads_match_serial(sector_design):
+    design, y, clusters = sector_design
+    res = wild_cluster_bootstrap(design, y, clusters, reps=REPS, seed=SEED, chunk_size=REPS)
+    res_chunks = wild_cluster_bootstrap(design, y, clusters, reps=REPS, seed=SEED, chunk_size=4)
+    res_threads = wild_cluster_bootstrap(design, y, clusters, reps=REPS, seed=SEED, chunk_size=4, jobs=3)
+
+    pd.testing.assert_frame_equal(res_threads.tstats_boot, res_chunks.tstats_boot, check_exact=True)
+    pd.testing.assert_series_equal(res_threads.pvalues, res_chunks.pvalues, check_exact=True)
+    pd.testing.assert_frame_equal(res_chunks.params_boot, res.params_boot, rtol=1e-10)
+    pd.testing.assert_frame_equal(res_chunks.tstats_boot, res.tstats_boot, rtol=1e-10)
+    pd.testing.assert_series_equal(res_chunks.pvalues, res.pvalues)
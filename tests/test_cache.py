@@ -0,0 +1,60 @@
+"""
+Tests of the stage cache (keys of the stages on the source of the modules they import)
+"""
+
+from pathlib import Path
+
+from Src.cache import StageCache
+from Src.cache import module_files
+from Src import make_data
+
+
+def write_package(package_dir, helper_body):
+    """
+    write_package small Src package: a stage module, a helper it imports and
+    a helper imported by the helper (inside a function)
+    """
+    package_dir.mkdir(exist_ok=True)
+    (package_dir/"stage.py").write_text("from Src.helper import scale\nimport numpy as np\n")
+    (package_dir/"helper.py").write_text("def scale(x):\n    from Src import base\n    return x\n")
+    (package_dir/"base.py").write_text(helper_body)
+    (package_dir/"other.py").write_text("")
+
+
+def stage(calls):
+    calls.append(1)
+    return len(calls)
+
+
+def test_module_files_follow_imports(tmp_path):
+    write_package(tmp_path/"Src", "factor = 1\n")
+    files = [path.name for path in module_files(tmp_path/"Src"/"stage.py")]
+    assert files == ["base.py", "helper.py", "stage.py"]
+
+
+def test_make_data_stages_keyed_on_imported_modules():
+    files = [path.name for path in module_files(Path(make_data.__file__))]
+    for name in ["make_data.py", "storage.py", "utility.py", "bartik.py", "mappings.py", "queries.py"]:
+        assert name in files
+
+
+def test_stage_reruns_after_helper_edit(tmp_path):
+    package_dir = tmp_path/"Src"
+    write_package(package_dir, "factor = 1\n")
+    calls = []
+
+    def run():
+        cache = StageCache(tmp_path/"cache", code_files=module_files(package_dir/"stage.py"))
+        return cache.run("stage", ["parts"], stage, calls)[1]
+
+    assert run() == 1
+    assert run() == 1
+
+    # a module that is not imported does not invalidate the stage
+    (package_dir/"other.py").write_text("factor = 20\n")
+    assert run() == 1
+
+    # a nested helper does
+    (package_dir/"base.py").write_text("factor = 20\n")
+    assert run() == 2
+    assert run() == 2
@@ -0,0 +1,114 @@
+"""
+Tests of the 2SLS estimators against linearmodels (fixed effects as dummies)
+"""
+
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from Src.estimators import IVDesign
+from Src.estimators import DesignCache
+from Src.estimators import absorb
+from Src.estimators import fe_codes
+
+DEPEND_VARS = ["job_creation_rate", "net_job_creation_rate"]
+
+
+@pytest.fixture(scope="module")
+def sector_panel(synthetic_panels):
+    """
+    sector_panel estimation sample of the synthetic sector panel
+    """
+    df = pd.read_parquet(synthetic_panels["model"]["sector_panel"])
+    var_lst = ["L_0_log_gdp", "L_0_log_restriction_2_0", "L_0_bartik_iv", "firms", "sector", "sector_2", "year"]
+    df = df[var_lst + DEPEND_VARS].dropna()
+    return df[df.firms > 0].reset_index(drop=True)
+
+
+def linearmodels_fit(df, depend_var, cov_type, fe_vars=("sector", "year"), **cov_config):
+    """
+    linearmodels_fit IV2SLS with a constant and dummies of the fixed effects
+    """
+    from linearmodels.iv import IV2SLS
+
+    exog = [pd.Series(1.0, index=df.index, name="const"), df[["L_0_log_gdp"]]]
+    if fe_vars:
+        exog.append(pd.get_dummies(df[list(fe_vars)].astype(str), drop_first=True, dtype=float))
+    exog = pd.concat(exog, axis=1)
+    mod = IV2SLS(df[depend_var], exog, df[["L_0_log_restriction_2_0"]], df[["L_0_bartik_iv"]], weights=df["firms"])
+    return mod.fit(cov_type=cov_type, debiased=False, **cov_config)
+
+
+@pytest.mark.parametrize("se_type", ["robust", "clustered"])
+def test_iv_design_matches_linearmodels(sector_panel, se_type):
+    df = sector_panel
+    design = IVDesign(
+        df[["L_0_log_gdp"]], df[["L_0_log_restriction_2_0"]], df[["L_0_bartik_iv"]],
+        weights=df["firms"], fe=fe_codes(df, ["sector", "year"]),
+        )
+    clusters = df["sector_2"] if se_type == "clustered" else None
+    results = design.fit(df[DEPEND_VARS], clusters=clusters)
+
+    for depend_var in DEPEND_VARS:
+        if se_type == "clustered":
+            res_ref = linearmodels_fit(df, depend_var, "clustered", clusters=df["sector_2"])
+            # variance scaled by G / (G - 1) (see IVDesign.fit)
+            n_clusters = df["sector_2"].nunique()
+            scale = np.sqrt(n_clusters / (n_clusters - 1))
+        else:
+            res_ref = linearmodels_fit(df, depend_var, "robust")
+            scale = 1.0
+        res = results[depend_var]
+        for var in ["L_0_log_gdp", "L_0_log_restriction_2_0"]:
+            np.testing.assert_allclose(res.params[var], res_ref.params[var], rtol=1e-6)
+            np.testing.assert_allclose(res.std_errors[var], res_ref.std_errors[var] * scale, rtol=1e-6)
+        assert res.nobs == res_ref.nobs
+
+
+def test_design_without_fixed_effects_has_a_constant(sector_panel):
+    df = sector_panel
+    designs = DesignCache()
+    spec = designs.spec(
+        "sector", ["L_0_log_gdp"], ["L_0_log_restriction_2_0"], ["L_0_bartik_iv"], weights="firms", fe_vars=[],
+        )
+    design, mask = designs.design(df, spec, DEPEND_VARS[0])
+    res = design.fit(df.loc[mask, [DEPEND_VARS[0]]])[DEPEND_VARS[0]]
+    res_ref = linearmodels_fit(df[mask], DEPEND_VARS[0], "robust", fe_vars=())
+
+    assert list(res.params.index) == ["const", "L_0_log_gdp", "L_0_log_restriction_2_0"]
+    np.testing.assert_allclose(res.params, res_ref.params[res.params.index], rtol=1e-6)
+    np.testing.assert_allclose(res.std_errors, res_ref.std_errors[res.params.index], rtol=1e-6)
+
+
+def test_absorb_warns_without_convergence(sector_panel):
+    df = sector_panel
+    codes = fe_codes(df, ["sector", "year"])
+    with pytest.warns(RuntimeWarning, match="no convergence after 1 sweeps"):
+        absorb(df[["L_0_log_gdp"]], codes, df["firms"], max_iter=1)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        absorb(df[["L_0_log_gdp"]], codes, df["firms"])
+
+
+def test_design_cache_bounds_designs_and_samples(sector_panel):
+    df = sector_panel
+    designs = DesignCache()
+    design, mask = designs.design(df, designs.spec("sector", ["L_0_log_gdp"], fe_vars=["sector"]), DEPEND_VARS[0])
+    one_fit = design.nbytes + mask.nbytes
+    designs.max_bytes = 3 * one_fit
+
+    # one sample and design per sample restriction
+    for year in range(1990, 2010):
+        sample = df[df.year > year]
+        spec = designs.spec("sector", ["L_0_log_gdp"], fe_vars=["sector"], sample=year)
+        for depend_var in DEPEND_VARS:
+            designs.design(sample, spec, depend_var)
+        # samples of specifications without a design
+        designs.mask(sample, designs.spec("ols", ["L_0_log_gdp"], sample=year), DEPEND_VARS[0])
+        assert designs.nbytes <= designs.max_bytes
+    # 20 designs and 60 samples were built
+    assert 0 < len(designs.designs) < 20
+    assert len(designs.masks) < 60
@@ -0,0 +1,25 @@
+"""
+Tests of the run reports (peak memory of each stage)
+"""
+
+import json
+import time
+
+import numpy as np
+
+from Src.profiling import RunReport
+from Src.profiling import stage
+
+
+def test_stage_peak_memory_is_per_stage(tmp_path):
+    with RunReport("test", tmp_path) as report:
+        with stage("large"):
+            data = np.ones(2**25)       # 256 MB
+            time.sleep(0.05)
+            del data
+        with stage("small"):
+            time.sleep(0.05)
+
+    with open(report.run_dir/"stages.json", "r") as f:
+        peaks = {record["stage"]: record["peak_rss_mb"] for record in json.load(f)["stages"]}
+    assert peaks["large"] - peaks["small"] > 200
@@ -0,0 +1,33 @@
+"""
+Tests of the duckdb backend against the pandas build of the panels
+"""
+
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+PANELS = ["sector_panel", "sector_age_panel", "sector_size_panel", "sector_age_size_panel", "agg_pattern"]
+
+
+def panel_path(config, panel):
+    """
+    panel_path file of a cleaned panel (agg_pattern is stored next to the sector panel)
+    """
+    if panel in config["model"]:
+        return config["model"][panel]
+    sector_panel = Path(config["model"]["sector_panel"])
+    return sector_panel.with_name(panel + sector_panel.suffix)
+
+
+@pytest.mark.parametrize("panel", PANELS)
+def test_duckdb_panels_match_pandas(synthetic_panels, duckdb_panels, panel):
+    df = pd.read_parquet(panel_path(synthetic_panels, panel))
+    df_duckdb = pd.read_parquet(panel_path(duckdb_panels, panel))
+
+    assert list(df_duckdb.columns) == list(df.columns)
+    keys = [var for var in ["year", "sector", "sector_2", "age_coarse", "large_firm"] if var in df.columns]
+    assert not df.duplicated(keys).any()
+    df = df.sort_values(keys).reset_index(drop=True)
+    df_duckdb = df_duckdb.sort_values(keys).reset_index(drop=True)
+    pd.testing.assert_frame_equal(df_duckdb, df, check_dtype=False, check_categorical=False, rtol=1e-8)
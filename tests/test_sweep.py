@@ -0,0 +1,87 @@
+"""
+Tests of the specification grid of the sweep on panels stored in every format
+"""
+
+import copy
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from Src.storage import write_panel
+from Src.storage import read_panel
+from Src.storage import panel_columns
+from Src.sweep import sweep_tasks
+from Src.sweep import fit_task
+from Src.sweep import init_worker
+
+
+def sweep_config(config, panel_path):
+    """
+    sweep_config grid of one panel split by age group, one regressor set and one sample
+    """
+    config = copy.deepcopy(config)
+    config["model"]["sector_age_panel"] = str(panel_path)
+    config_sweep = config["sweep"]
+    config_sweep["panels"] = {"sector_age": "age_coarse"}
+    config_sweep["regressors"] = {"iv": config_sweep["regressors"]["iv"]}
+    config_sweep["samples"] = {"1986_2019": config_sweep["samples"]["1986_2019"]}
+    return config
+
+
+@pytest.fixture(scope="module")
+def sector_age_panel(synthetic_panels):
+    """
+    sector_age_panel synthetic sector age panel
+    """
+    df = read_panel(synthetic_panels["model"]["sector_age_panel"])
+    return df
+
+
+@pytest.mark.parametrize("suffix", [".feather", ".h5", ".csv"])
+def test_sweep_tasks_of_every_format(synthetic_panels, sector_age_panel, tmp_path, suffix):
+    config = sweep_config(synthetic_panels, synthetic_panels["model"]["sector_age_panel"])
+    path = tmp_path/f"sector_age_panel{suffix}"
+    write_panel(sector_age_panel, path)
+    config_fmt = sweep_config(synthetic_panels, path)
+
+    tasks = sweep_tasks(config)
+    tasks_fmt = sweep_tasks(config_fmt)
+    assert len(tasks_fmt) == len(tasks) > 0
+    for task, task_fmt in zip(tasks, tasks_fmt):
+        for var in ["group", "outcomes", "fixed_effects"]:
+            assert task_fmt[var] == task[var]
+        assert sorted(task_fmt["columns"]) == sorted(task["columns"])
+
+    # same estimates from the panel of each format
+    init_worker()
+    df = fit_task(tasks[0])
+    init_worker()
+    df_fmt = fit_task(tasks_fmt[0])
+    assert df["coef"].notna().any()
+    np.testing.assert_allclose(df_fmt["coef"], df["coef"], rtol=1e-8)
+
+
+def test_sweep_tasks_unknown_format(synthetic_panels, tmp_path):
+    path = tmp_path/"sector_age_panel.xlsx"
+    path.touch()
+    with pytest.raises(ValueError, match="unknown panel format .xlsx"):
+        sweep_tasks(sweep_config(synthetic_panels, path))
+
+
+
+@pytest.mark.parametrize("suffix", [".feather", ".h5"])
+def test_read_panel_columns_and_filters(sector_age_panel, tmp_path, suffix):
+    path = tmp_path/f"sector_age_panel{suffix}"
+    write_panel(sector_age_panel, path)
+    assert panel_columns(path) == list(sector_age_panel.columns)
+
+    df = sector_age_panel
+    age_groups = list(df["age_coarse"].unique()[:2])
+    columns = ["sector", "age_coarse", "L_0_log_gdp"]
+    df_read = read_panel(path, columns=columns, filters=[("year", ">", 1990), ("age_coarse", "in", age_groups)])
+    df_ref = df.loc[(df.year > 1990) & df["age_coarse"].isin(age_groups), columns]
+    assert list(df_read.columns) == columns
+    pd.testing.assert_frame_equal(
+        df_read.reset_index(drop=True), df_ref.reset_index(drop=True), check_dtype=False, check_categorical=False,
+        )
@@ -0,0 +1,123 @@
+"""
+Tests of the panel helpers of utility (lags of the panels)
+"""
+
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from Src.utility import lag_variables
+from Src.utility import lag_lookup
+from Src.storage import read_raw
+from Src.storage import uniform_objects
+from Src.utility import share_frames
+from Src.utility import load_shared
+
+
+def lag_variable_merge(df, time_var, id_var, var, lags):
+    """
+    lag_variable_merge lag of one variable by a group shift and a join
+    (the lag_variable of the first version of the project)
+    """
+    index_var = time_var + id_var
+    df = df.sort_values(by=index_var)
+    df = df.set_index(index_var)
+    shifted = df[var].groupby(level=id_var).shift(lags)
+    shifted = shifted.rename(columns={var[0]: f"L_{lags}_{var[0]}"})
+    df = df.join(shifted)
+    return df.reset_index()
+
+
+@pytest.fixture(scope="module")
+def bds_panel(synthetic_config):
+    """
+    bds_panel sector x size x age panel of the synthetic BDS table (with missing cells and gaps)
+    """
+    config_make = synthetic_config["make_data"]
+    df = read_raw(Path(config_make["data_file_path"])/config_make["bds_sector_size"], "bds_sector_size")
+    df = df[["year", "sector", "fage", "fsize", "firms", "emp", "job_creation"]]
+    # drop some years of some groups
+    return df.sample(frac=0.9, random_state=0).reset_index(drop=True)
+
+
+def test_lag_variables_match_lag_variable(bds_panel):
+    id_var = ["sector", "fage", "fsize"]
+    var_lst = ["firms", "emp", "job_creation"]
+    lags_lst = [0, 1, 2, -1]
+
+    df = lag_variables(bds_panel, ["year"], id_var, var_lst, lags_lst, change=True)
+
+    df_ref = bds_panel
+    for var in var_lst:
+        for lags in lags_lst:
+            df_ref = lag_variable_merge(df_ref, ["year"], id_var, [var], lags)
+    for var in var_lst:
+        df_ref[f"{var}_chg"] = df_ref[var] - df_ref[f"L_1_{var}"]
+
+    pd.testing.assert_frame_equal(
+        df.reset_index(drop=True), df_ref[df.columns].reset_index(drop=True),
+        check_dtype=False, check_categorical=False,
+        )
+
+
+@pytest.fixture(scope="module")
+def regdata_table(synthetic_config):
+    """
+    regdata_table synthetic RegData industries (year and 2 digit sector), with gaps
+    """
+    config_make = synthetic_config["make_data"]
+    df = read_raw(Path(config_make["data_file_path"])/config_make["regdata_origin_path"], "regdata_origin")
+    df = df.rename(columns={"NAICS": "sector_reg"})
+    return df.sample(frac=0.8, random_state=0).reset_index(drop=True)
+
+
+def lag_merge(df, table, lags):
+    """
+    lag_merge lagged values by a left merge on the lag year (data_final of the first version)
+    """
+    df = df.assign(L_year=df["year"] - lags)
+    df = df.merge(
+        table, how="left", left_on=["L_year", "sector_2"], right_on=["year", "sector_reg"],
+        suffixes=("", "_reg"), validate="many_to_one",
+        )
+    return df.rename(columns={
+        var: f"L_{lags}_{var}" for var in ["industry_restrictions_1_0", "industry_restrictions_2_0"]
+        })
+
+
+def test_lag_lookup_matches_merge(bds_panel, regdata_table):
+    df = bds_panel.assign(sector_2=bds_panel["sector"].astype(str).str[:2].astype(int))
+    lagged = lag_lookup(df, regdata_table, "year", ["sector_2"], ["sector_reg"], [0, 1, 2])
+
+    for lags in [0, 1, 2]:
+        df_ref = lag_merge(df, regdata_table, lags)
+        for var in ["industry_restrictions_1_0", "industry_restrictions_2_0"]:
+            np.testing.assert_array_equal(lagged[f"L_{lags}_{var}"], df_ref[f"L_{lags}_{var}"].to_numpy())
+
+
+def test_lag_lookup_empty_table(bds_panel, regdata_table):
+    df = bds_panel.assign(sector_2=bds_panel["sector"].astype(str).str[:2].astype(int))
+    lagged = lag_lookup(df, regdata_table.iloc[:0], "year", ["sector_2"], ["sector_reg"], [0, 1])
+
+    assert sorted(lagged) == sorted(
+        f"L_{lags}_{var}" for lags in [0, 1] for var in ["industry_restrictions_1_0", "industry_restrictions_2_0"]
+        )
+    for column in lagged.values():
+        assert len(column) == len(df) and np.isnan(column).all()
+
+
+def test_shared_frames_match_raw(tmp_path):
+    df = uniform_objects(pd.DataFrame({
+        "sector": [11, "31-33", None, 42], "gdp": [1.0, 2.0, np.nan, 4.0], "naics": ["11", "21", "22", None],
+        }))
+    paths = share_frames({"raw": df}, tmp_path)
+    pd.testing.assert_frame_equal(load_shared(paths["raw"]), df)
+
+
+@pytest.mark.parametrize("panel", ["sector_panel", "sector_age_size_panel"])
+def test_make_data_jobs_match_serial(synthetic_panels, parallel_panels, panel):
+    pd.testing.assert_frame_equal(
+        pd.read_parquet(parallel_panels["model"][panel]), pd.read_parquet(synthetic_panels["model"][panel])
+        )